@@ -0,0 +1,109 @@
+'''Benchmark the bull control plane against a simulated kernel.
+
+For each number of live snapshots, create that many snapshots one at
+a time, list them, then remove them one at a time, all against a
+bull.fake.FakeKernel. This measures the work bull itself does (the
+commands it runs, the ioctls it makes and the time it spends in
+Python) rather than the kernel, so it needs no root and gives the
+same answer on any machine. Run it from the top of the source tree:
+
+    python -m benchmarks.control_plane --counts 1,10,100 --dmsetup
+'''
+
+import click
+import json
+from pathlib import Path
+import statistics
+import tempfile
+import time
+
+from bull import api
+from bull import fake
+from bull import listing
+
+LIST_REPEAT = 5
+
+
+def measure(kernel, func):
+    '''Call func, returning the seconds taken and the commands and ioctls
+    it caused.'''
+
+    subprocesses, ioctls = kernel.subprocesses, kernel.ioctls
+    started = time.perf_counter()
+    func()
+    return (time.perf_counter() - started,
+            kernel.subprocesses - subprocesses, kernel.ioctls - ioctls)
+
+
+def run(count, dmsetup=False, engine='snapshot'):
+    '''Create, list and remove count snapshots and return the results.'''
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        image = Path(tmpdir) / 'disk.img'
+        fake.make_image(image)
+
+        with fake.FakeKernel(Path(tmpdir) / 'run',
+                             dmsetup=dmsetup) as kernel:
+            names = []
+            created = measure(kernel, lambda: [
+                names.extend(snap.name for snap in api.create_snapshots(
+                    image, part=1, engine=engine))
+                for i in range(count)])
+
+            listed = [measure(kernel, listing.list_snapshots)
+                      for i in range(LIST_REPEAT)]
+
+            removed = measure(kernel, lambda: [
+                api.remove_snapshot(name) for name in names])
+
+    return {
+        'snapshots': count,
+        'creates_per_sec': count / created[0],
+        'removes_per_sec': count / removed[0],
+        'list_ms': statistics.median(t for t, s, i in listed) * 1000,
+        'subprocesses_per_create': created[1] / count,
+        'subprocesses_per_remove': removed[1] / count,
+        'subprocesses_per_list': listed[0][1],
+        'ioctls_per_create': created[2] / count,
+        'ioctls_per_remove': removed[2] / count,
+        'ioctls_per_list': listed[0][2],
+    }
+
+
+def format_results(results):
+    lines = ['{:>9} {:>10} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'SNAPSHOTS', 'CREATE/S', 'REMOVE/S', 'LIST_MS', 'PROCS/CREATE',
+        'PROCS/REMOVE', 'PROCS/LIST')]
+
+    for r in results:
+        lines.append(
+            '{snapshots:>9} {creates_per_sec:>10.1f} '
+            '{removes_per_sec:>10.1f} {list_ms:>10.2f} '
+            '{subprocesses_per_create:>12.1f} '
+            '{subprocesses_per_remove:>12.1f} '
+            '{subprocesses_per_list:>12}'.format(**r))
+
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--counts', default='1,10,100,1000',
+              help='comma-separated numbers of live snapshots')
+@click.option('--dmsetup', is_flag=True,
+              help='use the dmsetup backend instead of ioctls')
+@click.option('--engine', type=click.Choice(api.ENGINES),
+              default='snapshot')
+@click.option('--json', 'as_json', is_flag=True,
+              help='print results as JSON')
+def main(counts, dmsetup, engine, as_json):
+    results = [run(int(count), dmsetup=dmsetup, engine=engine)
+               for count in counts.split(',')]
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+from bull.aio import snapshot
+
+__all__ = ['snapshot']
@@ -0,0 +1,369 @@
+'''Create and remove snapshots from asyncio programs.
+
+The only slow parts of building a snapshot are the commands bull runs:
+losetup and, with the dmsetup backend, dmsetup. Here they run as
+asyncio subprocesses, so that many snapshot lifecycles can overlap on
+one event loop. Device-mapper ioctls and zram sysfs writes return as
+soon as the kernel has done the work, so they are made directly.
+
+    async with bull.snapshot('disk.img', part=2) as dev:
+        ...
+
+Only the snapshot engine is supported here. Removing a snapshot
+unmounts it and removes its device from the event loop; the rest of
+its devices, which its registry record lists, are released by the
+blocking code in bull.api on a worker thread, as are snapshots that
+are not in the registry.
+'''
+
+import asyncio
+import contextlib
+import functools
+import logging
+from pathlib import Path
+import subprocess
+import weakref
+
+from bull import api
+from bull import budget as snapbudget
+from bull import dmioctl
+from bull import loop
+from bull import mapper
+from bull import timing
+from bull import zram
+from bull.blockdev import BlockDevice
+from bull.common import lock_file, run_command_async
+from bull.exceptions import (DeviceExists, DeviceMapperError,
+                             NoSuchDevice)
+from bull.host import get_host
+from bull.registry import get_registry
+
+LOG = logging.getLogger(__name__)
+
+_loop_locks = weakref.WeakKeyDictionary()
+
+
+@contextlib.asynccontextmanager
+async def _lock_file(path):
+    '''Hold common.lock_file(path), waiting for it on a worker thread
+    rather than in the event loop.'''
+
+    lock = lock_file(path)
+    await asyncio.get_running_loop().run_in_executor(None, lock.__enter__)
+    try:
+        yield
+    finally:
+        lock.__exit__(None, None, None)
+
+
+class AsyncBackend():
+    '''Make device-mapper calls from a coroutine.
+
+    The ioctl backend is called directly. With the dmsetup backend,
+    dmsetup is run as an asyncio subprocess.
+    '''
+
+    def __init__(self, backend=None):
+        if isinstance(backend, AsyncBackend):
+            backend = backend.backend
+
+        self.backend = backend or mapper.get_backend()
+        self.native = isinstance(self.backend, dmioctl.IoctlBackend)
+
+    async def dmsetup(self, *args, input=None):
+        try:
+            p = await run_command_async('dmsetup', *args, input=input)
+        except subprocess.CalledProcessError as e:
+            raise DeviceMapperError('dmsetup {} failed: {}'.format(
+                ' '.join(str(arg) for arg in args),
+                e.stderr.decode('utf-8').strip()))
+
+        return p.stdout.decode('utf-8')
+
+    async def exists(self, name):
+        if self.native:
+            return self.backend.exists(name)
+
+        try:
+            await self.dmsetup('status', name)
+        except DeviceMapperError:
+            return False
+
+        return True
+
+    async def create(self, name):
+        if self.native:
+            return self.backend.create(name)
+        await self.dmsetup('create', name, '--notable')
+
+    async def remove(self, name):
+        if self.native:
+            return self.backend.remove(name)
+        await self.dmsetup('remove', name)
+
+    async def suspend(self, name):
+        if self.native:
+            return self.backend.suspend(name)
+        await self.dmsetup('suspend', name)
+
+    async def resume(self, name):
+        if self.native:
+            return self.backend.resume(name)
+        await self.dmsetup('resume', name)
+
+    async def load(self, name, table):
+        if self.native:
+            return self.backend.load(name, table)
+        await self.dmsetup('load', name, input=table.encode('utf-8'))
+
+    async def table(self, name):
+        if self.native:
+            return self.backend.table(name)
+        return await self.dmsetup('table', name)
+
+    async def status(self, name):
+        if self.native:
+            return self.backend.status(name)
+        return await self.dmsetup('status', name)
+
+
+class AsyncLoopDevice(loop.LoopDevice):
+    '''A loop device created and removed with an asyncio losetup.'''
+
+    @classmethod
+    async def create(kls, backing_file, **kwargs):
+        # An asyncio lock can only be used on one event loop.
+        lock = _loop_locks.setdefault(asyncio.get_running_loop(),
+                                      asyncio.Lock())
+        cli = kls.create_args(backing_file, **kwargs)
+
+        # The asyncio lock keeps our own coroutines from queueing up for
+        # the lock file, which is waited for on a worker thread.
+        async with lock, _lock_file(loop.LOOP_LOCK):
+            p = await run_command_async('losetup', *cli)
+
+        device = p.stdout.decode('ascii').strip()
+        LOG.debug('created loop device %s', device)
+        return kls(device)
+
+    async def remove(self):
+        LOG.debug('removing loop device %s', self.device.name)
+        await run_command_async('losetup', '-d', str(self.device))
+
+
+class AsyncMapperDevice(BlockDevice):
+    '''A device-mapper device operated on from a coroutine.
+
+    Unlike MapperDevice, the table is not read when the object is
+    created; use open() or refresh() for that.
+    '''
+
+    def __init__(self, device, backend=None, table=None):
+        super().__init__(device)
+        self.backend = AsyncBackend(backend)
+        self.table = mapper.Table(table or [])
+
+    @property
+    def name(self):
+        return self.device.name
+
+    @classmethod
+    async def open(kls, name, backend=None):
+        dev = kls('/dev/mapper/{}'.format(name), backend=backend)
+        await dev.refresh()
+        return dev
+
+    @classmethod
+    async def create(kls, name, exclusive=False, backend=None):
+        LOG.debug('creating dm device %s', name)
+        backend = AsyncBackend(backend)
+
+        if await backend.exists(name):
+            if exclusive:
+                raise DeviceExists(name)
+        else:
+            await backend.create(name)
+
+        return kls('/dev/mapper/{}'.format(name), backend=backend)
+
+    @classmethod
+    async def create_first_available(kls, prefix='bull', backend=None):
+        backend = AsyncBackend(backend)
+        allocator = mapper.get_allocator(prefix, backend=backend.backend)
+
+        # The allocator takes NAMES_LOCK, which is waited for on a
+        # worker thread.
+        devname = await asyncio.get_running_loop().run_in_executor(
+            None, allocator.allocate)
+
+        return kls('/dev/mapper/{}'.format(devname), backend=backend)
+
+    async def refresh(self):
+        self.table = mapper.Table.from_string(
+            await self.backend.table(self.name))
+        self.invalidate_geometry()
+
+    async def load(self):
+        LOG.debug('loading table for dm device %s', self.name)
+        await self.backend.load(self.name, str(self.table))
+        with timing.timed('dm suspend window'):
+            await self.backend.suspend(self.name)
+            await self.backend.resume(self.name)
+        self.invalidate_geometry()
+
+    async def remove(self):
+        LOG.debug('removing dm device %s', self.name)
+        await self.backend.remove(self.name)
+
+    async def status(self):
+        return await self.backend.status(self.name)
+
+
+async def open_source(src, part=None, offset=0):
+    '''Like api.open_source, but creating any loop device with an
+    asyncio losetup.'''
+
+    src = Path(src)
+    loopdev = None
+
+    if not get_host().is_block_device(src):
+        loopdev = await AsyncLoopDevice.create(src)
+        LOG.info('mapped %s to %s', src, loopdev.device)
+        device = loopdev
+    else:
+        device = BlockDevice(src)
+
+    return api.describe_source(device, part=part, offset=offset,
+                               loopdev=loopdev)
+
+
+async def create_snapshot(src, part=None, offset=0, snap_size=None,
+                          backing_size=None, name=None, prefix='bull',
+                          backend=None, zram_options=None, registry=None):
+    '''Create a snapshot of src. See api.create_snapshots.
+
+    Under a memory budget, the snapshot's zram device is admitted (see
+    budget.reserve) on a worker thread, and BUDGET_LOCK is only held
+    for the check and for recording the snapshot. If anything fails,
+    the devices created so far are removed again.
+
+    Returns an AsyncMapperDevice.
+    '''
+
+    backend = AsyncBackend(backend)
+    run = functools.partial(asyncio.get_running_loop().run_in_executor,
+                            None)
+
+    source = await open_source(src, part=part, offset=offset)
+    snaps = []
+    base = reservation = None
+    try:
+        snap_sectors, backing_size = api.snapshot_sizes(source, snap_size,
+                                                        backing_size)
+        options = api.budgeted_options(zram_options, backing_size)
+        reservation = await run(functools.partial(
+            snapbudget.reserve, options.get('mem_limit') or backing_size,
+            registry=registry))
+
+        if name is None:
+            snap = await AsyncMapperDevice.create_first_available(
+                prefix=prefix, backend=backend)
+        else:
+            snap = await AsyncMapperDevice.create(name, exclusive=True,
+                                                  backend=backend)
+        snaps.append(snap)
+
+        base = await AsyncMapperDevice.create('{}-base'.format(snap.name),
+                                              backend=backend)
+        base.table = api.base_table(source, snap_sectors)
+        await base.load()
+
+        backing = zram.ZramDevice.create()
+        try:
+            backing.configure(backing_size, **options)
+            cowdev = await AsyncMapperDevice.create(
+                '{}-cow'.format(snap.name), exclusive=True, backend=backend)
+            cowdev.table.append(mapper.Segment(
+                0, backing_size // 512, mapper.Linear(backing.device, 0)))
+            await cowdev.load()
+        except Exception:
+            backing.remove()
+            raise
+
+        snap.table.append(mapper.Segment(
+            0, snap_sectors, mapper.Snapshot(base.device, cowdev.device)))
+        await snap.load()
+
+        template = api.snapshot_template(src, source, base, snap_sectors,
+                                         backing_size, part=part,
+                                         offset=offset, snap_size=snap_size,
+                                         zram_options=zram_options or {})
+
+        def record():
+            with snapbudget.recording(reservation):
+                api.record_snapshots([snap], template, [[backing.device]],
+                                     registry=registry)
+
+        await run(record)
+    except Exception:
+        await run(functools.partial(
+            api.discard_snapshots, snaps, source, base=base,
+            backend=backend.backend))
+        raise
+    finally:
+        if reservation is not None:
+            await run(reservation.release)
+
+    return snap
+
+
+async def remove_snapshot(name, backend=None, registry=None):
+    '''Remove a snapshot. See api.remove_snapshot.'''
+
+    backend = AsyncBackend(backend)
+    registry = registry or get_registry()
+    run = functools.partial(asyncio.get_running_loop().run_in_executor,
+                            None)
+
+    if not await backend.exists(name):
+        await run(lambda: api.release_record(name, backend=backend.backend,
+                                             registry=registry))
+        raise NoSuchDevice(name)
+
+    record = registry.get(name)
+    if record is None:
+        await run(lambda: api.remove_snapshot(name, backend=backend.backend,
+                                              registry=registry))
+        return
+
+    if record.views:
+        await run(lambda: api.remove_views(name, backend=backend.backend,
+                                           views=record.views))
+
+    snap = BlockDevice('/dev/mapper/{}'.format(name))
+    if snap.is_mounted():
+        LOG.info('unmounting %s', name)
+        await run_command_async('umount', str(snap.device))
+
+    await backend.remove(name)
+    await run(lambda: api.remove_backing(record, backend=backend.backend))
+    await run(lambda: api.release_record(name, backend=backend.backend,
+                                         registry=registry))
+
+    mapper.release_name(name, backend=backend.backend)
+
+
+@contextlib.asynccontextmanager
+async def snapshot(src, backend=None, registry=None, **kwargs):
+    '''Create a snapshot of src for the duration of an async with block.
+
+    Keyword arguments are passed to create_snapshot. The snapshot is
+    removed when the block exits.
+    '''
+
+    snap = await create_snapshot(src, backend=backend, registry=registry,
+                                 **kwargs)
+    try:
+        yield snap
+    finally:
+        await remove_snapshot(snap.name, backend=backend, registry=registry)
@@ -0,0 +1,1696 @@
+'''Create and remove bull snapshots.
+
+These are the operations behind the bull command line tool, exposed
+so that they can be used directly from Python.
+'''
+
+import attr
+import concurrent.futures
+import logging
+from pathlib import Path
+import re
+import subprocess
+import time
+
+from bull import blockdev
+from bull import budget as snapbudget
+from bull import cow
+from bull import loop
+from bull import mapper
+from bull import preload as snappreload
+from bull import spill as snapspill
+from bull import store as snapstore
+from bull import thin
+from bull import timing
+from bull import zram
+from bull.common import lock_file, run_command
+from bull.exceptions import (BullError, DeviceBusy, DeviceMapperError,
+                             NoPartitionMap, NoSuchDevice, UnsupportedDevice)
+from bull.host import get_host
+from bull.registry import SnapshotRecord, get_registry
+
+LOG = logging.getLogger(__name__)
+MAX_BACKING_SIZE = 2**30
+ENGINES = ('snapshot', 'thin')
+MERGE_INTERVAL = 1.0
+BATCH_ERRORS = (BullError, subprocess.CalledProcessError, OSError,
+                TypeError, ValueError)
+
+
+@attr.s
+class Source():
+    '''The region of a device or image file that a snapshot is built on.'''
+
+    device = attr.ib()
+    offset = attr.ib(converter=int)
+    data_sectors = attr.ib(converter=int)
+    loopdev = attr.ib(default=None)
+    preloaded = attr.ib(default=False)
+
+    @property
+    def data_size(self):
+        return self.data_sectors * 512
+
+    @property
+    def sources(self):
+        return [self]
+
+    def segments(self):
+        '''Return the segments of a base table that map this region.'''
+
+        return [mapper.Segment(0, self.data_sectors,
+                               mapper.Linear(self.device.device,
+                                             self.offset))]
+
+
+@attr.s
+class SourceSet():
+    '''Several Sources that a snapshot is built on as one: concatenated,
+    or striped across in chunks of stripe_size bytes.
+
+    Striped sources are all cut down to the size of the smallest, in
+    whole chunks.
+    '''
+
+    sources = attr.ib()
+    stripe_size = attr.ib(default=None)
+    preloaded = False
+
+    @property
+    def device(self):
+        return self.sources[0].device
+
+    @property
+    def loopdev(self):
+        return self.sources[0].loopdev
+
+    @property
+    def offset(self):
+        return self.sources[0].offset
+
+    @property
+    def stripe_sectors(self):
+        '''Sectors each source contributes when striped.'''
+
+        chunk = self.stripe_size // 512
+        return min(source.data_sectors for source in self.sources) \
+            // chunk * chunk
+
+    @property
+    def data_sectors(self):
+        if self.stripe_size is None:
+            return sum(source.data_sectors for source in self.sources)
+        return self.stripe_sectors * len(self.sources)
+
+    @property
+    def data_size(self):
+        return self.data_sectors * 512
+
+    def segments(self):
+        if self.stripe_size is not None:
+            return [mapper.Segment(0, self.data_sectors, mapper.Striped(
+                self.stripe_size // 512,
+                [(source.device.device, source.offset)
+                 for source in self.sources]))]
+
+        segments = []
+        start = 0
+        for source in self.sources:
+            segments.append(mapper.Segment(
+                start, source.data_sectors,
+                mapper.Linear(source.device.device, source.offset)))
+            start += source.data_sectors
+        return segments
+
+
+def open_source(src, part=None, offset=0, inventory=None,
+                direct_io=False, block_size=None, preload=False):
+    '''Map src onto a loop device if it is not already a block device and
+    work out which sectors of it we are snapshotting.
+
+    With preload, an image file is read directly rather than through a
+    loop device, as it is only read once (see preload_source). An image
+    file otherwise shares the loop device of any other snapshot of it
+    with the same direct_io and block_size (the loop device's logical
+    block size); see loop.LoopDevice.attach. If an inventory.Inventory
+    is given, warn when a block device source is mounted, as snapshots
+    of a filesystem in use may not be consistent.
+    '''
+
+    src = Path(src)
+    loopdev = None
+
+    if not get_host().is_block_device(src):
+        if preload:
+            device = blockdev.BlockDevice(src)
+        else:
+            loopdev = loop.LoopDevice.attach(src, direct_io=direct_io,
+                                             block_size=block_size)
+            LOG.info('mapped %s to %s', src, loopdev.device)
+            device = loopdev
+    else:
+        device = blockdev.BlockDevice(src)
+        if inventory is not None and inventory.is_mounted(src):
+            LOG.warning('%s is mounted on %s', src,
+                        inventory.mountpoint(src))
+
+    return describe_source(device, part=part, offset=offset, loopdev=loopdev)
+
+
+def open_sources(srcs, part=None, offset=0, stripe_size=None, **kwargs):
+    '''Open each of srcs (see open_source, which is given the rest of
+    the arguments) and return them as a SourceSet, which stripes them
+    in chunks of stripe_size bytes if it is given. part and offset
+    apply to every source.'''
+
+    if stripe_size is not None and \
+            (stripe_size <= 0 or stripe_size % 4096):
+        raise ValueError('stripe size must be a multiple of 4096 bytes')
+
+    sources = []
+    try:
+        for src in srcs:
+            sources.append(open_source(src, part=part, offset=offset,
+                                       **kwargs))
+    except Exception:
+        for source in sources:
+            if source.loopdev is not None:
+                source.loopdev.release()
+        raise
+    source = SourceSet(sources, stripe_size=stripe_size)
+
+    if stripe_size is not None:
+        if source.stripe_sectors == 0:
+            raise ValueError('sources are smaller than the stripe size')
+        unused = sum(each.data_sectors for each in sources) - \
+            source.data_sectors
+        if unused:
+            LOG.warning('striping leaves %d bytes of the sources unused',
+                        unused * 512)
+
+    return source
+
+
+def describe_source(device, part=None, offset=0, loopdev=None):
+    '''Work out which sectors of a (block or loop) device to snapshot.'''
+
+    if part is not None:
+        offset = device.get_part_offset_sectors(part)
+        data_sectors = device.get_part_size_sectors(part)
+    else:
+        offset = offset or 0
+        data_sectors = device.get_size_sectors() - offset
+
+    return Source(device, offset, data_sectors, loopdev=loopdev)
+
+
+def find_preloaded(src, part=None, offset=0, registry=None):
+    '''Return the preloaded copy of src that a recorded snapshot with the
+    same part and offset uses, or None.'''
+
+    src = get_host().realpath(src)
+    for record in (registry or get_registry()).records():
+        if record.origin is None or \
+                get_host().realpath(record.source) != src or \
+                (record.params.get('part'), record.params.get('offset')) \
+                != (part, offset):
+            continue
+
+        origin = zram.ZramDevice(record.origin)
+        if origin.exists():
+            return origin
+
+
+def used_spill_extents(path, registry=None):
+    '''Return the (offset, sectors) extents of the spill file or device
+    at path that the slices of recorded snapshots hold.'''
+
+    path = get_host().realpath(path)
+    extents = []
+    for record in (registry or get_registry()).records():
+        if record.spill_extent is not None and \
+                get_host().realpath(record.spill) == path:
+            extents.append(tuple(record.spill_extent))
+    return extents
+
+
+def preload_source(src, source, part=None, offset=0, zram_options=None,
+                   registry=None, on_preload=None):
+    '''Return a Source for a copy of source in RAM.
+
+    If another snapshot of the same region of src has been preloaded,
+    share its copy; otherwise make one (see preload.preload) and call
+    on_preload, if given, with the preload.CopyStats. Callers hold
+    preload.PRELOAD_LOCK until the snapshots using the copy have been
+    recorded.
+    '''
+
+    origin = find_preloaded(src, part=part, offset=offset,
+                            registry=registry)
+    if origin is not None:
+        LOG.info('sharing preloaded copy of %s on %s', src, origin.device)
+    else:
+        with timing.phase('preload'):
+            origin, stats = snappreload.preload(source,
+                                                zram_options=zram_options)
+        if on_preload is not None:
+            on_preload(stats)
+
+    return Source(origin, 0, source.data_sectors, preloaded=True)
+
+
+def default_backing_size(snap_size):
+    return int(min(snap_size * 0.25, MAX_BACKING_SIZE))
+
+
+def snapshot_sizes(source, snap_size=None, backing_size=None):
+    '''Check the requested sizes against source and fill in defaults.
+
+    Returns the size of the snapshot in sectors and the size of its
+    backing store in bytes.
+    '''
+
+    if snap_size is None:
+        snap_size = source.data_size
+    elif snap_size < source.data_size:
+        raise ValueError('requested size cannot be smaller than source')
+
+    if backing_size is None:
+        backing_size = default_backing_size(snap_size)
+
+    return snap_size // 512, backing_size
+
+
+def snapshot_template(src, source, base, snap_sectors, backing_size,
+                      engine='snapshot', **params):
+    '''Return the parts of a SnapshotRecord shared by snapshots created
+    together; see record_snapshots.'''
+
+    loopdev = str(source.loopdev.device) if source.loopdev else None
+    loops = []
+    for each in source.sources[1:]:
+        if each.loopdev and str(each.loopdev.device) not in \
+                [loopdev] + loops:
+            loops.append(str(each.loopdev.device))
+
+    return SnapshotRecord(
+        None, engine=engine, size=snap_sectors * 512, source=str(src),
+        source_device=str(source.device.device), loop=loopdev, loops=loops,
+        origin=str(source.device.device) if source.preloaded else None,
+        offset=source.offset, base=str(base.device),
+        backing_size=backing_size, params=params)
+
+
+def budgeted_options(zram_options, size):
+    '''Return zram_options for a zram device of size bytes: with a
+    memory budget, it is given a mem_limit of size unless it has
+    one.'''
+
+    options = dict(zram_options or {})
+    if snapbudget.get_max_ram() is not None and not options.get('mem_limit'):
+        options['mem_limit'] = size
+    return options
+
+
+def create_backing_devices(count, size, workers=None, zram_options=None,
+                           spill_devices=None):
+    '''Hot-add and size count zram devices in parallel.
+
+    zram_options are passed to ZramDevice.configure (comp_algorithm,
+    max_comp_streams, mem_limit). spill_devices, if given, holds the
+    backing_dev of each zram device.
+    '''
+
+    def _create(i):
+        with timing.phase('backing'):
+            backing = zram.ZramDevice.create()
+            try:
+                backing.configure(
+                    size,
+                    backing_dev=spill_devices[i] if spill_devices else None,
+                    **(zram_options or {}))
+            except Exception:
+                backing.remove()
+                raise
+        return backing
+
+    if count == 1:
+        return [_create(0)]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or count) as pool:
+        futures = [pool.submit(_create, i) for i in range(count)]
+
+    # If any of them failed, the others are of no use either.
+    failed = [future.exception() for future in futures
+              if future.exception() is not None]
+    backings = [future.result() for future in futures
+                if future.exception() is None]
+    if failed:
+        for backing in backings:
+            backing.remove()
+        raise failed[0]
+
+    return backings
+
+
+def reserve_names(count, name=None, prefix='bull', backend=None):
+    '''Reserve snapshot names by creating dm devices with no table.'''
+
+    def _reserve(i):
+        if name is None:
+            return mapper.MapperDevice.create_first_available(
+                prefix=prefix, backend=backend)
+        devname = name if count == 1 else '{}{}'.format(name, i)
+        return mapper.MapperDevice.create(devname, exclusive=True,
+                                          backend=backend)
+
+    snaps = []
+    try:
+        for i in range(count):
+            snaps.append(_reserve(i))
+    except Exception:
+        for snap in snaps:
+            snap.remove()
+            mapper.release_name(snap.name, backend=backend)
+        raise
+
+    return snaps
+
+
+def create_snapshots(src, count=1, part=None, offset=0, snap_size=None,
+                     backing_size=None, name=None, prefix='bull',
+                     backend=None, workers=None, engine='snapshot',
+                     zram_options=None, registry=None, inventory=None,
+                     direct_io=False, block_size=None, preload=False,
+                     on_preload=None, backing_file=None, backing_dev=None,
+                     persistent=False, spill_to=None, wait=0,
+                     stripe_size=None):
+    '''Create count snapshots of src that share one base device.
+
+    The source is mapped (onto a loop device, if necessary, using
+    direct_io and block_size) and given a linear base mapping once.
+    With preload, the base maps onto a copy of the source in RAM
+    instead (see preload_source). src may also be a list of sources,
+    whose base maps them one after the other or, with stripe_size,
+    striped across them (see open_sources).
+    With the snapshot engine, each snapshot then stacks a snapshot
+    target on that base with its own zram backing store. With the thin
+    engine, the base is the external origin of thin volumes in a
+    single zram-backed thin pool, whose data device holds backing_size
+    bytes per snapshot. zram_options are applied to the zram devices
+    holding written data. The snapshots are recorded in the registry.
+    An inventory.Inventory, if given, is used to check whether the
+    source is mounted. Returns a list of MapperDevice objects for the
+    snapshots.
+
+    With persistent, classic snapshots use a persistent exception store
+    (on zram), which can later be merged back into the source with
+    commit_snapshot. With backing_file or backing_dev, a single
+    snapshot keeps its
+    exceptions in a persistent store on that file or device instead of
+    in zram (see bull.store); a new file is backing_size bytes (by
+    default, the size of the snapshot), and can later be brought back
+    with attach_snapshot.
+
+    With spill_to (a file or block device), each zram backing store
+    gets a slice of it to write idle pages back to (see bull.spill).
+    A new file is backing_size bytes per snapshot.
+
+    If there is a memory budget (see bull.budget), zram devices get a
+    mem_limit unless zram_options give one, and the snapshots are only
+    created once their zram devices fit in it, waiting up to wait
+    seconds before raising OverBudget.
+    '''
+
+    if engine not in ENGINES:
+        raise ValueError('unknown engine: {}'.format(engine))
+
+    store_path = backing_file or backing_dev
+    if backing_file is not None and backing_dev is not None:
+        raise ValueError('give a backing file or a backing device, '
+                         'not both')
+    if store_path is not None and (engine != 'snapshot' or count != 1):
+        raise ValueError('a persistent store holds a single classic '
+                         'snapshot')
+    on_zram = engine == 'snapshot' and store_path is None
+    if spill_to is not None and not on_zram:
+        raise ValueError('only classic snapshots on zram can spill')
+    store_size = backing_size
+
+    srcs = [src] if isinstance(src, (str, Path)) else list(src)
+    if not srcs:
+        raise ValueError('no source given')
+    several = len(srcs) > 1
+    if several and (preload or store_path is not None):
+        raise ValueError('a snapshot of several sources cannot be '
+                         'preloaded or kept in a store')
+    src = srcs[0]
+
+    # Snapshots of a source share one preloaded copy of it, which is
+    # found through the registry; hold the lock until it is recorded.
+    with lock_file(snappreload.PRELOAD_LOCK if preload else None):
+        with timing.phase('source'):
+            if several:
+                source = open_sources(srcs, part=part, offset=offset,
+                                      stripe_size=stripe_size,
+                                      inventory=inventory,
+                                      direct_io=direct_io,
+                                      block_size=block_size)
+            else:
+                source = open_source(src, part=part, offset=offset,
+                                     inventory=inventory,
+                                     direct_io=direct_io,
+                                     block_size=block_size, preload=preload)
+        # Anything built before a failure is torn down again.
+        snaps = []
+        base = store = spill = None
+        try:
+            snap_sectors, backing_size = snapshot_sizes(source, snap_size,
+                                                        backing_size)
+
+            # Under a memory budget (see bull.budget), wait until the zram
+            # devices fit, and hold the lock until they are recorded.
+            device_size = backing_size * count if engine == 'thin' \
+                else backing_size
+            backing_options = budgeted_options(zram_options, device_size)
+            cost = 0
+            if store_path is None:
+                cost = (1 if engine == 'thin' else count) * \
+                    (backing_options.get('mem_limit') or device_size)
+            if preload and find_preloaded(src, part=part, offset=offset,
+                                          registry=registry) is None:
+                cost += source.data_size
+
+            # Slices of a shared spill device are placed where no
+            # recorded one is; hold the lock until they are recorded.
+            spill_lock = snapspill.SPILL_LOCK if spill_to is not None \
+                else None
+            with snapbudget.admit(cost, wait=wait, registry=registry), \
+                    lock_file(spill_lock):
+                if preload:
+                    source = preload_source(src, source, part=part,
+                                            offset=offset,
+                                            zram_options=zram_options,
+                                            registry=registry,
+                                            on_preload=on_preload)
+
+                if store_path is not None:
+                    store = snapstore.create_store(
+                        store_path, size=store_size or snap_sectors * 512)
+
+                slices = spill_devices = None
+                if spill_to is not None:
+                    spill = snapspill.open_spill(spill_to,
+                                                 size=backing_size * count)
+
+                LOG.debug('part %s offset %s data_sectors %s data_size %s',
+                          part, source.offset, source.data_sectors,
+                          source.data_size)
+                LOG.debug('snap_sectors %s backing_size %s count %s',
+                          snap_sectors, backing_size, count)
+
+                # We reserve device names by creating dm devices with no
+                # table.
+                with timing.phase('names'):
+                    snaps = reserve_names(count, name=name, prefix=prefix,
+                                          backend=backend)
+
+                # Now that we have reserved a device name, we can create
+                # the base device. It is named after the first snapshot,
+                # and shared by all of them.
+                with timing.phase('base'):
+                    base = create_base(source, snap_sectors,
+                                       '{}-base'.format(snaps[0].name),
+                                       backend=backend)
+
+                with timing.phase(engine):
+                    if engine == 'thin':
+                        pool = create_thin_volumes(
+                            snaps, base, snap_sectors, backing_size,
+                            backend=backend, zram_options=backing_options)
+                        data_dev = pool.device.table[0].target.data_dev
+                        zram_devices = [[data_dev]] * count
+                    elif store is not None:
+                        header = snapstore.StoreHeader(
+                            snaps[0].name, str(src), part=part, offset=offset,
+                            data_sectors=source.data_sectors,
+                            size=snap_sectors * 512)
+                        store.write_header(header)
+                        stack_persistent(snaps[0], base, snap_sectors, store,
+                                         chunksize=header.chunksize)
+                        backing_size = store.cow_sectors * 512
+                        zram_devices = [[]]
+                    else:
+                        if spill is not None:
+                            slices = spill.create_slices(
+                                [snap.name for snap in snaps], backing_size,
+                                used=used_spill_extents(spill_to,
+                                                        registry=registry),
+                                backend=backend)
+                            spill_devices = [spilldev.device
+                                             for spilldev in slices]
+                        backings = stack_snapshots(
+                            snaps, base, snap_sectors, backing_size,
+                            workers=workers, zram_options=backing_options,
+                            persistent=persistent,
+                            spill_devices=spill_devices)
+                        zram_devices = [[backing.device]
+                                        for backing in backings]
+
+                with timing.phase('registry'):
+                    template = snapshot_template(
+                        src, source, base, snap_sectors, backing_size,
+                        engine=engine, part=part, offset=offset,
+                        snap_size=snap_size, zram_options=zram_options or {},
+                        direct_io=direct_io, block_size=block_size,
+                        preload=preload, persistent=persistent)
+                    if several:
+                        template.params.update(
+                            sources=[str(each) for each in srcs],
+                            stripe_size=stripe_size)
+                    if store is not None:
+                        template = store_record(template, store)
+                    if spill is not None:
+                        template = spill_record(template, spill)
+                    record_snapshots(snaps, template, zram_devices,
+                                     registry=registry,
+                                     spill_slices=slices)
+
+                return snaps
+        except Exception:
+            discard_snapshots(snaps, source, base=base, store=store,
+                              spill=spill, backend=backend)
+            raise
+
+
+def record_snapshots(snaps, template, zram_devices, registry=None,
+                     spill_slices=None):
+    '''Record snaps in the registry as copies of the template record.
+
+    zram_devices holds the list of zram devices behind each snapshot,
+    and spill_slices (if given) the spill slice (a MapperDevice) of
+    each.
+    '''
+
+    records = []
+    for i, (snap, devices) in enumerate(zip(snaps, zram_devices)):
+        target = snap.table[0].target
+        if isinstance(target, mapper.Thin):
+            backing, dev_id = target.pool_dev, target.dev_id
+        else:
+            backing, dev_id = target.backing, None
+
+        spill_dev = spill_extent = None
+        if spill_slices:
+            spill_dev = str(spill_slices[i].device)
+            segment = spill_slices[i].table[0]
+            spill_extent = [segment.target.offset, segment.sectors]
+
+        records.append(attr.evolve(
+            template, name=snap.name, backing=str(backing), dev_id=dev_id,
+            zram=[str(device) for device in devices], spill_dev=spill_dev,
+            spill_extent=spill_extent, created=time.time()))
+
+    (registry or get_registry()).add(*records)
+
+
+def discard_snapshots(snaps, source=None, base=None, store=None,
+                      spill=None, backend=None):
+    '''Tear down what a failed create_snapshots got as far as building.
+
+    snaps are the reserved snapshot devices, loaded or not; their COW,
+    spill and thin pool devices are found by name. base is removed if
+    nothing uses it, with the loop device or preloaded copy under it;
+    without a base, the loop devices of source (if given) are released
+    instead.
+    store and spill lose their loop devices. Errors are logged rather
+    than raised, so that the caller can raise the one that made it
+    give up.
+    '''
+
+    backend = backend or mapper.get_backend()
+
+    def _discard(what, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            LOG.warning('failed to remove %s: %s', what, e)
+
+    def _remove_named(name):
+        if backend.exists(name):
+            backend.remove(name)
+
+    def _remove_cow(name):
+        if backend.exists(name):
+            cow.remove('/dev/mapper/{}'.format(name), backend=backend)
+
+    def _remove_pool(name):
+        pool = thin.ThinPool('/dev/mapper/{}'.format(name), backend=backend)
+        if backend.exists(name) and not pool.holders():
+            pool.remove()
+
+    for snap in snaps:
+        if backend.exists(snap.name):
+            _discard(snap.name, remove_unrecorded, snap.name, backend)
+        _discard('{}-cow'.format(snap.name), _remove_cow,
+                 '{}-cow'.format(snap.name))
+        _discard('{}{}'.format(snap.name, snapspill.SPILL_SUFFIX),
+                 _remove_named,
+                 '{}{}'.format(snap.name, snapspill.SPILL_SUFFIX))
+        _discard(snap.name, mapper.release_name, snap.name, backend)
+    if snaps:
+        _discard('{}-pool'.format(snaps[0].name), _remove_pool,
+                 '{}-pool'.format(snaps[0].name))
+
+    if base is not None:
+        if backend.exists(base.name):
+            _discard(base.name, release_base, base.device, backend)
+    elif source is not None:
+        for each in source.sources:
+            if each.preloaded and not each.device.holders():
+                _discard(each.device.device, each.device.remove)
+            elif each.loopdev is not None:
+                loopdev = loop.LoopDevice(each.loopdev.device)
+                _discard(loopdev.device, loopdev.release)
+
+    for opened in (store, spill):
+        if opened is not None and opened.loopdev is not None:
+            _discard(opened.loopdev.device, opened.loopdev.release)
+
+
+def create_base(source, snap_sectors, name, backend=None):
+    '''Create the base device for snapshots of source.
+
+    This is a simple linear mapping onto the source, possibly with an
+    offset applied if either offset or part were given, padded with
+    zeros up to snap_sectors. A SourceSet is mapped as a linear segment
+    per source, or a single striped one.
+    '''
+
+    base = mapper.MapperDevice.create(name, backend=backend)
+    base.table = base_table(source, snap_sectors)
+    base.load()
+    return base
+
+
+def base_table(source, snap_sectors):
+    table = mapper.Table(source.segments())
+
+    if snap_sectors > source.data_sectors:
+        table.append(
+            mapper.Segment(source.data_sectors,
+                           (snap_sectors - source.data_sectors),
+                           mapper.Zero()))
+
+    return table
+
+
+def stack_snapshots(snaps, base, snap_sectors, backing_size, workers=None,
+                    zram_options=None, persistent=False, spill_devices=None):
+    '''Load a snapshot of base, with a new zram backing store, into each
+    of the (reserved, empty) devices in snaps.
+
+    Each backing store is wrapped in a growable COW device (see
+    bull.cow) named after its snapshot, and holds a persistent
+    exception store if persistent is true. spill_devices are passed to
+    create_backing_devices. Returns the zram devices, in the same
+    order as snaps.
+    '''
+
+    # Create ramdisks for use as the snapshot backing stores.
+    backings = create_backing_devices(len(snaps), backing_size,
+                                      workers=workers,
+                                      zram_options=zram_options,
+                                      spill_devices=spill_devices)
+
+    # And finally create the snapshots themselves.
+    try:
+        for snap, backing in zip(snaps, backings):
+            cowdev = cow.create_cow('{}-cow'.format(snap.name), backing,
+                                    size=backing_size, backend=snap.backend)
+            snap.table.append(
+                mapper.Segment(0, snap_sectors,
+                               mapper.Snapshot(base.device, cowdev.device,
+                                               persistent=persistent)))
+            snap.load()
+    except Exception:
+        # Those in a COW device go with it (see discard_snapshots).
+        for backing in backings:
+            if not backing.holders():
+                backing.remove()
+        raise
+
+    return backings
+
+
+def stack_persistent(snap, base, snap_sectors, store, chunksize=16):
+    '''Load a snapshot of base into the (reserved, empty) device snap,
+    keeping its exceptions in store (a store.Store).
+
+    The COW device maps the store after its header. The snapshot is
+    persistent, so the kernel reads back any exceptions already in
+    the store.
+    '''
+
+    cowdev = cow.create_cow('{}-cow'.format(snap.name), store.device,
+                            size=store.cow_sectors * 512,
+                            backend=snap.backend,
+                            offset=snapstore.HEADER_SECTORS)
+    snap.table.append(
+        mapper.Segment(0, snap_sectors,
+                       mapper.Snapshot(base.device, cowdev.device,
+                                       persistent=True,
+                                       chunksize=chunksize)))
+    snap.load()
+
+
+def store_record(template, store):
+    '''Add a persistent store to a template record.'''
+
+    return attr.evolve(
+        template, store=store.path,
+        store_loop=str(store.loopdev.device) if store.loopdev else None)
+
+
+def spill_record(template, spill):
+    '''Add a spill device to a template record.'''
+
+    return attr.evolve(
+        template, spill=spill.path,
+        spill_loop=str(spill.loopdev.device) if spill.loopdev else None)
+
+
+def attach_snapshot(path, name=None, backend=None, registry=None,
+                    inventory=None):
+    '''Rebuild a snapshot from the persistent store at path, for example
+    after a reboot.
+
+    The header of the store says which source the snapshot was made
+    of and how; the source is opened again, a base device and COW
+    device are created, and the snapshot is loaded on top of them.
+    The snapshot is called name, or the name it had when it was
+    created. Returns the MapperDevice of the snapshot.
+    '''
+
+    store = snapstore.open_store(path)
+    try:
+        header = store.read_header()
+        if header is None:
+            raise UnsupportedDevice('{} does not hold a bull '
+                                    'snapshot'.format(path))
+
+        with timing.phase('source'):
+            source = open_source(header.source, part=header.part,
+                                 offset=header.offset, inventory=inventory)
+        if source.data_sectors != header.data_sectors:
+            raise UnsupportedDevice(
+                '{} has changed size since {} was created'.format(
+                    header.source, path))
+    except Exception:
+        store.close()
+        raise
+
+    snap_sectors = header.size // 512
+    with timing.phase('names'):
+        snap, = reserve_names(1, name=name or header.name, backend=backend)
+    with timing.phase('base'):
+        base = create_base(source, snap_sectors,
+                           '{}-base'.format(snap.name), backend=backend)
+    with timing.phase('snapshot'):
+        stack_persistent(snap, base, snap_sectors, store,
+                         chunksize=header.chunksize)
+
+    with timing.phase('registry'):
+        template = snapshot_template(
+            header.source, source, base, snap_sectors,
+            store.cow_sectors * 512, part=header.part,
+            offset=header.offset, snap_size=header.size)
+        record_snapshots([snap], store_record(template, store), [[]],
+                         registry=registry)
+
+    LOG.info('attached %s from %s', snap.name, path)
+    return snap
+
+
+def create_thin_volumes(snaps, base, snap_sectors, backing_size,
+                        backend=None, zram_options=None):
+    '''Back each of snaps with a thin volume whose external origin is base.
+
+    Returns the ThinPool.
+    '''
+
+    pool = thin.ThinPool.create('{}-pool'.format(snaps[0].name),
+                                backing_size * len(snaps), backend=backend,
+                                zram_options=zram_options)
+
+    for snap in snaps:
+        dev_id = pool.create_thin()
+        snap.table.append(
+            mapper.Segment(0, snap_sectors,
+                           mapper.Thin(pool.device.device, dev_id,
+                                       base.device)))
+        snap.load()
+
+    pool.device.table.resolve()
+    return pool
+
+
+def clone_snapshot(name, new_name=None, prefix='bull', backend=None,
+                   registry=None):
+    '''Create a snapshot of an existing thin volume.
+
+    The new volume shares all of its blocks with the original, so
+    this costs the same no matter how much has been written to it.
+    '''
+
+    backend = backend or mapper.get_backend()
+    if not backend.exists(name):
+        raise NoSuchDevice(name)
+
+    snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                               backend=backend)
+    snap.table.resolve()
+    segment = snap.table[0]
+
+    if not isinstance(segment.target, mapper.Thin):
+        raise UnsupportedDevice('{} is not a thin volume'.format(name))
+
+    pool = thin.ThinPool(segment.target.pool_dev, backend=backend)
+    clone = reserve_names(1, name=new_name, prefix=prefix,
+                          backend=backend)[0]
+
+    snap.suspend()
+    try:
+        dev_id = pool.create_snap(segment.target.dev_id)
+    finally:
+        snap.resume()
+
+    clone.table.append(
+        mapper.Segment(0, segment.sectors,
+                       mapper.Thin(segment.target.pool_dev, dev_id,
+                                   segment.target.origin)))
+    clone.load()
+
+    registry = registry or get_registry()
+    record = registry.get(name)
+    if record is not None:
+        registry.add(attr.evolve(record, name=clone.name, dev_id=dev_id,
+                                 created=time.time()))
+
+    return clone
+
+
+def recycle_snapshot(name, backend=None, registry=None):
+    '''Throw away everything written to a snapshot.
+
+    The snapshot is briefly pointed at a zero target so that its zram
+    backing store can be reset, and then the original snapshot table
+    is loaded again. The device name, base device and zram device are
+    all kept; zram devices added by growing the COW device are
+    removed.
+    '''
+
+    backend = backend or mapper.get_backend()
+    snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                               backend=backend)
+    if snap.is_mounted():
+        raise DeviceBusy('{} is mounted'.format(name))
+
+    table = snap.table
+    table.resolve()
+    target = table[0].target
+
+    if not isinstance(target, mapper.Snapshot):
+        raise UnsupportedDevice('{} is not a snapshot'.format(name))
+
+    snap.table = mapper.Table([mapper.Segment(0, table[0].sectors,
+                                              mapper.Zero())])
+    snap.load()
+
+    cow.reset(target.backing, backend=backend)
+
+    snap.table = table
+    snap.load()
+
+    registry = registry or get_registry()
+    record = registry.get(name)
+    if record is not None and len(record.zram) > 1:
+        registry.update(name, zram=record.zram[:1])
+
+    return snap
+
+
+def backing_device(snap):
+    '''Return the device holding data written to snap.
+
+    For thin volumes this is the data device of the pool, which is
+    shared with every other volume in that pool.
+    '''
+
+    target = snap.table[0].target
+    if isinstance(target, mapper.Thin):
+        pool = mapper.MapperDevice(target.pool_dev, backend=snap.backend)
+        pool.table.resolve()
+        return pool.table[0].target.data_dev
+
+    return target.backing
+
+
+def backing_stats(name, backend=None):
+    '''Return the backing device of a snapshot and the combined MMStat
+    of the zram devices behind it.'''
+
+    snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                               backend=backend)
+    snap.table.resolve()
+    backing = backing_device(snap)
+    return backing, zram.sum_mm_stats(
+        backing.mm_stat()
+        for backing in cow.zram_devices(backing, backend=snap.backend))
+
+
+def create_snapshot(src, **kwargs):
+    '''Create a single snapshot of src. See create_snapshots.'''
+
+    return create_snapshots(src, count=1, **kwargs)[0]
+
+
+def select_partitions(table, parts):
+    '''Return the partitions of a blockdev.PartitionTable named by parts:
+    'all', or a list of partition numbers.'''
+
+    if parts != 'all':
+        return [table.get(number) for number in parts]
+
+    if not table.partitions:
+        raise NoPartitionMap('no partitions found')
+    return list(table.partitions)
+
+
+def create_partition_snapshots(src, parts='all', backing_size=None,
+                               name=None, prefix='bull', backend=None,
+                               workers=None, zram_options=None,
+                               registry=None, inventory=None,
+                               direct_io=False, block_size=None,
+                               persistent=False, wait=0):
+    '''Snapshot several partitions of src in one go.
+
+    src is opened (and put on a loop device) once and its partition
+    table read once. Each partition named by parts (see
+    select_partitions) gets a classic snapshot with its own base device
+    and a zram backing store sized for the partition (or of
+    backing_size bytes, if given). With name, the snapshots are called
+    <name>p<N> after their partitions. The tables of each layer (base,
+    COW and snapshot devices) are loaded together (see
+    mapper.load_all). Returns the MapperDevices of the snapshots, in
+    the order of the partitions.
+    '''
+
+    with timing.phase('source'):
+        disk = open_source(src, inventory=inventory, direct_io=direct_io,
+                           block_size=block_size)
+        partitions = select_partitions(disk.device.get_part_table(), parts)
+
+    sources = [Source(disk.device, part.start, part.size,
+                      loopdev=disk.loopdev) for part in partitions]
+    sizes = [snapshot_sizes(source, backing_size=backing_size)
+             for source in sources]
+    options = [budgeted_options(zram_options, size) for _, size in sizes]
+    cost = sum(opts.get('mem_limit') or size
+               for opts, (_, size) in zip(options, sizes))
+
+    with snapbudget.admit(cost, wait=wait, registry=registry):
+        with timing.phase('names'):
+            if name is None:
+                snaps = reserve_names(len(partitions), prefix=prefix,
+                                      backend=backend)
+            else:
+                snaps = [mapper.MapperDevice.create(
+                    '{}p{}'.format(name, part.number), exclusive=True,
+                    backend=backend) for part in partitions]
+
+        with timing.phase('base'):
+            bases = []
+            for snap, source, (snap_sectors, _) in zip(snaps, sources,
+                                                       sizes):
+                base = mapper.MapperDevice.create(
+                    '{}-base'.format(snap.name), backend=backend)
+                base.table = base_table(source, snap_sectors)
+                bases.append(base)
+            mapper.load_all(bases)
+
+        def _backing(i):
+            return create_backing_devices(1, sizes[i][1],
+                                          zram_options=options[i])[0]
+
+        with timing.phase('snapshot'):
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers or len(snaps)) as pool:
+                backings = list(pool.map(_backing, range(len(snaps))))
+
+            cows = [cow.create_cow('{}-cow'.format(snap.name), backing,
+                                   backend=backend, load=False)
+                    for snap, backing in zip(snaps, backings)]
+            mapper.load_all(cows)
+
+            for snap, base, cowdev, (snap_sectors, _) in zip(
+                    snaps, bases, cows, sizes):
+                snap.table.append(
+                    mapper.Segment(0, snap_sectors,
+                                   mapper.Snapshot(base.device, cowdev.device,
+                                                   persistent=persistent)))
+            mapper.load_all(snaps)
+
+        with timing.phase('registry'):
+            for i, part in enumerate(partitions):
+                template = snapshot_template(
+                    src, sources[i], bases[i], sizes[i][0], sizes[i][1],
+                    part=part.number, offset=0, snap_size=None,
+                    zram_options=zram_options or {}, direct_io=direct_io,
+                    block_size=block_size, persistent=persistent)
+                record_snapshots([snaps[i]], template,
+                                 [[backings[i].device]], registry=registry)
+
+    return snaps
+
+
+def create_disk_snapshot(src, parts='all', backing_size=None,
+                         block_size=None, backend=None, registry=None,
+                         **kwargs):
+    '''Snapshot the whole of src, and map each of the partitions named
+    by parts (see select_partitions) onto the snapshot as a linear
+    device called <snapshot>p<N>, as kpartx would.
+
+    Unless backing_size is given, the zram backing store is as big as
+    the backing stores of snapshots of each of those partitions would
+    be together. Other arguments are passed to create_snapshots.
+    Returns the MapperDevices of the snapshot and of its partitions.
+    '''
+
+    with timing.phase('source'):
+        device = blockdev.BlockDevice(src)
+        if device.geometry.is_block_device:
+            table = device.get_part_table()
+        else:
+            table = blockdev.get_part_table(src, sector_size=block_size)
+        partitions = select_partitions(table, parts)
+
+    if backing_size is None:
+        backing_size = sum(default_backing_size(part.size * 512)
+                           for part in partitions)
+
+    snap, = create_snapshots(src, count=1, backing_size=backing_size,
+                             block_size=block_size, backend=backend,
+                             registry=registry, **kwargs)
+
+    with timing.phase('views'):
+        views = create_views(snap, partitions, backend=backend)
+    (registry or get_registry()).update(
+        snap.name, views=[str(view.device) for view in views])
+
+    return snap, views
+
+
+def create_views(snap, partitions, backend=None):
+    '''Map each of partitions (blockdev.Partitions) of the disk snapshot
+    snap as a linear device. Returns the MapperDevices.'''
+
+    views = []
+    for part in partitions:
+        view = mapper.MapperDevice.create(
+            '{}p{}'.format(snap.name, part.number), exclusive=True,
+            backend=backend)
+        view.table.append(mapper.Segment(
+            0, part.size, mapper.Linear(snap.device, part.start)))
+        views.append(view)
+
+    mapper.load_all(views)
+    return views
+
+
+def remove_views(name, backend=None, inventory=None, views=None):
+    '''Unmount and remove the partition views (see create_views) of a
+    snapshot: those named in views, or if views is None, any linear
+    device called <name>p<N> that maps onto the snapshot.'''
+
+    backend = backend or mapper.get_backend()
+    if views is None:
+        pattern = re.compile(r'{}p\d+$'.format(re.escape(name)))
+        views = []
+        for view_name in backend.list_devices('linear'):
+            if not pattern.match(view_name):
+                continue
+            view = mapper.MapperDevice('/dev/mapper/{}'.format(view_name),
+                                       backend=backend)
+            view.table.resolve()
+            if [str(segment.target.device) for segment in view.table] == \
+                    ['/dev/mapper/{}'.format(name)]:
+                views.append(view.device)
+
+    for view in views:
+        if blockdev.BlockDevice(view).is_mounted(inventory):
+            LOG.info('unmounting %s', view)
+            run_command('umount', view)
+        backend.remove(Path(view).name)
+
+
+def snapshot_names(prefix=None, backend=None, registry=None):
+    '''Return the names of bull snapshots.
+
+    They are read from the registry if there is one, and from the
+    kernel otherwise.
+    '''
+
+    registry = registry or get_registry()
+    if registry.exists():
+        return [record.name for record in registry.records(prefix=prefix)]
+
+    return mapper.list_devices(prefix=prefix, backend=backend)
+
+
+def remove_snapshot(name, backend=None, registry=None, inventory=None):
+    '''Remove a bull snapshot.
+
+    The base device and loop device are shared between all snapshots
+    created together, so they are only removed once nothing else is
+    using them. If the snapshot is in the registry, its record says
+    which devices to remove and the other records which of them are
+    still in use; otherwise the stack is worked out from the kernel.
+    inventory (an inventory.Inventory) is used to see whether the
+    snapshot is mounted, if given.
+    '''
+
+    backend = backend or mapper.get_backend()
+    registry = registry or get_registry()
+
+    if not backend.exists(name):
+        release_record(name, backend=backend, registry=registry)
+        raise NoSuchDevice(name)
+
+    record = registry.get(name)
+    if record is None:
+        with timing.phase('remove'):
+            remove_unrecorded(name, backend=backend, inventory=inventory)
+    else:
+        # Only the decision about shared devices needs the registry
+        # lock; the snapshot's own devices can go without it.
+        with timing.phase('remove'):
+            remove_recorded(record, backend=backend, inventory=inventory)
+        release_record(name, backend=backend, registry=registry)
+
+    mapper.release_name(name, backend=backend)
+
+
+def remove_recorded(record, backend=None, inventory=None):
+    '''Remove the devices that belong to a recorded snapshot alone.'''
+
+    if record.views:
+        remove_views(record.name, backend=backend, inventory=inventory,
+                     views=record.views)
+
+    snap = blockdev.BlockDevice('/dev/mapper/{}'.format(record.name))
+    if snap.is_mounted(inventory):
+        LOG.info('unmounting %s', record.name)
+        run_command('umount', snap.device)
+
+    backend.remove(record.name)
+    remove_backing(record, backend=backend)
+
+
+def remove_backing(record, backend=None):
+    '''Remove what a removed snapshot kept its writes in: its thin
+    volume, or its COW device, zram devices, spill slice and store
+    loop device.'''
+
+    backend = backend or mapper.get_backend()
+
+    if record.engine == 'thin':
+        thin.ThinPool(record.backing, backend=backend).delete(record.dev_id)
+    else:
+        if cow.is_cow_device(record.backing):
+            backend.remove(Path(record.backing).name)
+        for device in record.zram:
+            zram.ZramDevice(device).remove()
+        if record.spill_dev is not None:
+            backend.remove(Path(record.spill_dev).name)
+        if record.store_loop is not None:
+            loop.LoopDevice(record.store_loop).remove()
+
+
+def release_record(name, backend=None, registry=None):
+    '''Drop the record of a removed snapshot, and remove the shared
+    devices it used that no other record uses (see release_shared).'''
+
+    backend = backend or mapper.get_backend()
+    registry = registry or get_registry()
+    with timing.phase('release'), registry.transaction() as records:
+        record = records.pop(name, None)
+        if record is not None:
+            release_shared(record, records.values(), backend=backend)
+
+
+def unused_shared(record, others):
+    '''Return the shared devices of a removed snapshot that none of the
+    other records use, as a dictionary with any of the keys 'pool',
+    'base', 'loop', 'loops', 'origin' and 'spill_loop'.'''
+
+    def in_use(field, value):
+        return any(getattr(other, field) == value for other in others)
+
+    def loop_in_use(value):
+        return any(other.loop == value or value in other.loops
+                   for other in others)
+
+    unused = {}
+    if record.engine == 'thin' and not in_use('backing', record.backing):
+        unused['pool'] = record.backing
+    if record.spill_loop is not None and \
+            not in_use('spill_loop', record.spill_loop):
+        unused['spill_loop'] = record.spill_loop
+    if record.base is not None and not in_use('base', record.base):
+        unused['base'] = record.base
+        if record.loop is not None and not loop_in_use(record.loop):
+            unused['loop'] = record.loop
+        loops = [each for each in record.loops if not loop_in_use(each)]
+        if loops:
+            unused['loops'] = loops
+        if record.origin is not None and \
+                not in_use('origin', record.origin):
+            unused['origin'] = record.origin
+
+    return unused
+
+
+def release_shared(record, others, backend=None):
+    '''Remove the thin pool, spill loop, base, loop and preloaded origin
+    devices of a removed snapshot that none of the other records use.'''
+
+    unused = unused_shared(record, others)
+
+    if 'pool' in unused:
+        thin.ThinPool(unused['pool'], backend=backend).remove()
+
+    if 'spill_loop' in unused:
+        loop.LoopDevice(unused['spill_loop']).remove()
+
+    if 'base' not in unused:
+        return
+
+    try:
+        backend.remove(Path(unused['base']).name)
+    except DeviceMapperError as e:
+        LOG.warning('not removing base device %s: %s', unused['base'], e)
+        return
+
+    if 'loop' in unused:
+        loop.LoopDevice(unused['loop']).release()
+
+    for each in unused.get('loops', []):
+        loop.LoopDevice(each).release()
+
+    if 'origin' in unused:
+        zram.ZramDevice(unused['origin']).remove()
+
+
+def remove_unrecorded(name, backend=None, inventory=None):
+    '''Remove a snapshot that is not in the registry, working out the
+    devices behind it from the kernel.'''
+
+    snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                               backend=backend)
+    snap.table.resolve()
+
+    # A reserved name that never got a table has nothing behind it.
+    if not snap.table:
+        LOG.debug('%s has no table', name)
+        snap.remove()
+        return
+
+    if snap.holders():
+        remove_views(name, backend=backend, inventory=inventory)
+
+    if snap.is_mounted(inventory):
+        LOG.info('unmounting %s', name)
+        run_command('umount', snap.device)
+
+    target = snap.table[0].target
+    snap.remove()
+
+    if isinstance(target, mapper.Thin):
+        LOG.debug('got thin pool %s id %s', target.pool_dev, target.dev_id)
+        pool = thin.ThinPool(target.pool_dev, backend=backend)
+        pool.delete(target.dev_id)
+
+        if pool.holders():
+            LOG.debug('thin pool %s still in use', pool.name)
+        else:
+            pool.remove()
+    else:
+        LOG.debug('got backing device %s', target.backing)
+        cow.remove(target.backing, backend=backend)
+
+    if target.origin is not None:
+        release_base(target.origin, backend=backend)
+
+
+def release_base(device, backend=None):
+    '''Remove a base device and its loop device (or preloaded copy) if
+    nothing is using them.'''
+
+    base = mapper.MapperDevice(device, backend=backend)
+    if base.holders():
+        LOG.debug('base device %s still in use', base.name)
+        return
+
+    base.table.resolve()
+    srcdevs = []
+    for segment in base.table:
+        target = segment.target
+        if isinstance(target, mapper.Striped):
+            srcdevs.extend(target.devices)
+        elif isinstance(target, mapper.Linear):
+            srcdevs.append(target.device)
+    LOG.debug('got source devices %s', srcdevs)
+
+    try:
+        base.remove()
+    except DeviceMapperError as e:
+        LOG.debug('base device %s still in use: %s', base.name, e)
+        return
+
+    for srcdev in sorted(set(srcdevs)):
+        if str(srcdev).startswith('/dev/zram'):
+            origin = zram.ZramDevice(srcdev)
+            if origin.exists() and not origin.holders():
+                origin.remove()
+            continue
+
+        loop.LoopDevice(srcdev).release()
+
+
+def merge_source(snap):
+    '''Check that the changes in snap (a MapperDevice) can be merged back
+    into its source, and return the source device.
+
+    The snapshot needs a persistent exception store, must be the only
+    user of its base device, and must be no bigger than a writable
+    source, as the merge writes to the source through the base.
+    '''
+
+    target = snap.table[0].target
+    if not isinstance(target, mapper.Snapshot):
+        raise UnsupportedDevice('{} is not a classic snapshot'.format(
+            snap.name))
+    if target.persistent != 'P':
+        raise UnsupportedDevice(
+            '{} has a transient exception store, which cannot be merged; '
+            'create it with --persistent'.format(snap.name))
+
+    base = mapper.MapperDevice(mapper.resolve_device(target.origin),
+                               backend=snap.backend)
+    if len(base.holders()) > 1:
+        raise DeviceBusy('{} shares {} with other snapshots'.format(
+            snap.name, base.name))
+
+    base.table.resolve()
+    if any(isinstance(segment.target, mapper.Zero)
+           for segment in base.table):
+        raise UnsupportedDevice('{} is bigger than its source'.format(
+            snap.name))
+    if len(base.table) != 1 or \
+            not isinstance(base.table[0].target, mapper.Linear):
+        raise UnsupportedDevice('{} is built on several sources'.format(
+            snap.name))
+
+    source = blockdev.BlockDevice(base.table[0].target.device)
+    if cow.is_zram_device(source.device):
+        raise UnsupportedDevice('{} is a snapshot of a preloaded copy of '
+                                'its source'.format(snap.name))
+    try:
+        readonly = get_host().read(source.sysfs / 'ro').strip() == '1'
+    except FileNotFoundError:
+        readonly = False
+    if readonly:
+        raise UnsupportedDevice('{} is read-only'.format(source.device))
+
+    return source
+
+
+def merge_progress(status):
+    '''Return the sectors of a merging snapshot's exception store still
+    to be merged, from its status line.'''
+
+    start, length, target_type, *args = status.split()
+    if not args or '/' not in args[0]:
+        raise DeviceMapperError('merge failed: {}'.format(
+            ' '.join(args) or 'no status'))
+
+    allocated = int(args[0].split('/')[0])
+    metadata = int(args[1]) if len(args) > 1 else 0
+    return allocated - metadata
+
+
+def commit_snapshot(name, backend=None, registry=None, inventory=None,
+                    on_progress=None, interval=MERGE_INTERVAL):
+    '''Write the changes made in a snapshot back to its source, and then
+    remove the snapshot.
+
+    The snapshot's table is swapped for a snapshot-merge target, so
+    the kernel copies only the chunks that were written back into the
+    source (see merge_source for what can be merged). Until that has
+    finished, its status is polled every interval seconds and, if
+    given, on_progress is called with the sectors merged so far and
+    the number to merge in all.
+    '''
+
+    backend = backend or mapper.get_backend()
+    if not backend.exists(name):
+        raise NoSuchDevice(name)
+
+    snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                               backend=backend)
+    source = merge_source(snap)
+    LOG.info('merging %s into %s', name, source.device)
+
+    if snap.is_mounted(inventory):
+        LOG.info('unmounting %s', name)
+        run_command('umount', snap.device)
+
+    target = snap.table[0].target
+    with timing.phase('merge'):
+        snap.table = mapper.Table([
+            mapper.Segment(0, snap.table[0].sectors, mapper.SnapshotMerge(
+                target.origin, target.backing, target.persistent,
+                target.chunksize))])
+        snap.load()
+
+        total = None
+        while True:
+            remaining = merge_progress(
+                backend.status(name).splitlines()[0])
+            if total is None:
+                total = remaining
+            if on_progress is not None:
+                on_progress(total - remaining, total)
+            if remaining <= 0:
+                break
+            time.sleep(interval)
+
+    LOG.info('merged %d sectors of %s', total, name)
+    remove_snapshot(name, backend=backend, registry=registry,
+                    inventory=inventory)
+
+
+@attr.s
+class ResizeResult():
+    '''The outcome of resize_snapshot. Sizes are in bytes; stalls holds
+    how long I/O to each reloaded device was suspended, in seconds.'''
+
+    name = attr.ib()
+    old_size = attr.ib()
+    new_size = attr.ib()
+    stalls = attr.ib(default=attr.Factory(dict))
+
+    @property
+    def stall(self):
+        return sum(self.stalls.values())
+
+
+def extend_table(table, sectors):
+    '''Pad a base table with zeros up to sectors.'''
+
+    last = table[-1]
+    end = last.start + last.sectors
+    if isinstance(last.target, mapper.Zero):
+        last.sectors += sectors - end
+    else:
+        table.append(mapper.Segment(end, sectors - end, mapper.Zero()))
+
+
+def resize_snapshot(name, snap_size, backend=None, registry=None):
+    '''Grow a live snapshot to snap_size bytes. Returns a ResizeResult.
+
+    The base device of a classic snapshot is padded with zeros up to
+    the new size first (snapshots sharing it keep their size), and then
+    the snapshot's table is reloaded with the new length. A thin volume
+    may be bigger than its external origin, so only its own table is
+    reloaded. Each new table is loaded into the inactive slot before
+    the device is suspended (see MapperDevice.load), so I/O only stalls
+    while the kernel swaps tables.
+    '''
+
+    backend = backend or mapper.get_backend()
+    if not backend.exists(name):
+        raise NoSuchDevice(name)
+
+    snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                               backend=backend)
+    segment = snap.table[0]
+    target = segment.target
+    if len(snap.table) != 1 or isinstance(target, mapper.SnapshotMerge) or \
+            not isinstance(target, (mapper.Snapshot, mapper.Thin)):
+        raise UnsupportedDevice('{} is not a snapshot'.format(name))
+
+    sectors = snap_size // 512
+    result = ResizeResult(name, segment.sectors * 512, sectors * 512)
+    if sectors < segment.sectors:
+        raise ValueError('{} cannot be shrunk'.format(name))
+    elif sectors == segment.sectors:
+        return result
+
+    with timing.phase('resize'):
+        if isinstance(target, mapper.Snapshot):
+            base = mapper.MapperDevice(target.origin, backend=backend)
+            end = sum(part.sectors for part in base.table)
+            if end < sectors:
+                extend_table(base.table, sectors)
+                result.stalls[base.name] = base.load()
+
+        segment.sectors = sectors
+        result.stalls[name] = snap.load()
+
+    registry = registry or get_registry()
+    record = registry.get(name)
+    if record is not None:
+        params = dict(record.params, snap_size=snap_size)
+        registry.update(name, size=sectors * 512, params=params)
+        if record.store is not None:
+            store = snapstore.Store(record.store, blockdev.BlockDevice(
+                record.store_loop or record.store))
+            header = store.read_header()
+            header.size = sectors * 512
+            store.write_header(header, clear=False)
+
+    LOG.info('resized %s to %d bytes; I/O stalled for %.3fs', name,
+             sectors * 512, result.stall)
+    return result
+
+
+@attr.s
+class BatchResult():
+    '''The outcome of one item of a batch.'''
+
+    item = attr.ib()
+    ok = attr.ib(default=True)
+    devices = attr.ib(default=attr.Factory(list))
+    error = attr.ib(default=None)
+    elapsed = attr.ib(default=0.0)
+
+    def to_dict(self):
+        return attr.asdict(self)
+
+
+@attr.s
+class BatchReport():
+    '''The results of a batch, in the order the items were given.'''
+
+    results = attr.ib(default=attr.Factory(list))
+    elapsed = attr.ib(default=0.0)
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def devices(self):
+        return [device for result in self.results for device in
+                result.devices]
+
+    @property
+    def throughput(self):
+        '''Devices handled per second.'''
+
+        if not self.elapsed:
+            return 0.0
+        return len(self.devices) / self.elapsed
+
+    def to_dict(self):
+        return {'results': [result.to_dict() for result in self.results],
+                'elapsed': self.elapsed,
+                'throughput': self.throughput}
+
+
+def run_batch(func, items, workers=None):
+    '''Call func on each of items in a thread pool.
+
+    func returns the list of devices it handled. An item that fails
+    does not stop the others; its error is recorded in its result.
+    '''
+
+    def _run(item):
+        started = time.monotonic()
+        try:
+            devices = func(item)
+        except BATCH_ERRORS as e:
+            LOG.error('%s failed: %s', item, e)
+            return BatchResult(item, ok=False, error=str(e),
+                               elapsed=time.monotonic() - started)
+
+        return BatchResult(item, devices=devices,
+                           elapsed=time.monotonic() - started)
+
+    items = list(items)
+    started = time.monotonic()
+    if not items:
+        return BatchReport()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or len(items)) as pool:
+        results = list(pool.map(_run, items))
+
+    return BatchReport(results, time.monotonic() - started)
+
+
+def create_many(specs, workers=None, backend=None, registry=None,
+                inventory=None):
+    '''Create snapshots for each of specs in parallel.
+
+    Each spec is a dictionary of keyword arguments for
+    create_snapshots, including src. Name allocation, loop device
+    setup and registry updates are serialised by their own locks;
+    everything else runs concurrently. Returns a BatchReport.
+    '''
+
+    def _create(spec):
+        spec = dict(spec)
+        if 'src' not in spec:
+            raise ValueError('no src in {}'.format(spec))
+        src = spec.pop('src')
+        snaps = create_snapshots(src, backend=backend, registry=registry,
+                                 inventory=inventory, **spec)
+        return [str(snap.device) for snap in snaps]
+
+    return run_batch(_create, specs, workers=workers)
+
+
+def remove_many(names, workers=None, backend=None, registry=None,
+                inventory=None):
+    '''Remove the named snapshots in parallel. Returns a BatchReport.'''
+
+    def _remove(name):
+        remove_snapshot(name, backend=backend, registry=registry,
+                        inventory=inventory)
+        return [name]
+
+    return run_batch(_remove, names, workers=workers)
@@ -1,30 +1,396 @@
 import attr
 import json
+import logging
+import os
 from pathlib import Path
+import re
+import stat
+import struct
 import subprocess
+import zlib
 
 from bull.common import run_command
-from bull.exceptions import NoPartitionMap
+from bull.exceptions import NoPartitionMap, NoSuchPartition
+from bull.host import get_host
 
+LOG = logging.getLogger(__name__)
 
-def get_mounts():
-    mounts = []
-    with open('/proc/mounts') as fd:
-        for line in fd:
-            line = line.split()
-            mounts.append((line[0], line[1]))
+SECTOR_SIZE = 512
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+MBR_GPT_PROTECTIVE = 0xee
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+MAX_LOGICAL_PARTITIONS = 128
+MAX_CACHED_TABLES = 64
+
+_part_table_cache = {}
+
+
+@attr.s(frozen=True)
+class Geometry():
+    '''Size, sector sizes and device number of a device or image file.
+
+    Sizes of block devices come from the BLKGETSIZE64, BLKSSZGET and
+    BLKPBSZGET ioctls. Regular files are described using fstat alone
+    and have no device number.
+    '''
+
+    size_bytes = attr.ib(converter=int)
+    logical_sector_size = attr.ib(converter=int, default=SECTOR_SIZE)
+    physical_sector_size = attr.ib(converter=int, default=SECTOR_SIZE)
+    dev = attr.ib(default=None)
+
+    @property
+    def size_sectors(self):
+        '''Size in 512-byte sectors.'''
+        return self.size_bytes // SECTOR_SIZE
+
+    @property
+    def is_block_device(self):
+        return self.dev is not None
+
+    @property
+    def major(self):
+        return os.major(self.dev) if self.dev is not None else None
+
+    @property
+    def minor(self):
+        return os.minor(self.dev) if self.dev is not None else None
+
+    @classmethod
+    def from_path(kls, path):
+        size, logical, physical, dev = get_host().device_info(path)
+        return kls(size, logical or SECTOR_SIZE, physical or SECTOR_SIZE,
+                   dev)
+
+
+def get_mounts_by_dev():
+    '''Return a dictionary mapping 'major:minor' to mount points.
+
+    Using the device number from /proc/self/mountinfo means a device
+    is found no matter which of its names it was mounted by.
+    '''
+
+    mounts = {}
+    for line in get_host().read('/proc/self/mountinfo').splitlines():
+        fields = line.split()
+        mounts.setdefault(fields[2], fields[4])
     return mounts
 
 
+@attr.s
+class Partition():
+    '''A single entry in a partition table.
+
+    Start and size are always expressed in 512-byte sectors,
+    regardless of the logical sector size of the underlying device.
+    '''
+
+    number = attr.ib(converter=int)
+    start = attr.ib(converter=int)
+    size = attr.ib(converter=int)
+    type = attr.ib(default=None)
+
+
+@attr.s
+class PartitionTable():
+    '''A partition table, as read from a device or image file.'''
+
+    label = attr.ib()
+    partitions = attr.ib(default=attr.Factory(list))
+
+    def get(self, partnum):
+        for part in self.partitions:
+            if part.number == partnum:
+                return part
+
+        raise NoSuchPartition(partnum)
+
+
+def _read_at(fd, offset, size):
+    data = os.pread(fd, size, offset)
+    if len(data) != size:
+        raise ValueError('short read at offset {}'.format(offset))
+    return data
+
+
+def _parse_mbr_entries(sector):
+    for i in range(4):
+        entry = sector[446 + i * 16:446 + (i + 1) * 16]
+        parttype = entry[4]
+        start, size = struct.unpack('<II', entry[8:16])
+        yield parttype, start, size
+
+
+def _plausible_mbr(sector, device_sectors, scale=1):
+    '''Return whether the entries of a sector with an MBR signature look
+    like a partition table, rather than (say) the boot sector of a FAT
+    or NTFS volume: every boot flag is 0x00 or 0x80, and no partition
+    overlaps another or runs past the end of the device.'''
+
+    if any(sector[446 + i * 16] not in (0, 0x80) for i in range(4)):
+        return False
+
+    extents = sorted((start, start + size)
+                     for parttype, start, size in _parse_mbr_entries(sector)
+                     if parttype != 0 and size != 0)
+    end = 1
+    for start, stop in extents:
+        if start < end or stop * scale > device_sectors:
+            return False
+        end = stop
+
+    return True
+
+
+def parse_mbr(fd, sector_size=SECTOR_SIZE):
+    '''Parse a DOS partition table, including logical partitions.'''
+
+    scale = sector_size // SECTOR_SIZE
+    sector = _read_at(fd, 0, SECTOR_SIZE)
+    table = PartitionTable('dos')
+    extended = None
+
+    for num, (parttype, start, size) in enumerate(
+            _parse_mbr_entries(sector), start=1):
+        if parttype == 0 or size == 0:
+            continue
+
+        table.partitions.append(
+            Partition(num, start * scale, size * scale,
+                      '{:x}'.format(parttype)))
+
+        if parttype in MBR_EXTENDED_TYPES:
+            extended = start
+
+    if extended is None:
+        return table
+
+    # Logical partitions are described by a chain of extended boot
+    # records. The partition in each EBR is relative to that EBR, and
+    # the link to the next EBR is relative to the start of the
+    # extended partition.
+    ebr = extended
+    for num in range(5, 5 + MAX_LOGICAL_PARTITIONS):
+        sector = _read_at(fd, ebr * sector_size, SECTOR_SIZE)
+        if sector[510:512] != MBR_SIGNATURE:
+            break
+
+        entries = list(_parse_mbr_entries(sector))
+        parttype, start, size = entries[0]
+        if parttype != 0 and size != 0:
+            table.partitions.append(
+                Partition(num, (ebr + start) * scale, size * scale,
+                          '{:x}'.format(parttype)))
+
+        parttype, start, size = entries[1]
+        if parttype not in MBR_EXTENDED_TYPES or start == 0:
+            break
+
+        ebr = extended + start
+
+    return table
+
+
+def _format_guid(raw):
+    a, b, c = struct.unpack('<IHH', raw[:8])
+    d = raw[8:10].hex()
+    e = raw[10:].hex()
+    return '{:08X}-{:04X}-{:04X}-{}-{}'.format(a, b, c, d.upper(), e.upper())
+
+
+def parse_gpt(fd, sector_size=SECTOR_SIZE):
+    '''Parse a GPT partition table.
+
+    Raise ValueError if there is no valid GPT header at LBA 1.
+    '''
+
+    scale = sector_size // SECTOR_SIZE
+    raw = _read_at(fd, sector_size, sector_size)
+    (signature, revision, header_size, header_crc, _reserved,
+     current_lba, backup_lba, first_lba, last_lba, disk_guid,
+     entries_lba, num_entries, entry_size, entries_crc) = \
+        GPT_HEADER.unpack_from(raw)
+
+    if signature != GPT_SIGNATURE:
+        raise ValueError('missing GPT signature')
+
+    header = bytearray(raw[:header_size])
+    header[16:20] = b'\0\0\0\0'
+    if zlib.crc32(header) != header_crc:
+        raise ValueError('invalid GPT header checksum')
+
+    entries = _read_at(fd, entries_lba * sector_size,
+                       num_entries * entry_size)
+    if zlib.crc32(entries) != entries_crc:
+        raise ValueError('invalid GPT partition entry checksum')
+
+    table = PartitionTable('gpt')
+    for i in range(num_entries):
+        (type_guid, part_guid, start, end, flags,
+         name) = GPT_ENTRY.unpack_from(entries, i * entry_size)
+
+        if type_guid == bytes(16):
+            continue
+
+        table.partitions.append(
+            Partition(i + 1, start * scale, (end - start + 1) * scale,
+                      _format_guid(type_guid)))
+
+    return table
+
+
+def read_part_table(path, sector_size=None):
+    '''Read an MBR or GPT partition table directly from a device or file.
+
+    If sector_size is None, try a 512-byte logical sector size first
+    and then 4096 bytes. Return None if no partition table we
+    understand is found.
+    '''
+
+    sector_sizes = [sector_size] if sector_size else [512, 4096]
+
+    with get_host().open_device(path) as fd:
+        fd = fd.fileno()
+        try:
+            mbr = _read_at(fd, 0, SECTOR_SIZE)
+        except ValueError:
+            return None
+
+        if mbr[510:512] != MBR_SIGNATURE:
+            return None
+
+        types = [parttype for parttype, start, size in _parse_mbr_entries(mbr)]
+        gpt = MBR_GPT_PROTECTIVE in types
+        device_sectors = os.lseek(fd, 0, os.SEEK_END) // SECTOR_SIZE
+        if not _plausible_mbr(mbr, float('inf') if gpt else device_sectors,
+                              scale=sector_sizes[0] // SECTOR_SIZE):
+            LOG.debug('%s has an MBR signature but no partition table',
+                      path)
+            return None
+
+        if gpt:
+            for size in sector_sizes:
+                try:
+                    return parse_gpt(fd, size)
+                except ValueError as e:
+                    LOG.debug('no GPT with %d byte sectors on %s: %s',
+                              size, path, e)
+            return None
+
+        try:
+            return parse_mbr(fd, sector_sizes[0])
+        except ValueError as e:
+            LOG.debug('failed to parse MBR on %s: %s', path, e)
+            return None
+
+
+def read_part_table_sfdisk(path):
+    '''Read a partition table using sfdisk.'''
+
+    try:
+        p = run_command('sfdisk', '--json', str(path))
+    except subprocess.CalledProcessError:
+        raise NoPartitionMap(path)
+
+    data = json.loads(p.stdout.decode('ascii'))['partitiontable']
+    table = PartitionTable(data.get('label'))
+    for i, part in enumerate(data.get('partitions', []), start=1):
+        match = re.search(r'(\d+)$', part.get('node', ''))
+        table.partitions.append(
+            Partition(int(match.group(1)) if match else i,
+                      part['start'], part['size'], part.get('type')))
+
+    return table
+
+
+def part_table_cache_key(path):
+    '''Return a key that changes when a partition table may have changed.
+
+    Regular files are identified by inode and modification time. Block
+    devices are identified by device number plus the kernel's disk
+    sequence number (or the device size on kernels that don't
+    provide one), since writing to a device node does not update its
+    mtime.
+    '''
+
+    host = get_host()
+    st = host.stat(path)
+    if stat.S_ISBLK(st.st_mode):
+        sysfs = Path('/sys/dev/block/{}:{}'.format(
+            os.major(st.st_rdev), os.minor(st.st_rdev)))
+        generation = None
+        for attrname in ('diskseq', 'size'):
+            try:
+                generation = (attrname,
+                              host.read(sysfs / attrname).strip())
+                break
+            except OSError:
+                continue
+
+        return ('blk', st.st_rdev, generation)
+
+    return ('file', st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def get_part_table(path, sector_size=None):
+    '''Return the (possibly cached) partition table for path.
+
+    Use the native MBR/GPT parser, and fall back to sfdisk for
+    partition table formats it doesn't understand.
+    '''
+
+    key = (part_table_cache_key(path), sector_size)
+    try:
+        return _part_table_cache[key]
+    except KeyError:
+        pass
+
+    table = read_part_table(path, sector_size=sector_size)
+    if table is None:
+        LOG.debug('falling back to sfdisk for %s', path)
+        table = read_part_table_sfdisk(path)
+
+    if len(_part_table_cache) >= MAX_CACHED_TABLES:
+        _part_table_cache.pop(next(iter(_part_table_cache)))
+    _part_table_cache[key] = table
+
+    return table
+
+
+def clear_part_table_cache():
+    _part_table_cache.clear()
+
+
 @attr.s
 class BlockDevice():
     '''Base class for our other block device classes.'''
 
     device = attr.ib(converter=Path)
 
+    _geometry = None
+    _realdevice = None
+
+    @property
+    def geometry(self):
+        '''Return the (cached) geometry of this device.'''
+
+        if self._geometry is None:
+            self._geometry = Geometry.from_path(self.device)
+        return self._geometry
+
+    def invalidate_geometry(self):
+        '''Forget cached geometry and kernel name, e.g. after the device
+        was resized or recreated.'''
+
+        self._geometry = None
+        self._realdevice = None
+
     def get_device_info(self):
-        with (self.sysfs / 'dev').open() as fd:
-            return (int(x) for x in (fd.read().strip().split(':')))
+        geometry = self.geometry
+        return (geometry.major, geometry.minor)
 
     @property
     def sysfs(self):
@@ -40,7 +406,9 @@ class BlockDevice():
         device in /sys.
         '''
 
-        return self.device.resolve()
+        if self._realdevice is None:
+            self._realdevice = get_host().realpath(self.device)
+        return self._realdevice
 
     @property
     def major(self):
@@ -55,51 +423,59 @@ class BlockDevice():
     def get_size_bytes(self):
         '''Return the device size in bytes.'''
 
-        p = run_command('blockdev', '--getsize64', str(self.device))
-        return int(p.stdout.decode('ascii').strip())
+        return self.geometry.size_bytes
 
     def get_size_sectors(self):
         '''Return the device size in 512-byte sectors.'''
-        p = run_command('blockdev', '--getsz', str(self.device))
-        return int(p.stdout.decode('ascii').strip())
+        return self.geometry.size_sectors
 
     def get_part_table(self):
         '''Return the partition table of the device.'''
-        try:
-            p = run_command('sfdisk', '--json', str(self.device))
-        except subprocess.CalledProcessError:
-            raise NoPartitionMap(self)
 
-        table = json.loads(p.stdout.decode('ascii'))
-        return table
+        geometry = self.geometry
+        sector_size = (geometry.logical_sector_size
+                       if geometry.is_block_device else None)
+        return get_part_table(self.device, sector_size=sector_size)
 
     def get_part_offset_sectors(self, partnum):
         '''Get the offset of a partition in 512-byte sectors.'''
 
-        table = self.get_part_table()
-        return table['partitiontable']['partitions'][partnum - 1]['start']
+        return self.get_part_table().get(partnum).start
 
     def get_part_size_sectors(self, partnum):
         '''Get the size of a partition in 512-byte sectors.'''
 
-        table = self.get_part_table()
-        return table['partitiontable']['partitions'][partnum - 1]['size']
+        return self.get_part_table().get(partnum).size
 
     def get_part_size_bytes(self, partnum):
         '''Get the size of a partition in bytes.'''
 
-        sectors = self.get_part_size_sectors()
-        return sectors * 512
+        sectors = self.get_part_size_sectors(partnum)
+        return sectors * SECTOR_SIZE
+
+    def holders(self):
+        '''Return the names of devices (like dm-3) stacked on this one.'''
+
+        try:
+            return get_host().listdir(self.sysfs / 'holders')
+        except FileNotFoundError:
+            return []
 
     def exists(self):
         '''Returns True if the device path exists, False otherwise.'''
 
-        return self.device.exists()
+        return get_host().exists(self.device)
+
+    def is_mounted(self, inventory=None):
+        '''Returns True if the device is mounted, by whatever name,
+        False otherwise.'''
 
-    def is_mounted(self):
-        '''Returns True if the device is mounted, False otherwise.'''
+        if inventory is not None:
+            return inventory.is_mounted(self.device)
 
-        mounts = {dev: path
-                  for dev, path in get_mounts()}
+        try:
+            devnum = '{}:{}'.format(self.major, self.minor)
+        except FileNotFoundError:
+            return False
 
-        return str(self.device) in mounts
+        return devnum in get_mounts_by_dev()
@@ -0,0 +1,234 @@
+'''Keep bull's ramdisks within a host-wide memory budget.
+
+Every zram device bull creates takes RAM as it fills, and nothing
+stops a burst of creates from promising more of it than the host has.
+With a budget (see set_max_ram), each create first works out what the
+zram devices of the recorded snapshots are committed to (their
+mem_limit, or what they use now if they have none) and is only let
+through if its own devices fit in what is left. Creates under a
+budget give their zram devices a mem_limit, so that what they are
+admitted with is also the most they can take.
+
+The check and the create happen under BUDGET_LOCK, so that
+concurrent bull commands see each other's devices. Creates that should
+not hold the lock for that long (see bull.aio) reserve their cost
+instead: the reservation is kept in RESERVED_PATH, where other checks
+count it, until their devices are recorded.
+'''
+
+import attr
+import contextlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from bull import zram
+from bull.common import lock_file
+from bull.exceptions import OverBudget
+from bull.host import RUN_DIR, get_host
+from bull.registry import get_registry
+
+LOG = logging.getLogger(__name__)
+BUDGET_LOCK = RUN_DIR / 'budget.lock'
+RESERVED_PATH = RUN_DIR / 'budget.json'
+ADMIT_INTERVAL = 1.0
+
+
+@attr.s
+class MemoryUsage():
+    '''RAM committed to bull's zram devices, and the budget, in bytes.
+    budget is None if there is none.'''
+
+    committed = attr.ib(default=0)
+    budget = attr.ib(default=None)
+
+    @property
+    def headroom(self):
+        if self.budget is None:
+            return None
+        return self.budget - self.committed
+
+    def fits(self, cost):
+        return self.budget is None or self.committed + cost <= self.budget
+
+
+def committed(registry=None):
+    '''Return the bytes of RAM committed to the zram devices of recorded
+    snapshots: the mem_limit of each, or its current usage if it has no
+    limit.'''
+
+    devices = set()
+    for record in (registry or get_registry()).records():
+        devices.update(record.zram)
+        if record.origin is not None:
+            devices.add(record.origin)
+
+    total = 0
+    for device in sorted(devices):
+        try:
+            stat = zram.ZramDevice(device).mm_stat()
+        except OSError as e:
+            LOG.debug('no zram statistics for %s: %s', device, e)
+            continue
+        total += stat.mem_limit or stat.mem_used_total
+
+    return total
+
+
+def memory_usage(budget=None, registry=None):
+    '''Return a MemoryUsage for budget (by default, get_max_ram()).
+    What is reserved counts as committed.'''
+
+    if budget is None:
+        budget = get_max_ram()
+    total = committed(registry=registry) + sum(reserved().values())
+    return MemoryUsage(total, budget)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load_reserved():
+    try:
+        with get_host().run_path(RESERVED_PATH).open() as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        LOG.warning('ignoring unreadable reservations: %s', e)
+        return {}
+
+
+def _save_reserved(reservations):
+    path = get_host().run_path(RESERVED_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.{}.{}'.format(path.name, os.getpid()))
+    with tmp.open('w') as fd:
+        json.dump(reservations, fd)
+    os.replace(str(tmp), str(path))
+
+
+def reserved():
+    '''Return the bytes of RAM reserved (see reserve) by each running
+    process, as a dictionary mapping reservation ids to bytes.'''
+
+    return {key: each['cost'] for key, each in _load_reserved().items()
+            if _alive(each['pid'])}
+
+
+@attr.s
+class Reservation():
+    '''cost bytes of the budget set aside by reserve.'''
+
+    key = attr.ib()
+    cost = attr.ib()
+    released = attr.ib(default=False)
+
+    def _drop(self):
+        reservations = _load_reserved()
+        reservations.pop(self.key, None)
+        _save_reserved(reservations)
+        self.released = True
+
+    def release(self):
+        '''Give the reservation back, if recording has not already.'''
+
+        if not self.released:
+            with lock_file(BUDGET_LOCK):
+                self._drop()
+
+
+@contextlib.contextmanager
+def recording(reservation):
+    '''Hold BUDGET_LOCK while the devices a Reservation was for are
+    recorded, then give it back. If reservation is None, no lock is
+    taken.'''
+
+    if reservation is None:
+        yield
+        return
+
+    with lock_file(BUDGET_LOCK):
+        yield
+        reservation._drop()
+
+
+def reserve(cost, budget=None, wait=0, interval=ADMIT_INTERVAL,
+            registry=None):
+    '''Like admit, but instead of holding BUDGET_LOCK until the block
+    is done, set cost bytes aside and return a Reservation. Record the
+    devices inside a recording() block, or release() it if they are
+    not created. Without a budget, returns None.'''
+
+    if budget is None:
+        budget = get_max_ram()
+    if budget is None:
+        return None
+
+    with admit(cost, budget=budget, wait=wait, interval=interval,
+               registry=registry):
+        reservation = Reservation(uuid.uuid4().hex, cost)
+        reservations = {key: each for key, each
+                        in _load_reserved().items() if _alive(each['pid'])}
+        reservations[reservation.key] = {'pid': os.getpid(), 'cost': cost}
+        _save_reserved(reservations)
+
+    return reservation
+
+
+@contextlib.contextmanager
+def admit(cost, budget=None, wait=0, interval=ADMIT_INTERVAL,
+          registry=None):
+    '''Run the block once cost more bytes of RAM fit in the budget (by
+    default, get_max_ram()), holding BUDGET_LOCK.
+
+    If they do not fit, check again every interval seconds for up to
+    wait seconds, then raise OverBudget. Without a budget, the block
+    runs at once and no lock is taken.
+    '''
+
+    if budget is None:
+        budget = get_max_ram()
+    if budget is None:
+        yield MemoryUsage()
+        return
+
+    deadline = time.monotonic() + wait
+    while True:
+        with lock_file(BUDGET_LOCK):
+            usage = memory_usage(budget, registry=registry)
+            if usage.fits(cost):
+                LOG.debug('admitting %d bytes with %d of %d committed',
+                          cost, usage.committed, budget)
+                yield usage
+                return
+
+        if time.monotonic() >= deadline:
+            raise OverBudget(
+                'need {} bytes of RAM but only {} of the {} byte budget '
+                'are left'.format(cost, max(usage.headroom, 0), budget))
+
+        LOG.info('waiting for %d bytes of RAM (%d left)', cost,
+                 usage.headroom)
+        time.sleep(interval)
+
+
+_max_ram = None
+
+
+def get_max_ram():
+    return _max_ram
+
+
+def set_max_ram(max_ram):
+    global _max_ram
+    _max_ram = max_ram
@@ -1,6 +1,12 @@
+import contextlib
+import fcntl
 import logging
+import os
 import subprocess
 
+from bull import timing
+from bull.host import get_host
+
 LOG = logging.getLogger(__name__)
 
 
@@ -17,8 +23,66 @@ def run_command(*args, input=None):
     if input is not None:
         LOG.debug('with input: %s', repr(input))
 
-    return subprocess.run(cli,
-                          check=True,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE,
-                          input=input)
+    with timing.timed(command_name(cli)):
+        return get_host().run(cli, input=input)
+
+
+def command_name(cli):
+    '''Name a command for timing: the program and its subcommand, if
+    it has one (e.g. "dmsetup load", "losetup").'''
+
+    if len(cli) > 1 and not cli[1].startswith('-') and \
+            not cli[1].startswith('/'):
+        return '{} {}'.format(cli[0], cli[1])
+    return cli[0]
+
+
+async def run_command_async(*args, input=None):
+    '''Run a command as an asyncio subprocess, capturing stdout and stderr.
+
+    This behaves like run_command, but does not block the event loop
+    while the command runs.
+    '''
+
+    cli = [str(arg) for arg in args]
+    LOG.debug('running command: %s', ' '.join(cli))
+    if input is not None:
+        LOG.debug('with input: %s', repr(input))
+
+    with timing.timed(command_name(cli)):
+        p = await get_host().run_async(cli, input=input)
+
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cli,
+                                            output=p.stdout, stderr=p.stderr)
+
+    return p
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    '''Hold an exclusive flock on path for the duration of the block.
+
+    If path is None, or the lock file cannot be opened (for example,
+    because we are not running as root), no lock is taken. Paths
+    under RUN_DIR are placed in the host's run directory.
+    '''
+
+    if path is None:
+        yield
+        return
+
+    path = get_host().run_path(path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+        LOG.debug('not locking %s: %s', path, e)
+        yield
+        return
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
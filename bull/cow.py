@@ -0,0 +1,170 @@
+'''Growable copy-on-write stores for snapshots.
+
+A snapshot's exception store is a linear device-mapper device
+(bullN-cow) over one or more zram devices. dm-snapshot checks the
+size of its COW device every time it allocates a chunk, so the store
+can be grown under a live snapshot by hot-adding another zram device
+and appending it to the linear table.
+
+Snapshots created before this layer existed use a zram device
+directly as their COW device; they are still understood here, but
+cannot be grown. Nor can persistent stores (see bull.store), whose
+COW device maps part of a file or disk.
+'''
+
+import logging
+from pathlib import Path
+
+from bull import loop
+from bull import mapper
+from bull import spill
+from bull import zram
+
+LOG = logging.getLogger(__name__)
+
+
+def is_cow_device(device):
+    return Path(str(device)).parent == Path('/dev/mapper')
+
+
+def is_zram_device(device):
+    return Path(str(device)).name.startswith('zram')
+
+
+def create_cow(name, backing, size=None, backend=None, offset=0,
+               load=True):
+    '''Create a linear COW device called name over size bytes of a zram
+    device (all of it, if not given), starting offset sectors in. If
+    load is false, the caller loads its table.'''
+
+    if size is None:
+        size = backing.size
+
+    cow = mapper.MapperDevice.create(name, exclusive=True, backend=backend)
+    cow.table.append(
+        mapper.Segment(0, size // 512,
+                       mapper.Linear(backing.device, offset)))
+    if load:
+        cow.load()
+    return cow
+
+
+def backing_devices(device, backend=None):
+    '''Return the paths of the devices behind a COW device.'''
+
+    if not is_cow_device(device):
+        return [str(device)]
+
+    cow = mapper.MapperDevice(device, backend=backend)
+    cow.table.resolve()
+    return [str(segment.target.device) for segment in cow.table]
+
+
+def zram_devices(device, backend=None):
+    '''Return the zram devices behind a COW device.'''
+
+    return [zram.ZramDevice(path)
+            for path in backing_devices(device, backend=backend)
+            if is_zram_device(path)]
+
+
+def is_growable(device, backend=None):
+    '''Whether grow() can add to a COW device.'''
+
+    if not is_cow_device(device):
+        return False
+    return all(is_zram_device(path)
+               for path in backing_devices(device, backend=backend))
+
+
+def size_bytes(device, backend=None):
+    if not is_cow_device(device):
+        return zram.ZramDevice(device).size
+
+    cow = mapper.MapperDevice(device, backend=backend)
+    return sum(segment.sectors for segment in cow.table) * 512
+
+
+def grow(device, size, backend=None):
+    '''Add size bytes of zram to a COW device.
+
+    The new zram device gets the same compression algorithm and memory
+    limit as the first one. Returns the new zram device.
+    '''
+
+    if not is_cow_device(device):
+        raise ValueError('{} cannot be grown'.format(device))
+
+    cow = mapper.MapperDevice(device, backend=backend)
+    cow.table.resolve()
+    first = zram.ZramDevice(cow.table[0].target.device)
+
+    backing = zram.ZramDevice.create()
+    backing.configure(size, comp_algorithm=first.comp_algorithm,
+                      mem_limit=first.mem_limit or None)
+
+    end = sum(segment.sectors for segment in cow.table)
+    cow.table.append(
+        mapper.Segment(end, size // 512, mapper.Linear(backing.device, 0)))
+
+    LOG.info('growing %s by %d bytes with %s', cow.name, size,
+             backing.device)
+    cow.load()
+    return backing
+
+
+def reset(device, backend=None):
+    '''Discard everything in a COW device that nothing is using.
+
+    The first zram device is reset (keeping its size, compression
+    algorithm, memory limit and spill device) and any zram devices
+    added by grow() are removed.
+    '''
+
+    devices = zram_devices(device, backend=backend)
+    first, extra = devices[0], devices[1:]
+
+    # zram will not reset a device that is open, and the COW device's
+    # table holds it open, so the COW device maps zeros until the
+    # reset is done.
+    cow = table = None
+    if is_cow_device(device):
+        cow = mapper.MapperDevice(device, backend=backend)
+        table = mapper.Table(cow.table[:1])
+        cow.table = mapper.Table([
+            mapper.Segment(0, table[0].sectors, mapper.Zero())])
+        cow.load()
+        for backing in extra:
+            backing.remove()
+
+    size = first.size
+    options = {'comp_algorithm': first.comp_algorithm,
+               'mem_limit': first.mem_limit or None,
+               'backing_dev': first.backing_dev}
+    first.reset()
+    first.configure(size, **options)
+
+    if cow is not None:
+        cow.table = table
+        cow.load()
+
+
+def remove(device, backend=None):
+    '''Remove a COW device and the zram devices behind it, with their
+    spill slices. The loop device of a persistent store is detached,
+    leaving the file.'''
+
+    devices = backing_devices(device, backend=backend)
+
+    if is_cow_device(device):
+        mapper.MapperDevice(device, backend=backend).remove()
+
+    for path in devices:
+        if is_zram_device(path):
+            backing = zram.ZramDevice(path)
+            spilldev = backing.backing_dev
+            backing.remove()
+            if spilldev is not None and spill.is_spill_device(spilldev):
+                spill.release(spilldev, backend=backend)
+        elif Path(path).name.startswith('loop'):
+            loop.LoopDevice(path).remove()
@@ -0,0 +1,636 @@
+'''Talk to the device mapper through /dev/mapper/control.
+
+This implements the subset of the device mapper ioctl interface (see
+linux/dm-ioctl.h) that bull needs, so that creating and loading
+devices does not require forking dmsetup. FakeControl is an in-memory
+stand-in for the control device that lets the same code run without
+root.
+'''
+
+import attr
+import collections
+import errno
+import fcntl
+import logging
+import os
+from pathlib import Path
+import stat
+import struct
+
+from bull import timing
+from bull.exceptions import DeviceMapperError
+
+LOG = logging.getLogger(__name__)
+
+DM_IOCTL = 0xfd
+DM_VERSION = (4, 0, 0)
+DM_NAME_LEN = 128
+DM_UUID_LEN = 129
+DM_MAX_TYPE_NAME = 16
+DEFAULT_BUFFER_SIZE = 16 * 1024
+
+DM_IOCTL_STRUCT = struct.Struct(
+    '=3IIIIiIIIQ{}s{}s7s'.format(DM_NAME_LEN, DM_UUID_LEN))
+DM_TARGET_SPEC = struct.Struct('=QQiI{}s'.format(DM_MAX_TYPE_NAME))
+DM_NAME_LIST = struct.Struct('=QI')
+DM_TARGET_MSG = struct.Struct('=Q')
+
+DM_VERSION_CMD = 0
+DM_REMOVE_ALL_CMD = 1
+DM_LIST_DEVICES_CMD = 2
+DM_DEV_CREATE_CMD = 3
+DM_DEV_REMOVE_CMD = 4
+DM_DEV_RENAME_CMD = 5
+DM_DEV_SUSPEND_CMD = 6
+DM_DEV_STATUS_CMD = 7
+DM_DEV_WAIT_CMD = 8
+DM_TABLE_LOAD_CMD = 9
+DM_TABLE_CLEAR_CMD = 10
+DM_TABLE_DEPS_CMD = 11
+DM_TABLE_STATUS_CMD = 12
+DM_LIST_VERSIONS_CMD = 13
+DM_TARGET_MSG_CMD = 14
+
+DM_READONLY_FLAG = 1 << 0
+DM_SUSPEND_FLAG = 1 << 1
+DM_PERSISTENT_DEV_FLAG = 1 << 3
+DM_STATUS_TABLE_FLAG = 1 << 4
+DM_ACTIVE_PRESENT_FLAG = 1 << 5
+DM_INACTIVE_PRESENT_FLAG = 1 << 6
+DM_BUFFER_FULL_FLAG = 1 << 8
+DM_SKIP_LOCKFS_FLAG = 1 << 10
+DM_NOFLUSH_FLAG = 1 << 11
+DM_QUERY_INACTIVE_TABLE_FLAG = 1 << 12
+DM_DATA_OUT_FLAG = 1 << 16
+
+DM_COMMAND_NAMES = {
+    DM_VERSION_CMD: 'version',
+    DM_REMOVE_ALL_CMD: 'remove_all',
+    DM_LIST_DEVICES_CMD: 'list',
+    DM_DEV_CREATE_CMD: 'create',
+    DM_DEV_REMOVE_CMD: 'remove',
+    DM_DEV_RENAME_CMD: 'rename',
+    DM_DEV_SUSPEND_CMD: 'suspend',
+    DM_DEV_STATUS_CMD: 'status',
+    DM_DEV_WAIT_CMD: 'wait',
+    DM_TABLE_LOAD_CMD: 'load',
+    DM_TABLE_CLEAR_CMD: 'clear',
+    DM_TABLE_DEPS_CMD: 'deps',
+    DM_TABLE_STATUS_CMD: 'table_status',
+    DM_LIST_VERSIONS_CMD: 'versions',
+    DM_TARGET_MSG_CMD: 'message',
+}
+
+
+def dm_request(cmd):
+    '''Return the ioctl request number for a DM_*_CMD (_IOWR).'''
+
+    return (3 << 30) | (DM_IOCTL_STRUCT.size << 16) | (DM_IOCTL << 8) | cmd
+
+
+def _align(n, boundary=8):
+    return (n + boundary - 1) & ~(boundary - 1)
+
+
+def _cstring(raw):
+    return raw.split(b'\0', 1)[0].decode('utf-8')
+
+
+def _cstring_at(buf, pos, end=None):
+    end = buf.find(b'\0', pos, end)
+    return bytes(buf[pos:end if end >= 0 else None]).decode('utf-8')
+
+
+@attr.s
+class Header():
+    '''The struct dm_ioctl header that starts every request.'''
+
+    name = attr.ib(default='')
+    uuid = attr.ib(default='')
+    flags = attr.ib(default=0)
+    dev = attr.ib(default=0)
+    event_nr = attr.ib(default=0)
+    target_count = attr.ib(default=0)
+    open_count = attr.ib(default=0)
+    data_size = attr.ib(default=0)
+    data_start = attr.ib(default=DM_IOCTL_STRUCT.size)
+    version = attr.ib(default=DM_VERSION)
+
+    def pack_into(self, buf):
+        DM_IOCTL_STRUCT.pack_into(
+            buf, 0, *self.version, self.data_size, self.data_start,
+            self.target_count, self.open_count, self.flags, self.event_nr,
+            0, self.dev, self.name.encode('utf-8'),
+            self.uuid.encode('utf-8'), b'')
+
+    @classmethod
+    def unpack_from(kls, buf):
+        (v0, v1, v2, data_size, data_start, target_count, open_count,
+         flags, event_nr, _padding, dev, name, uuid,
+         _data) = DM_IOCTL_STRUCT.unpack_from(buf)
+
+        return kls(name=_cstring(name), uuid=_cstring(uuid), flags=flags,
+                   dev=dev, event_nr=event_nr, target_count=target_count,
+                   open_count=open_count, data_size=data_size,
+                   data_start=data_start, version=(v0, v1, v2))
+
+
+def encode_targets(targets):
+    '''Encode (start, length, type, params) tuples as dm_target_specs.
+
+    When passed to the kernel, the next field is the offset from the
+    start of one spec to the start of the next.
+    '''
+
+    data = bytearray()
+    for start, length, target_type, params in targets:
+        params = params.encode('utf-8') + b'\0'
+        size = _align(DM_TARGET_SPEC.size + len(params))
+        spec = bytearray(size)
+        DM_TARGET_SPEC.pack_into(spec, 0, start, length, 0, size,
+                                 target_type.encode('utf-8'))
+        spec[DM_TARGET_SPEC.size:DM_TARGET_SPEC.size + len(params)] = params
+        data += spec
+
+    return bytes(data)
+
+
+def decode_targets(buf, offset, count):
+    '''Decode dm_target_specs returned by DM_TABLE_STATUS.
+
+    When returned by the kernel, the next field is the offset of the
+    next spec from the start of the first one.
+    '''
+
+    targets = []
+    pos = offset
+    for i in range(count):
+        start, length, _status, _next, target_type = \
+            DM_TARGET_SPEC.unpack_from(buf, pos)
+        params = _cstring_at(buf, pos + DM_TARGET_SPEC.size,
+                             offset + _next if _next else None)
+        targets.append((start, length, _cstring(target_type), params))
+        pos = offset + _next
+
+    return targets
+
+
+def parse_table(table):
+    '''Split a textual table into (start, length, type, params) tuples.'''
+
+    targets = []
+    for line in table.splitlines():
+        if not line.strip():
+            continue
+        start, length, target_type, *params = line.split(None, 3)
+        targets.append((int(start), int(length), target_type,
+                        params[0] if params else ''))
+
+    return targets
+
+
+def format_table(targets):
+    return '\n'.join(' '.join(str(x) for x in target if x != '')
+                     for target in targets)
+
+
+def decode_name_list(buf, offset):
+    '''Decode the dm_name_list returned by DM_LIST_DEVICES.'''
+
+    names = []
+    pos = offset
+    while True:
+        dev, _next = DM_NAME_LIST.unpack_from(buf, pos)
+        if dev == 0 and not names:
+            break
+
+        names.append((_cstring_at(buf, pos + DM_NAME_LIST.size), dev))
+        if _next == 0:
+            break
+        pos += _next
+
+    return names
+
+
+def encode_name_list(names):
+    data = bytearray()
+    for i, (name, dev) in enumerate(names):
+        raw = name.encode('utf-8') + b'\0'
+        size = _align(DM_NAME_LIST.size + len(raw))
+        entry = bytearray(size)
+        DM_NAME_LIST.pack_into(entry, 0, dev,
+                               size if i < len(names) - 1 else 0)
+        entry[DM_NAME_LIST.size:DM_NAME_LIST.size + len(raw)] = raw
+        data += entry
+
+    return bytes(data) or bytes(_align(DM_NAME_LIST.size))
+
+
+class Control():
+    '''The device mapper control device.'''
+
+    path = Path('/dev/mapper/control')
+
+    def __init__(self, path=None):
+        if path is not None:
+            self.path = Path(path)
+        self.fd = os.open(str(self.path), os.O_RDWR | os.O_CLOEXEC)
+
+    def ioctl(self, request, buf):
+        return fcntl.ioctl(self.fd, request, buf, True)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+@attr.s
+class FakeMapping():
+    name = attr.ib()
+    dev = attr.ib()
+    uuid = attr.ib(default='')
+    active = attr.ib(default=None)
+    inactive = attr.ib(default=None)
+    suspended = attr.ib(default=False)
+    event_nr = attr.ib(default=0)
+    messages = attr.ib(default=attr.Factory(list))
+
+
+class FakeControl():
+    '''An in-memory stand-in for /dev/mapper/control.
+
+    It decodes the same ioctl buffers that the kernel would and
+    keeps device tables in memory, so that IoctlBackend (and anything
+    built on it) can be exercised without root or a device mapper.
+    Target status is produced by status_for, which subclasses can
+    override to simulate e.g. snapshot usage.
+    '''
+
+    major = 253
+
+    def __init__(self):
+        self.devices = {}
+        self.next_minor = 0
+        self.calls = 0
+        self.index = None
+
+    def dev_for(self, name):
+        return os.makedev(self.major, self.devices[name].dev)
+
+    def devpath(self, name):
+        return '/dev/mapper/{}'.format(name)
+
+    def referrers(self, refs):
+        '''Return names of devices whose active table mentions any of
+        refs (device paths or major:minor pairs).'''
+
+        # Built on demand and dropped whenever an active table changes,
+        # so that open counts stay cheap with thousands of devices.
+        if self.index is None:
+            self.index = collections.defaultdict(set)
+            for other in self.devices.values():
+                for start, length, target_type, params in other.active or []:
+                    for ref in params.split():
+                        self.index[ref].add(other.name)
+
+        found = set()
+        for ref in refs:
+            found.update(self.index.get(ref, ()))
+        return sorted(found, key=lambda name: self.devices[name].dev)
+
+    def holders(self, name):
+        '''Return names of devices whose active table refers to name.'''
+
+        return self.referrers((self.devpath(name), '{}:{}'.format(
+            self.major, self.devices[name].dev)))
+
+    def status_for(self, mapping, start, length, target_type, params):
+        if target_type in ('snapshot', 'snapshot-merge'):
+            return '0/{} 0'.format(length)
+        elif target_type == 'thin-pool':
+            return '0 0/1024 0/{} - rw discard_passdown queue_if_no_space ' \
+                '- 1024'.format(length // int(params.split()[2]))
+        elif target_type == 'thin':
+            return '0 {}'.format(length - 1)
+        return ''
+
+    def ioctl(self, request, buf):
+        self.calls += 1
+        cmd = request & 0xff
+        header = Header.unpack_from(buf)
+
+        if header.version[0] != DM_VERSION[0]:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        header.version = (4, 48, 0)
+        header.flags &= ~DM_BUFFER_FULL_FLAG
+        payload = self.dispatch(cmd, header, buf)
+
+        if payload is not None:
+            if header.data_start + len(payload) > header.data_size:
+                header.flags |= DM_BUFFER_FULL_FLAG
+            else:
+                buf[header.data_start:header.data_start + len(payload)] = \
+                    payload
+                header.flags |= DM_DATA_OUT_FLAG
+
+        header.pack_into(buf)
+        return 0
+
+    def lookup(self, header):
+        try:
+            return self.devices[header.name]
+        except KeyError:
+            raise OSError(errno.ENXIO, os.strerror(errno.ENXIO))
+
+    def describe(self, header, mapping):
+        header.dev = self.dev_for(mapping.name)
+        header.event_nr = mapping.event_nr
+        header.uuid = mapping.uuid
+        header.open_count = len(self.holders(mapping.name))
+        present = DM_ACTIVE_PRESENT_FLAG | DM_INACTIVE_PRESENT_FLAG
+        header.flags &= ~(present | DM_SUSPEND_FLAG)
+        if mapping.active is not None:
+            header.flags |= DM_ACTIVE_PRESENT_FLAG
+        if mapping.inactive is not None:
+            header.flags |= DM_INACTIVE_PRESENT_FLAG
+        if mapping.suspended:
+            header.flags |= DM_SUSPEND_FLAG
+
+        table = mapping.active
+        if header.flags & DM_QUERY_INACTIVE_TABLE_FLAG:
+            table = mapping.inactive
+        header.target_count = len(table or [])
+        return table
+
+    def dispatch(self, cmd, header, buf):
+        if cmd == DM_VERSION_CMD:
+            return None
+
+        if cmd == DM_LIST_DEVICES_CMD:
+            return encode_name_list([(name, self.dev_for(name))
+                                     for name in sorted(self.devices)])
+
+        if cmd == DM_DEV_CREATE_CMD:
+            if header.name in self.devices or not header.name:
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+            mapping = FakeMapping(header.name, self.next_minor,
+                                  uuid=header.uuid)
+            self.next_minor += 1
+            self.devices[header.name] = mapping
+            self.describe(header, mapping)
+            return None
+
+        mapping = self.lookup(header)
+
+        if cmd == DM_DEV_REMOVE_CMD:
+            if self.holders(mapping.name):
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+            del self.devices[mapping.name]
+            self.index = None
+        elif cmd == DM_DEV_SUSPEND_CMD:
+            if header.flags & DM_SUSPEND_FLAG:
+                mapping.suspended = True
+            else:
+                if mapping.inactive is not None:
+                    mapping.active = mapping.inactive
+                    mapping.inactive = None
+                    self.index = None
+                mapping.suspended = False
+            mapping.event_nr += 1
+            self.describe(header, mapping)
+        elif cmd == DM_DEV_STATUS_CMD:
+            self.describe(header, mapping)
+        elif cmd == DM_TABLE_LOAD_CMD:
+            mapping.inactive = decode_targets_in(buf, header.data_start,
+                                                 header.target_count)
+            self.describe(header, mapping)
+        elif cmd == DM_TABLE_CLEAR_CMD:
+            mapping.inactive = None
+            self.describe(header, mapping)
+        elif cmd == DM_TABLE_STATUS_CMD:
+            table = self.describe(header, mapping) or []
+            if header.flags & DM_STATUS_TABLE_FLAG:
+                return encode_status(table)
+            return encode_status([
+                (start, length, target_type,
+                 self.status_for(mapping, start, length, target_type,
+                                 params))
+                for start, length, target_type, params in table])
+        elif cmd == DM_TARGET_MSG_CMD:
+            mapping.messages.append(_cstring_at(
+                buf, header.data_start + DM_TARGET_MSG.size))
+        else:
+            raise OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+
+        return None
+
+
+def decode_targets_in(buf, offset, count):
+    '''Decode dm_target_specs as passed to DM_TABLE_LOAD.'''
+
+    targets = []
+    pos = offset
+    for i in range(count):
+        start, length, _status, _next, target_type = \
+            DM_TARGET_SPEC.unpack_from(buf, pos)
+        params = _cstring_at(buf, pos + DM_TARGET_SPEC.size, pos + _next)
+        targets.append((start, length, _cstring(target_type), params))
+        pos += _next
+
+    return targets
+
+
+def encode_status(targets):
+    '''Encode targets the way DM_TABLE_STATUS returns them.'''
+
+    data = encode_targets(targets)
+
+    # Rewrite next as an offset from the first spec rather than from
+    # the current one.
+    out = bytearray(data)
+    pos = 0
+    for i in range(len(targets)):
+        _next = DM_TARGET_SPEC.unpack_from(out, pos)[3]
+        struct.pack_into('=I', out, pos + 20, pos + _next)
+        pos += _next
+
+    return bytes(out)
+
+
+class IoctlBackend():
+    '''Device mapper backend using the DM ioctl interface.
+
+    control is anything with an ioctl(request, buf) method, normally
+    a Control. If mknodes is True, create (and remove) the
+    /dev/mapper/<name> nodes ourselves when udev hasn't done so.
+    '''
+
+    def __init__(self, control=None, mknodes=None,
+                 bufsize=DEFAULT_BUFFER_SIZE):
+        if control is None:
+            control = Control()
+            if mknodes is None:
+                mknodes = True
+
+        self.control = control
+        self.mknodes = bool(mknodes)
+        self.bufsize = bufsize
+
+    def _ioctl(self, cmd, name='', flags=0, payload=b'', target_count=0):
+        bufsize = max(self.bufsize, DM_IOCTL_STRUCT.size + len(payload))
+
+        while True:
+            buf = bytearray(bufsize)
+            header = Header(name=name, flags=flags, data_size=bufsize,
+                            target_count=target_count)
+            header.pack_into(buf)
+            buf[DM_IOCTL_STRUCT.size:DM_IOCTL_STRUCT.size + len(payload)] = \
+                payload
+
+            self.control.ioctl(dm_request(cmd), buf)
+            header = Header.unpack_from(buf)
+
+            if header.flags & DM_BUFFER_FULL_FLAG:
+                bufsize *= 2
+                LOG.debug('retrying dm ioctl %d with %d byte buffer',
+                          cmd, bufsize)
+                continue
+
+            return header, buf
+
+    def call(self, cmd, name='', **kwargs):
+        operation = DM_COMMAND_NAMES.get(cmd, str(cmd))
+        if cmd == DM_DEV_SUSPEND_CMD and \
+                not kwargs.get('flags', 0) & DM_SUSPEND_FLAG:
+            operation = 'resume'
+
+        try:
+            with timing.timed('dm {}'.format(operation)):
+                return self._ioctl(cmd, name=name, **kwargs)
+        except OSError as e:
+            raise DeviceMapperError('dm ioctl {} failed for {}: {}'.format(
+                cmd, name or '(none)', e.strerror))
+
+    def version(self):
+        header, buf = self.call(DM_VERSION_CMD)
+        return header.version
+
+    def exists(self, name):
+        try:
+            self._ioctl(DM_DEV_STATUS_CMD, name=name)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return False
+            raise DeviceMapperError(str(e))
+
+        return True
+
+    def devpath(self, name):
+        return Path('/dev/mapper') / name
+
+    def create(self, name):
+        header, buf = self.call(DM_DEV_CREATE_CMD, name=name)
+        path = self.devpath(name)
+
+        if self.mknodes and not os.path.lexists(str(path)):
+            LOG.debug('creating device node %s', path)
+            try:
+                os.mknod(str(path), stat.S_IFBLK | 0o660, header.dev)
+            except FileExistsError:
+                pass
+
+        return header.dev
+
+    def remove(self, name):
+        header, buf = self.call(DM_DEV_STATUS_CMD, name=name)
+        self.call(DM_DEV_REMOVE_CMD, name=name)
+        path = self.devpath(name)
+
+        if self.mknodes:
+            try:
+                st = os.lstat(str(path))
+                if stat.S_ISBLK(st.st_mode) and st.st_rdev == header.dev:
+                    os.unlink(str(path))
+            except FileNotFoundError:
+                pass
+
+    def suspend(self, name):
+        self.call(DM_DEV_SUSPEND_CMD, name=name, flags=DM_SUSPEND_FLAG)
+
+    def resume(self, name):
+        self.call(DM_DEV_SUSPEND_CMD, name=name)
+
+    def load(self, name, table):
+        targets = parse_table(table)
+        self.call(DM_TABLE_LOAD_CMD, name=name,
+                  payload=encode_targets(targets),
+                  target_count=len(targets))
+
+    def clear(self, name):
+        self.call(DM_TABLE_CLEAR_CMD, name=name)
+
+    def message(self, name, sector, message):
+        payload = DM_TARGET_MSG.pack(sector) + message.encode('utf-8') + b'\0'
+        header, buf = self.call(DM_TARGET_MSG_CMD, name=name, payload=payload)
+
+        if header.flags & DM_DATA_OUT_FLAG:
+            return _cstring_at(buf, header.data_start)
+        return ''
+
+    def _table_status(self, name, flags=0):
+        header, buf = self.call(DM_TABLE_STATUS_CMD, name=name, flags=flags)
+        return decode_targets(buf, header.data_start, header.target_count)
+
+    def table(self, name):
+        return format_table(self._table_status(name, DM_STATUS_TABLE_FLAG))
+
+    def status(self, name):
+        return format_table(self._table_status(name))
+
+    def names(self):
+        '''Return the names of all dm devices.'''
+
+        header, buf = self.call(DM_LIST_DEVICES_CMD)
+        return [name for name, dev in decode_name_list(buf, header.data_start)]
+
+    def list_devices(self, target_type=None):
+        names = self.names()
+
+        if target_type is None:
+            return names
+
+        return [name for name in names
+                if any(t[2] == target_type for t in
+                       self._table_status(name, DM_STATUS_TABLE_FLAG))]
+
+    def devices(self):
+        '''Return a dictionary mapping device names to 'major:minor'.'''
+
+        header, buf = self.call(DM_LIST_DEVICES_CMD)
+        return {name: '{}:{}'.format(os.major(dev), os.minor(dev))
+                for name, dev in decode_name_list(buf, header.data_start)}
+
+    def _per_device(self, flags, target_type=None):
+        header, buf = self.call(DM_LIST_DEVICES_CMD)
+        output = {}
+        for name, dev in decode_name_list(buf, header.data_start):
+            # Status and table entries both carry the target type, so
+            # one ioctl per device is enough to filter on it.
+            targets = self._table_status(name, flags)
+            if target_type is None or any(t[2] == target_type
+                                          for t in targets):
+                output[name] = format_table(targets)
+
+        return output
+
+    def status_all(self, target_type=None):
+        '''Return a dictionary mapping device names to their status.'''
+
+        return self._per_device(0, target_type)
+
+    def table_all(self, target_type=None):
+        '''Return a dictionary mapping device names to their table.'''
+
+        return self._per_device(DM_STATUS_TABLE_FLAG, target_type)
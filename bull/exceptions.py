@@ -10,9 +10,29 @@ class NoPartitionMap(BullError):
     pass
 
 
+class NoSuchPartition(BullError):
+    pass
+
+
 class NoDevicesAvailable(BullError):
     pass
 
 
 class DeviceExists(BullError):
     pass
+
+
+class DeviceMapperError(BullError):
+    pass
+
+
+class UnsupportedDevice(BullError):
+    pass
+
+
+class DeviceBusy(BullError):
+    pass
+
+
+class OverBudget(BullError):
+    pass
@@ -0,0 +1,744 @@
+'''A simulated kernel, for running bull without root.
+
+FakeKernel is a Host (see bull.host) that keeps loop devices, zram
+devices, device-mapper devices (in a dmioctl.FakeControl) and mounts
+in memory and serves the /sys, /proc and /dev files bull reads from
+them. The commands bull runs (losetup, dmsetup, umount) act on the
+same state, and are counted. Image files are real files; only the
+block devices are simulated, and nothing under /sys, /proc or /dev on
+the real host is touched.
+
+    with fake.FakeKernel(tmpdir) as kernel:
+        api.create_snapshots('disk.img', part=1)
+        print(kernel.commands)
+
+Entering a FakeKernel makes it the host, the device-mapper backend
+(ioctls, or dmsetup if dmsetup is True) and the registry, and keeps
+the registry and lock files in run_dir.
+'''
+
+import attr
+import collections
+import errno
+import io
+import os
+from pathlib import Path
+import re
+import stat
+import struct
+import subprocess
+import threading
+import types
+
+from bull import blockdev
+from bull import dmioctl
+from bull import host
+from bull import mapper
+from bull import registry
+from bull import zram
+from bull.exceptions import DeviceMapperError
+
+LOOP_MAJOR = 7
+ZRAM_MAJOR = 252
+ZRAM_ALGORITHMS = ('lzo', 'lzo-rle', 'lz4', 'zstd')
+ZRAM_CONTROL = str(zram.ZramDevice.control_path)
+VIRTUAL_ROOTS = ('/sys/', '/proc/', '/dev/')
+
+
+def _error(code, path=None):
+    return OSError(code, os.strerror(code), *([str(path)] if path else []))
+
+
+def make_image(path, size=64 * 2**20, partitions=None):
+    '''Write a sparse disk image with an MBR partition table.
+
+    partitions is a list of (type, start, size) tuples, in sectors. By
+    default there is one Linux partition filling the image after the
+    first MiB.
+    '''
+
+    if partitions is None:
+        partitions = [(0x83, 2048, size // blockdev.SECTOR_SIZE - 2048)]
+
+    mbr = bytearray(blockdev.SECTOR_SIZE)
+    for i, (parttype, start, length) in enumerate(partitions):
+        mbr[446 + i * 16:446 + (i + 1) * 16] = struct.pack(
+            '<B3sB3sII', 0, bytes(3), parttype, bytes(3), start, length)
+    mbr[510:512] = blockdev.MBR_SIGNATURE
+
+    with open(str(path), 'wb') as fd:
+        fd.write(mbr)
+        fd.truncate(size)
+
+
+@attr.s
+class FakeLoop():
+    minor = attr.ib()
+    backing_file = attr.ib()
+    offset = attr.ib(default=0)
+    sizelimit = attr.ib(default=0)
+    readonly = attr.ib(default=False)
+    direct_io = attr.ib(default=False)
+    block_size = attr.ib(default=512)
+
+    major = LOOP_MAJOR
+
+    @property
+    def name(self):
+        return 'loop{}'.format(self.minor)
+
+    @property
+    def size_bytes(self):
+        size = max(os.stat(self.backing_file).st_size - self.offset, 0)
+        return min(size, self.sizelimit) if self.sizelimit else size
+
+    def read(self, rest):
+        if rest[0] == 'loop' and len(rest) == 2 and rest[1] in (
+                'backing_file', 'offset', 'sizelimit'):
+            return '{}\n'.format(getattr(self, rest[1]))
+        if rest == ('loop', 'dio'):
+            return '{}\n'.format(int(self.direct_io))
+        if rest == ('queue', 'logical_block_size'):
+            return '{}\n'.format(self.block_size)
+        if rest == ('ro',):
+            return '{}\n'.format(int(self.readonly))
+
+
+@attr.s
+class FakeZram():
+    minor = attr.ib()
+    disksize = attr.ib(default=0)
+    comp_algorithm = attr.ib(default='lzo-rle')
+    max_comp_streams = attr.ib(default=1)
+    mem_limit = attr.ib(default=0)
+    orig_data_size = attr.ib(default=0)
+    backing_dev = attr.ib(default=None)
+    idle_pages = attr.ib(default=0)
+    writeback_limit = attr.ib(default=None)
+    bd_count = attr.ib(default=0)
+    bd_writes = attr.ib(default=0)
+    syncs = attr.ib(default=0)
+
+    major = ZRAM_MAJOR
+
+    @property
+    def name(self):
+        return 'zram{}'.format(self.minor)
+
+    @property
+    def size_bytes(self):
+        return self.disksize
+
+    def read(self, rest):
+        if len(rest) != 1:
+            return None
+
+        name = rest[0]
+        if name == 'comp_algorithm':
+            return ' '.join('[{}]'.format(algorithm)
+                            if algorithm == self.comp_algorithm
+                            else algorithm
+                            for algorithm in ZRAM_ALGORITHMS) + '\n'
+        elif name == 'initstate':
+            return '{}\n'.format(int(self.disksize > 0))
+        elif name == 'mm_stat':
+            # Everything compresses 2:1.
+            compressed = self.orig_data_size // 2
+            return '{} {} {} {} {} 0 0 0 0\n'.format(
+                self.orig_data_size, compressed, compressed,
+                self.mem_limit, compressed)
+        elif name == 'io_stat':
+            return '0 0 0 0\n'
+        elif name == 'bd_stat':
+            return '{} 0 {}\n'.format(self.bd_count, self.bd_writes)
+        elif name == 'backing_dev':
+            return '{}\n'.format(self.backing_dev or 'none')
+        elif name in ('disksize', 'max_comp_streams', 'mem_limit'):
+            return '{}\n'.format(getattr(self, name))
+
+    def write(self, name, value):
+        '''Change an attribute the way the zram driver would.'''
+
+        if name == 'reset':
+            self.disksize = 0
+            self.mem_limit = 0
+            self.orig_data_size = 0
+            self.backing_dev = None
+            self.idle_pages = 0
+        elif name in ('disksize', 'comp_algorithm', 'backing_dev') and \
+                self.disksize:
+            raise _error(errno.EBUSY)
+        elif name == 'backing_dev':
+            self.backing_dev = value
+        elif name in ('idle', 'writeback') and not self.disksize:
+            raise _error(errno.EINVAL)
+        elif name == 'idle':
+            self.idle_pages = self.orig_data_size // 4096
+        elif name == 'writeback':
+            if self.backing_dev is None:
+                raise _error(errno.ENODEV)
+            pages = self.idle_pages
+            if self.writeback_limit is not None:
+                pages = min(pages, self.writeback_limit)
+                self.writeback_limit -= pages
+            self.idle_pages -= pages
+            self.orig_data_size -= pages * 4096
+            self.bd_count += pages
+            self.bd_writes += pages
+        elif name == 'writeback_limit_enable':
+            self.writeback_limit = 0 if int(value) else None
+        elif name == 'writeback_limit':
+            self.writeback_limit = int(value)
+        elif name == 'comp_algorithm':
+            if value not in ZRAM_ALGORITHMS:
+                raise _error(errno.EINVAL)
+            self.comp_algorithm = value
+        elif name in ('disksize', 'max_comp_streams', 'mem_limit'):
+            setattr(self, name, int(value))
+        else:
+            raise _error(errno.ENOENT)
+
+
+class FakeZramFile(io.RawIOBase):
+    '''A zram device opened for writing.'''
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        self.pos = pos if whence == io.SEEK_SET else self.pos + pos
+        return self.pos
+
+    def write(self, data):
+        if self.pos + len(data) > self.dev.disksize:
+            raise _error(errno.ENOSPC)
+        self.dev.orig_data_size += len(data)
+        self.pos += len(data)
+        return len(data)
+
+
+class FakeKernel(host.Host):
+    '''Loop, zram and device-mapper devices that exist only in memory.
+
+    commands counts the commands run, by program. With loop_configure
+    false, the kernel is too old for LOOP_CONFIGURE and loop devices
+    have to be set up with losetup.
+    '''
+
+    def __init__(self, run_dir, dmsetup=False, loop_configure=True):
+        self.run_dir = Path(run_dir)
+        self.dmsetup = dmsetup
+        self.loop_configure = loop_configure
+        self.loop_ioctls = 0
+        self.control = dmioctl.FakeControl()
+        self.ioctl_backend = dmioctl.IoctlBackend(self, mknodes=False)
+        self.loops = {}
+        self.zrams = {}
+        self.mounts = {}
+        self.minors = None
+        self.commands = collections.Counter()
+        self.lock = threading.RLock()
+        self.saved = None
+
+    @property
+    def subprocesses(self):
+        return sum(self.commands.values())
+
+    @property
+    def ioctls(self):
+        return self.control.calls + self.loop_ioctls
+
+    def backend(self):
+        return mapper.DmsetupBackend() if self.dmsetup \
+            else self.ioctl_backend
+
+    def install(self):
+        '''Use this kernel for everything bull does from now on.'''
+
+        host.set_host(self)
+        mapper.set_backend(self.backend())
+        registry.set_registry(registry.Registry())
+        blockdev.clear_part_table_cache()
+
+    def __enter__(self):
+        self.saved = (host.get_host(), mapper._backend, registry._registry)
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        saved_host, saved_backend, saved_registry = self.saved
+        host.set_host(saved_host)
+        mapper.set_backend(saved_backend)
+        registry.set_registry(saved_registry)
+        blockdev.clear_part_table_cache()
+
+    def ioctl(self, request, buf):
+        '''Pass a device-mapper ioctl to the FakeControl.'''
+
+        with self.lock:
+            return self.control.ioctl(request, buf)
+
+    # Devices
+
+    def mappings(self):
+        return list(self.control.devices.values())
+
+    def block_devices(self):
+        return list(self.loops.values()) + list(self.zrams.values()) + \
+            self.mappings()
+
+    def block_name(self, dev):
+        if isinstance(dev, dmioctl.FakeMapping):
+            return 'dm-{}'.format(dev.dev)
+        return dev.name
+
+    def devnum(self, dev):
+        if isinstance(dev, dmioctl.FakeMapping):
+            return os.makedev(self.control.major, dev.dev)
+        return os.makedev(dev.major, dev.minor)
+
+    def size_bytes(self, dev):
+        if isinstance(dev, dmioctl.FakeMapping):
+            return sum(length for start, length, target_type, params
+                       in dev.active or []) * 512
+        return dev.size_bytes
+
+    def device(self, path):
+        '''Return the FakeLoop, FakeZram or FakeMapping a /dev path
+        refers to, or None.'''
+
+        path = str(path)
+        if path.startswith('/dev/mapper/'):
+            return self.control.devices.get(path[len('/dev/mapper/'):])
+
+        match = re.match(r'/dev/(loop|zram|dm-)(\d+)$', path)
+        if match:
+            return self.by_name(match.group(1) + match.group(2))
+
+    def by_name(self, name):
+        match = re.match(r'(loop|zram|dm-)(\d+)$', name)
+        if not match:
+            return None
+
+        minor = int(match.group(2))
+        if match.group(1) == 'loop':
+            return self.loops.get(minor)
+        elif match.group(1) == 'zram':
+            return self.zrams.get(minor)
+
+        # Mappings are looked up by minor number all the time, so keep
+        # an index, rebuilt whenever a device is created or removed.
+        key = (len(self.control.devices), self.control.next_minor)
+        if self.minors is None or self.minors[0] != key:
+            self.minors = (key, {mapping.dev: mapping
+                                 for mapping in self.mappings()})
+        return self.minors[1].get(minor)
+
+    def by_devnum(self, devnum):
+        major, minor = (int(n) for n in devnum.split(':'))
+        if major == LOOP_MAJOR:
+            return self.loops.get(minor)
+        elif major == ZRAM_MAJOR:
+            return self.zrams.get(minor)
+        elif major == self.control.major:
+            return self.by_name('dm-{}'.format(minor))
+
+    def holders(self, dev):
+        '''Return the names (like dm-3) of dm devices whose active table
+        refers to dev.'''
+
+        devnum = self.devnum(dev)
+        refs = ['/dev/{}'.format(self.block_name(dev)),
+                '{}:{}'.format(os.major(devnum), os.minor(devnum))]
+        if isinstance(dev, dmioctl.FakeMapping):
+            refs.append('/dev/mapper/{}'.format(dev.name))
+
+        return ['dm-{}'.format(self.control.devices[name].dev)
+                for name in self.control.referrers(refs)]
+
+    def slaves(self, dev):
+        '''Return the names of the devices a dm device's active table
+        refers to.'''
+
+        if not isinstance(dev, dmioctl.FakeMapping):
+            return []
+
+        names = []
+        for start, length, target_type, params in dev.active or []:
+            for ref in params.split():
+                other = self.by_devnum(ref) if re.match(r'\d+:\d+$', ref) \
+                    else self.device(ref)
+                if other is not None and self.block_name(other) not in names:
+                    names.append(self.block_name(other))
+        return names
+
+    def hot_add(self):
+        minor = min(set(range(len(self.zrams) + 1)) - set(self.zrams))
+        self.zrams[minor] = FakeZram(minor)
+        return minor
+
+    def hot_remove(self, minor):
+        dev = self.zrams.get(minor)
+        if dev is None:
+            raise _error(errno.ENODEV)
+        if self.holders(dev) or self.devnum(dev) in self.mounts:
+            raise _error(errno.EBUSY)
+        del self.zrams[minor]
+
+    def mount(self, device, mountpoint):
+        '''Pretend that device is mounted on mountpoint.'''
+
+        with self.lock:
+            dev = self.device(device)
+            if dev is None:
+                raise _error(errno.ENODEV, device)
+            self.mounts[self.devnum(dev)] = (str(device), str(mountpoint))
+
+    # Files
+
+    def is_virtual(self, path):
+        return str(path).startswith(VIRTUAL_ROOTS)
+
+    def sysfs(self, path):
+        '''Split a /sys/block or /sys/dev/block path into the device it
+        describes and the rest of the path.'''
+
+        parts = Path(path).parts
+        if parts[:3] == ('/', 'sys', 'block') and len(parts) > 3:
+            return self.by_name(parts[3]), parts[4:]
+        elif parts[:4] == ('/', 'sys', 'dev', 'block') and len(parts) > 4:
+            return self.by_devnum(parts[4]), parts[5:]
+
+        return None, None
+
+    def read_attr(self, dev, rest):
+        devnum = self.devnum(dev)
+        if rest == ('dev',):
+            return '{}:{}\n'.format(os.major(devnum), os.minor(devnum))
+        elif rest == ('size',):
+            return '{}\n'.format(self.size_bytes(dev) // 512)
+        elif rest == ('uevent',):
+            return 'MAJOR={}\nMINOR={}\nDEVNAME={}\nDEVTYPE=disk\n'.format(
+                os.major(devnum), os.minor(devnum), self.block_name(dev))
+        elif isinstance(dev, dmioctl.FakeMapping):
+            if rest == ('dm', 'name'):
+                return '{}\n'.format(dev.name)
+            elif rest == ('dm', 'uuid'):
+                return '{}\n'.format(dev.uuid)
+            return None
+
+        return dev.read(rest)
+
+    def directories(self, dev):
+        dirs = {('holders',), ('slaves',)}
+        if isinstance(dev, dmioctl.FakeMapping):
+            dirs.add(('dm',))
+        elif isinstance(dev, FakeLoop):
+            dirs.add(('loop',))
+        return dirs
+
+    def mountinfo(self):
+        return ''.join(
+            '{} 1 {}:{} / {} rw,relatime - ext4 {} rw\n'.format(
+                i + 100, os.major(devnum), os.minor(devnum), mountpoint,
+                source)
+            for i, (devnum, (source, mountpoint))
+            in enumerate(sorted(self.mounts.items())))
+
+    def proc_mounts(self):
+        return ''.join('{} {} ext4 rw,relatime 0 0\n'.format(source,
+                                                             mountpoint)
+                       for source, mountpoint in self.mounts.values())
+
+    def read(self, path):
+        path = str(path)
+        if not self.is_virtual(path):
+            return super().read(path)
+
+        with self.lock:
+            if path == '/proc/self/mountinfo':
+                return self.mountinfo()
+            elif path == '/proc/mounts':
+                return self.proc_mounts()
+            elif path == ZRAM_CONTROL + '/hot_add':
+                return '{}\n'.format(self.hot_add())
+
+            dev, rest = self.sysfs(path)
+            text = self.read_attr(dev, rest) if dev and rest else None
+            if text is None:
+                raise _error(errno.ENOENT, path)
+            return text
+
+    def write(self, path, value):
+        path = str(path)
+        if not self.is_virtual(path):
+            return super().write(path, value)
+
+        with self.lock:
+            if path == ZRAM_CONTROL + '/hot_remove':
+                return self.hot_remove(int(value))
+
+            dev, rest = self.sysfs(path)
+            if not isinstance(dev, FakeZram) or len(rest) != 1:
+                raise _error(errno.ENOENT, path)
+            if rest[0] == 'reset' and (
+                    self.holders(dev) or self.devnum(dev) in self.mounts):
+                raise _error(errno.EBUSY, path)
+            try:
+                dev.write(rest[0], '{}'.format(value).strip())
+            except OSError as e:
+                raise _error(e.errno, path)
+
+    def exists(self, path):
+        path = str(path)
+        if not self.is_virtual(path):
+            return super().exists(path)
+
+        with self.lock:
+            if path in ('/proc/self/mountinfo', '/proc/mounts',
+                        '/sys/block', '/sys/dev/block', ZRAM_CONTROL,
+                        ZRAM_CONTROL + '/hot_add',
+                        ZRAM_CONTROL + '/hot_remove'):
+                return True
+            elif path.startswith('/dev/'):
+                return self.device(path) is not None
+
+            dev, rest = self.sysfs(path)
+            if dev is None:
+                return False
+            return not rest or rest in self.directories(dev) or \
+                self.read_attr(dev, rest) is not None
+
+    def is_block_device(self, path):
+        if not self.is_virtual(path):
+            return super().is_block_device(path)
+
+        with self.lock:
+            return self.device(path) is not None
+
+    def listdir(self, path):
+        path = str(path)
+        if not self.is_virtual(path):
+            return super().listdir(path)
+
+        with self.lock:
+            if path == '/sys/block':
+                return [self.block_name(dev) for dev in self.block_devices()]
+            elif path == '/sys/dev/block':
+                return ['{}:{}'.format(os.major(self.devnum(dev)),
+                                       os.minor(self.devnum(dev)))
+                        for dev in self.block_devices()]
+
+            dev, rest = self.sysfs(path)
+            if dev is None or rest not in (('holders',), ('slaves',)):
+                raise _error(errno.ENOENT, path)
+            return getattr(self, rest[0])(dev)
+
+    def readlink(self, path):
+        if not self.is_virtual(path):
+            return super().readlink(path)
+
+        with self.lock:
+            dev, rest = self.sysfs(path)
+            if dev is None or rest:
+                raise _error(errno.ENOENT, path)
+            return '../../devices/virtual/block/{}'.format(
+                self.block_name(dev))
+
+    def realpath(self, path):
+        if not self.is_virtual(path):
+            return super().realpath(path)
+
+        with self.lock:
+            dev = self.device(path)
+            if dev is None:
+                return Path(path)
+            return Path('/dev') / self.block_name(dev)
+
+    def stat(self, path):
+        if not self.is_virtual(path):
+            return super().stat(path)
+
+        with self.lock:
+            dev = self.device(path)
+            if dev is None:
+                raise _error(errno.ENOENT, path)
+            return types.SimpleNamespace(st_mode=stat.S_IFBLK | 0o660,
+                                         st_rdev=self.devnum(dev))
+
+    def device_info(self, path):
+        if not self.is_virtual(path):
+            return super().device_info(path)
+
+        with self.lock:
+            dev = self.device(path)
+            if dev is None:
+                raise _error(errno.ENOENT, path)
+            physical = 4096 if isinstance(dev, FakeZram) else 512
+            logical = dev.block_size if isinstance(dev, FakeLoop) else 512
+            return (self.size_bytes(dev), logical, max(logical, physical),
+                    self.devnum(dev))
+
+    def configure_loop(self, backing_file, offset=0, sizelimit=0,
+                       readonly=False, partscan=False, direct_io=False,
+                       block_size=0):
+        with self.lock:
+            self.loop_ioctls += 1
+            if not self.loop_configure:
+                raise _error(errno.ENOTTY)
+            return self.add_loop(backing_file, offset=offset,
+                                 sizelimit=sizelimit, readonly=readonly,
+                                 direct_io=direct_io,
+                                 block_size=block_size or 512)
+
+    def sync_device(self, fd):
+        if isinstance(fd, FakeZramFile):
+            fd.dev.syncs += 1
+        else:
+            super().sync_device(fd)
+
+    def open_device(self, path, mode='rb'):
+        '''Loop devices read from the start of their backing file, and
+        every other device reads as zeros. zram devices count the bytes
+        written to them, and otherwise throw them away.'''
+
+        if not self.is_virtual(path):
+            return super().open_device(path, mode)
+
+        with self.lock:
+            dev = self.device(path)
+            if dev is None:
+                raise _error(errno.ENOENT, path)
+            elif isinstance(dev, FakeLoop):
+                return open(dev.backing_file, mode)
+            elif isinstance(dev, FakeZram) and mode != 'rb':
+                return FakeZramFile(dev)
+            return open('/dev/zero', 'rb')
+
+    # Commands
+
+    def execute(self, cli, input=None):
+        '''Carry out a command, returning a CompletedProcess.'''
+
+        with self.lock:
+            self.commands[cli[0]] += 1
+            handler = getattr(self, 'cmd_{}'.format(cli[0]), None)
+            if handler is None:
+                return subprocess.CompletedProcess(
+                    cli, 127, b'', '{}: command not found\n'.format(
+                        cli[0]).encode('utf-8'))
+
+            try:
+                stdout = handler(list(cli[1:]), input)
+            except (OSError, DeviceMapperError, ValueError,
+                    IndexError) as e:
+                return subprocess.CompletedProcess(
+                    cli, 1, b'', '{}: {}\n'.format(cli[0], e).encode('utf-8'))
+
+            return subprocess.CompletedProcess(cli, 0,
+                                               stdout.encode('utf-8'), b'')
+
+    def run(self, cli, input=None):
+        p = self.execute(cli, input=input)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cli,
+                                                output=p.stdout,
+                                                stderr=p.stderr)
+        return p
+
+    async def run_async(self, cli, input=None):
+        return self.execute(cli, input=input)
+
+    def cmd_losetup(self, args, input):
+        if args[0] == '-d':
+            for path in args[1:]:
+                dev = self.device(path)
+                if not isinstance(dev, FakeLoop):
+                    raise _error(errno.ENXIO, path)
+                if self.holders(dev) or self.devnum(dev) in self.mounts:
+                    raise _error(errno.EBUSY, path)
+                del self.loops[dev.minor]
+            return ''
+
+        options = {}
+        show = False
+        while len(args) > 1:
+            arg = args.pop(0)
+            if arg in ('--offset', '--sizelimit'):
+                options[arg[2:]] = int(args.pop(0))
+            elif arg == '--sector-size':
+                options['block_size'] = int(args.pop(0))
+            elif arg == '--direct-io=on':
+                options['direct_io'] = True
+            elif arg == '--read-only':
+                options['readonly'] = True
+            elif arg == '--show':
+                show = True
+
+        device = self.add_loop(args[0], **options)
+        return device + '\n' if show else ''
+
+    def add_loop(self, backing_file, **options):
+        backing_file = os.path.realpath(str(backing_file))
+        if not os.path.isfile(backing_file):
+            raise _error(errno.ENOENT, backing_file)
+
+        minor = min(set(range(len(self.loops) + 1)) - set(self.loops))
+        self.loops[minor] = FakeLoop(minor, backing_file, **options)
+        return '/dev/loop{}'.format(minor)
+
+    def cmd_dmsetup(self, args, input):
+        backend = self.ioctl_backend
+        target_type = None
+        if '--target' in args:
+            i = args.index('--target')
+            target_type = args[i + 1]
+            del args[i:i + 2]
+        if '--notable' in args:
+            args.remove('--notable')
+
+        command, args = args[0], args[1:]
+        if command == 'create':
+            backend.create(args[0])
+            if input:
+                backend.load(args[0], input.decode('utf-8'))
+                backend.resume(args[0])
+        elif command in ('remove', 'suspend', 'resume', 'clear'):
+            getattr(backend, command)(args[0])
+        elif command == 'load':
+            backend.load(args[0], input.decode('utf-8'))
+        elif command == 'message':
+            return backend.message(args[0], args[1], ' '.join(args[2:]))
+        elif command in ('table', 'status') and args:
+            return getattr(backend, command)(args[0]) + '\n'
+        elif command in ('table', 'status'):
+            tables = getattr(backend, command + '_all')(target_type)
+            lines = []
+            for name, table in sorted(tables.items()):
+                lines.extend('{}: {}'.format(name, segment)
+                             for segment in table.splitlines() or [''])
+            return '\n'.join(lines or ['No devices found']) + '\n'
+        elif command == 'ls':
+            names = backend.list_devices(target_type)
+            devices = backend.devices()
+            lines = ['{}\t({})'.format(name, devices[name])
+                     for name in sorted(names)]
+            return '\n'.join(lines or ['No devices found']) + '\n'
+        else:
+            raise ValueError('unknown command {}'.format(command))
+
+        return ''
+
+    def cmd_umount(self, args, input):
+        dev = self.device(args[-1])
+        if dev is None or self.devnum(dev) not in self.mounts:
+            raise _error(errno.EINVAL, args[-1])
+        del self.mounts[self.devnum(dev)]
+        return ''
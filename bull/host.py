@@ -0,0 +1,202 @@
+'''Reach the parts of the host that bull reads and writes.
+
+Apart from device-mapper ioctls (see bull.dmioctl), everything bull
+learns about the host comes from files under /sys, /proc and /dev,
+block device ioctls and the commands it runs, and everything it keeps
+lives under /run/bull. All of that goes through the Host returned by
+get_host(), so that a simulated kernel (bull.fake.FakeKernel) can
+stand in for the real one.
+'''
+
+import asyncio
+import errno
+import fcntl
+import os
+from pathlib import Path
+import stat
+import struct
+import subprocess
+
+RUN_DIR = Path('/run/bull')
+
+# from linux/fs.h
+BLKSSZGET = 0x1268
+BLKPBSZGET = 0x127b
+BLKGETSIZE64 = 0x80081272
+
+# from linux/loop.h
+LOOP_CONFIGURE = 0x4c0a
+LOOP_CTL_GET_FREE = 0x4c82
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_PARTSCAN = 8
+LO_FLAGS_DIRECT_IO = 16
+LO_NAME_SIZE = 64
+LOOP_CONFIG = struct.Struct('=II' + 'QQQQQIIII{0}s{0}s32sQQ'.format(
+    LO_NAME_SIZE) + '8Q')
+LOOP_CONFIGURE_ATTEMPTS = 8
+
+
+def _ioctl_int(fd, request, fmt):
+    buf = bytearray(struct.calcsize(fmt))
+    fcntl.ioctl(fd, request, buf, True)
+    return struct.unpack(fmt, buf)[0]
+
+
+class Host():
+    '''The real host.'''
+
+    run_dir = RUN_DIR
+
+    def run_path(self, path):
+        '''Return where a file bull keeps under RUN_DIR lives on this
+        host. Other paths are returned unchanged.'''
+
+        path = Path(path)
+        try:
+            return self.run_dir / path.relative_to(RUN_DIR)
+        except ValueError:
+            return path
+
+    def read(self, path):
+        with open(str(path)) as fd:
+            return fd.read()
+
+    def write(self, path, value):
+        with open(str(path), 'w') as fd:
+            fd.write('{}'.format(value))
+
+    def exists(self, path):
+        return os.path.exists(str(path))
+
+    def is_block_device(self, path):
+        return Path(path).is_block_device()
+
+    def listdir(self, path):
+        return os.listdir(str(path))
+
+    def readlink(self, path):
+        return os.readlink(str(path))
+
+    def realpath(self, path):
+        return Path(path).resolve()
+
+    def stat(self, path):
+        return os.stat(str(path))
+
+    def device_info(self, path):
+        '''Return the size in bytes, logical and physical sector sizes and
+        device number of path.
+
+        Regular files are described using stat alone, and have no
+        sector sizes or device number.
+        '''
+
+        st = self.stat(path)
+        if not stat.S_ISBLK(st.st_mode):
+            return st.st_size, None, None, None
+
+        fd = os.open(str(path), os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            return (_ioctl_int(fd, BLKGETSIZE64, '=Q'),
+                    _ioctl_int(fd, BLKSSZGET, '=i'),
+                    _ioctl_int(fd, BLKPBSZGET, '=I'),
+                    st.st_rdev)
+        finally:
+            os.close(fd)
+
+    def configure_loop(self, backing_file, offset=0, sizelimit=0,
+                       readonly=False, partscan=False, direct_io=False,
+                       block_size=0):
+        '''Bind backing_file to a free loop device with a single
+        LOOP_CONFIGURE ioctl and return the device path.
+
+        LOOP_CONFIGURE appeared in Linux 5.8; older kernels fail with
+        ENOTTY or EINVAL.
+        '''
+
+        flags = 0
+        for flag, wanted in ((LO_FLAGS_READ_ONLY, readonly),
+                             (LO_FLAGS_PARTSCAN, partscan),
+                             (LO_FLAGS_DIRECT_IO, direct_io)):
+            if wanted:
+                flags |= flag
+        mode = (os.O_RDONLY if readonly else os.O_RDWR) | os.O_CLOEXEC
+        name = os.fsencode(str(backing_file))[:LO_NAME_SIZE - 1]
+
+        backing = os.open(str(backing_file), mode)
+        try:
+            control = os.open('/dev/loop-control', os.O_RDWR | os.O_CLOEXEC)
+            try:
+                for attempt in range(LOOP_CONFIGURE_ATTEMPTS):
+                    path = '/dev/loop{}'.format(
+                        fcntl.ioctl(control, LOOP_CTL_GET_FREE))
+                    config = LOOP_CONFIG.pack(
+                        backing, block_size, 0, 0, 0, offset, sizelimit, 0,
+                        0, 0, flags, name, b'', b'', 0, 0, *[0] * 8)
+
+                    fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+                    try:
+                        fcntl.ioctl(fd, LOOP_CONFIGURE, config)
+                        return path
+                    except OSError as e:
+                        # Someone else bound it first.
+                        if e.errno != errno.EBUSY:
+                            raise
+                    finally:
+                        os.close(fd)
+            finally:
+                os.close(control)
+        finally:
+            os.close(backing)
+
+        raise OSError(errno.EBUSY, 'no free loop device')
+
+    def open_device(self, path, mode='rb'):
+        '''Open a device or image file for reading (or, with mode 'r+b',
+        writing) raw data.'''
+
+        return open(str(path), mode)
+
+    def sync_device(self, fd):
+        '''Flush what was written to a device opened with open_device
+        out of the page cache.'''
+
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    def run(self, cli, input=None):
+        return subprocess.run(cli,
+                              check=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              input=input)
+
+    async def run_async(self, cli, input=None):
+        '''Run a command without blocking the event loop. Unlike run, a
+        nonzero exit code is not an error here.'''
+
+        proc = await asyncio.create_subprocess_exec(
+            *cli,
+            stdin=asyncio.subprocess.PIPE if input is not None else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate(input)
+        return subprocess.CompletedProcess(cli, proc.returncode, stdout,
+                                           stderr)
+
+
+_host = None
+
+
+def get_host():
+    global _host
+
+    if _host is None:
+        _host = Host()
+
+    return _host
+
+
+def set_host(host):
+    global _host
+    _host = host
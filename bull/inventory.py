@@ -0,0 +1,161 @@
+'''The host's block devices, as seen in one scan.
+
+Working out whether a device is mounted, what it is called in /sys,
+or what is stacked on it normally means re-reading /proc and /sys each
+time the question is asked. An Inventory reads /sys/dev/block (and
+the device-mapper names under it) and /proc/self/mountinfo once and
+answers from memory, by device number, so that a device is found
+whichever of its names (/dev/mapper/bull0, /dev/dm-5, 253:5) it is
+asked about. Holders and slaves are read the first time they are
+wanted for each device.
+
+Nothing is re-read until refresh() is called, so an Inventory should
+be refreshed (or replaced) once the devices it describes have changed.
+'''
+
+import attr
+import logging
+import os
+from pathlib import Path
+
+from bull.host import get_host
+
+LOG = logging.getLogger(__name__)
+SYS_DEV_BLOCK = Path('/sys/dev/block')
+
+
+@attr.s
+class DeviceEntry():
+    '''One block device.'''
+
+    devnum = attr.ib()
+    name = attr.ib()
+    dm_name = attr.ib(default=None)
+
+    @property
+    def path(self):
+        if self.dm_name is not None:
+            return '/dev/mapper/{}'.format(self.dm_name)
+        return '/dev/{}'.format(self.name)
+
+    @property
+    def major(self):
+        return int(self.devnum.split(':')[0])
+
+    @property
+    def minor(self):
+        return int(self.devnum.split(':')[1])
+
+
+class Inventory():
+    '''Block devices and mounts, indexed by 'major:minor'.'''
+
+    def __init__(self):
+        self.refresh()
+
+    def refresh(self):
+        '''Scan the host again.'''
+
+        host = get_host()
+        self.devices = {}
+        self.names = {}
+        self.dm_names = {}
+        self.mounts = {}
+        self._holders = {}
+        self._slaves = {}
+
+        for devnum in host.listdir(SYS_DEV_BLOCK):
+            try:
+                name = os.path.basename(host.readlink(SYS_DEV_BLOCK / devnum))
+            except FileNotFoundError:
+                continue
+
+            dm_name = None
+            if name.startswith('dm-'):
+                try:
+                    dm_name = host.read(
+                        SYS_DEV_BLOCK / devnum / 'dm' / 'name').strip()
+                except FileNotFoundError:
+                    pass
+
+            entry = DeviceEntry(devnum, name, dm_name)
+            self.devices[devnum] = entry
+            self.names[name] = devnum
+            if dm_name is not None:
+                self.dm_names[dm_name] = devnum
+
+        for line in host.read('/proc/self/mountinfo').splitlines():
+            fields = line.split()
+            self.mounts.setdefault(fields[2], []).append(fields[4])
+
+        LOG.debug('found %d block devices and %d mounted', len(self.devices),
+                  len(self.mounts))
+
+    def devnum(self, device):
+        '''Return the 'major:minor' of a /dev path, kernel name (like
+        dm-5) or 'major:minor', or None if there is no such device.'''
+
+        device = str(device)
+        if device in self.devices:
+            return device
+        elif device.startswith('/dev/mapper/'):
+            return self.dm_names.get(device[len('/dev/mapper/'):])
+        elif '/' not in device:
+            return self.names.get(device)
+        elif os.path.dirname(device) == '/dev':
+            return self.names.get(os.path.basename(device))
+
+        # Something like /dev/disk/by-id/..., or /dev/vg/lv.
+        try:
+            return self.names.get(get_host().realpath(device).name)
+        except OSError:
+            return None
+
+    def lookup(self, device):
+        '''Return the DeviceEntry for device, or None.'''
+
+        return self.devices.get(self.devnum(device))
+
+    def exists(self, device):
+        return self.devnum(device) is not None
+
+    def path(self, device):
+        '''Return the preferred /dev path of device, or None.'''
+
+        entry = self.lookup(device)
+        return entry.path if entry is not None else None
+
+    def mountpoints(self, device):
+        return list(self.mounts.get(self.devnum(device), []))
+
+    def mountpoint(self, device):
+        mountpoints = self.mountpoints(device)
+        return mountpoints[0] if mountpoints else None
+
+    def is_mounted(self, device):
+        return bool(self.mountpoints(device))
+
+    def _related(self, cache, kind, device):
+        devnum = self.devnum(device)
+        if devnum is None:
+            return []
+
+        if devnum not in cache:
+            try:
+                names = get_host().listdir(SYS_DEV_BLOCK / devnum / kind)
+            except FileNotFoundError:
+                names = []
+            cache[devnum] = [self.devices[self.names[name]] for name in names
+                             if name in self.names]
+
+        return cache[devnum]
+
+    def holders(self, device):
+        '''Return DeviceEntries for the devices stacked on device.'''
+
+        return self._related(self._holders, 'holders', device)
+
+    def slaves(self, device):
+        '''Return DeviceEntries for the devices device is stacked on.'''
+
+        return self._related(self._slaves, 'slaves', device)
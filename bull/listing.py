@@ -0,0 +1,213 @@
+'''Describe every bull snapshot in one pass.
+
+Rather than asking the kernel about each snapshot in turn,
+list_snapshots reads every device-mapper table and status once, takes
+one Inventory of the block devices and mounts, and reads each zram
+device's statistics once, then puts the pieces together.
+'''
+
+import attr
+import logging
+from pathlib import Path
+
+from bull import mapper
+from bull import zram
+from bull.host import get_host
+from bull.inventory import Inventory
+
+LOG = logging.getLogger(__name__)
+
+
+@attr.s
+class SnapshotInfo():
+    '''Everything we know about one snapshot.
+
+    Sizes are in bytes. For classic snapshots, allocated and total
+    describe the exception store; for thin volumes they are the bytes
+    mapped by the volume and the size of the pool's data device.
+    spilled is what the zram devices have written back to a spill
+    device and still hold there, and spill_reads and spill_writes the
+    bytes read from and written to it (see bull.spill).
+    '''
+
+    name = attr.ib()
+    device = attr.ib()
+    engine = attr.ib()
+    size = attr.ib()
+    source = attr.ib(default=None)
+    source_file = attr.ib(default=None)
+    offset = attr.ib(default=0)
+    base = attr.ib(default=None)
+    backing = attr.ib(default=None)
+    backing_devices = attr.ib(default=attr.Factory(list))
+    allocated = attr.ib(default=None)
+    total = attr.ib(default=None)
+    state = attr.ib(default='valid')
+    orig_data_size = attr.ib(default=None)
+    compr_data_size = attr.ib(default=None)
+    mem_used_max = attr.ib(default=None)
+    spilled = attr.ib(default=None)
+    spill_reads = attr.ib(default=None)
+    spill_writes = attr.ib(default=None)
+    mountpoint = attr.ib(default=None)
+
+    def to_dict(self):
+        return attr.asdict(self)
+
+
+class DeviceSweep():
+    '''Resolve devices using tables gathered up front.'''
+
+    def __init__(self, backend=None, inventory=None):
+        backend = backend or mapper.get_backend()
+        self.devices = backend.devices()
+        self.tables = {name: mapper.Table.from_string(table)
+                       for name, table in backend.table_all().items()}
+        self.status = backend.status_all()
+        self.inventory = inventory or Inventory()
+        self.dm_names = {dev: '/dev/mapper/{}'.format(name)
+                         for name, dev in self.devices.items()}
+        self.zram_stats = {}
+        self.bd_stats = {}
+
+    def resolve(self, ref):
+        if ref is None or ref.startswith('/dev'):
+            return ref
+        return self.dm_names.get(ref) or self.inventory.path(ref) or ref
+
+    def table_of(self, device):
+        device = self.resolve(device)
+        if device is None or not device.startswith('/dev/mapper/'):
+            return None
+        return self.tables.get(Path(device).name)
+
+    def zram_devices(self, device):
+        '''Return the zram devices behind a (possibly growable) COW
+        device or thin pool data device.'''
+
+        table = self.table_of(device)
+        if table is None:
+            return [self.resolve(device)]
+
+        return [self.resolve(segment.target.device) for segment in table
+                if isinstance(segment.target, mapper.Linear)]
+
+    def mm_stat(self, device):
+        if device not in self.zram_stats:
+            try:
+                self.zram_stats[device] = zram.ZramDevice(device).mm_stat()
+            except OSError as e:
+                LOG.debug('no zram statistics for %s: %s', device, e)
+                self.zram_stats[device] = None
+
+        return self.zram_stats[device]
+
+    def bd_stat(self, device):
+        '''Return the BDStat of a zram device that has a spill device,
+        or None.'''
+
+        if device not in self.bd_stats:
+            self.bd_stats[device] = None
+            try:
+                backing = zram.ZramDevice(device)
+                if backing.backing_dev is not None:
+                    self.bd_stats[device] = backing.bd_stat()
+            except OSError as e:
+                LOG.debug('no writeback statistics for %s: %s', device, e)
+
+        return self.bd_stats[device]
+
+    def source_of(self, info, origin):
+        info.base = self.resolve(origin)
+        table = self.table_of(origin)
+        if not table or not isinstance(table[0].target, mapper.Linear):
+            return
+
+        info.source = self.resolve(table[0].target.device)
+        info.offset = table[0].target.offset * 512
+
+        if info.source.startswith('/dev/loop'):
+            path = Path('/sys/block') / Path(info.source).name / 'loop'
+            try:
+                info.source_file = get_host().read(
+                    path / 'backing_file').strip()
+            except OSError:
+                pass
+
+    def describe(self, name):
+        table = self.tables.get(name)
+        if not table:
+            return None
+
+        segment = table[0]
+        target = segment.target
+        status = self.status.get(name, '').split()
+
+        if isinstance(target, mapper.Snapshot):
+            info = SnapshotInfo(name, '/dev/mapper/{}'.format(name),
+                                'snapshot', segment.sectors * 512)
+            info.backing = self.resolve(target.backing)
+            info.backing_devices = self.zram_devices(target.backing)
+
+            if len(status) > 3 and '/' in status[3]:
+                # The allocated sectors include the metadata.
+                allocated, total = status[3].split('/')
+                info.allocated = int(allocated) * 512
+                info.total = int(total) * 512
+            elif len(status) > 3:
+                info.state = ' '.join(status[3:])
+        elif isinstance(target, mapper.Thin):
+            info = SnapshotInfo(name, '/dev/mapper/{}'.format(name),
+                                'thin', segment.sectors * 512)
+            info.backing = self.resolve(target.pool_dev)
+            pool = self.table_of(target.pool_dev)
+
+            if pool:
+                info.backing_devices = self.zram_devices(
+                    pool[0].target.data_dev)
+                info.total = pool[0].sectors * 512
+            if len(status) > 3 and status[3].isdigit():
+                info.allocated = int(status[3]) * 512
+            elif len(status) > 3:
+                info.state = ' '.join(status[3:])
+        else:
+            return None
+
+        self.source_of(info, target.origin)
+
+        stats = [self.mm_stat(device) for device in info.backing_devices]
+        stats = [stat for stat in stats if stat is not None]
+        if stats:
+            stat = zram.sum_mm_stats(stats)
+            info.orig_data_size = stat.orig_data_size
+            info.compr_data_size = stat.compr_data_size
+            info.mem_used_max = stat.mem_used_max
+
+        stats = [self.bd_stat(device) for device in info.backing_devices]
+        stats = [stat for stat in stats if stat is not None]
+        if stats:
+            stat = zram.sum_bd_stats(stats)
+            info.spilled = stat.bd_count * zram.PAGE_SIZE
+            info.spill_reads = stat.bd_reads * zram.PAGE_SIZE
+            info.spill_writes = stat.bd_writes * zram.PAGE_SIZE
+
+        if name in self.devices:
+            info.mountpoint = self.inventory.mountpoint(self.devices[name])
+        return info
+
+
+def list_snapshots(prefix=None, backend=None, inventory=None):
+    '''Return a SnapshotInfo for every snapshot and thin volume.'''
+
+    sweep = DeviceSweep(backend=backend, inventory=inventory)
+    snapshots = []
+
+    for name in sorted(sweep.tables):
+        if prefix is not None and not name.startswith(prefix):
+            continue
+
+        info = sweep.describe(name)
+        if info is not None:
+            snapshots.append(info)
+
+    return snapshots
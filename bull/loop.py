@@ -1,10 +1,20 @@
 import functools
 import logging
+from pathlib import Path
+import threading
 
+from bull import timing
 from bull.blockdev import BlockDevice
-from bull.common import run_command
+from bull.common import lock_file, run_command
+from bull.host import RUN_DIR, get_host
 
 LOG = logging.getLogger(__name__)
+LOOP_LOCK = RUN_DIR / 'loop.lock'
+SYS_BLOCK = Path('/sys/block')
+
+# losetup --find picks the first free loop device and then binds it,
+# so two of them running at once can pick the same one.
+_create_lock = threading.Lock()
 
 
 losetup = functools.partial(run_command, 'losetup')
@@ -15,21 +25,26 @@ class LoopDevice(BlockDevice):
 
     @property
     def backing_file(self):
-        with (self.sysfs / 'loop' / 'backing_file').open() as fd:
-            backing_file = fd.read().strip()
-
-        return backing_file
+        return get_host().read(self.sysfs / 'loop' / 'backing_file').strip()
 
     @property
     def offset(self):
-        with (self.sysfs / 'loop' / 'offset').open() as fd:
-            offset = fd.read().strip()
+        return get_host().read(self.sysfs / 'loop' / 'offset').strip()
+
+    @property
+    def sizelimit(self):
+        return get_host().read(self.sysfs / 'loop' / 'sizelimit').strip()
 
-        return offset
+    @property
+    def direct_io(self):
+        return get_host().read(self.sysfs / 'loop' / 'dio').strip() == '1'
+
+    @staticmethod
+    def create_args(backing_file, offset=None, partscan=False,
+                    readonly=False, sizelimit=None, direct_io=False,
+                    block_size=None):
+        '''Return the losetup arguments that create a loop device.'''
 
-    @classmethod
-    def create(kls, backing_file, offset=None, partscan=False,
-               readonly=False, sizelimit=None):
         cli = ['--find', '--show']
 
         if offset is not None:
@@ -46,17 +61,152 @@ class LoopDevice(BlockDevice):
             cli.append('--sizelimit')
             cli.append(str(sizelimit))
 
+        if direct_io:
+            cli.append('--direct-io=on')
+
+        if block_size is not None:
+            cli.append('--sector-size')
+            cli.append(str(block_size))
+
         cli.append(str(backing_file))
+        return cli
+
+    @classmethod
+    def create(kls, backing_file, **kwargs):
+        with _create_lock, lock_file(LOOP_LOCK):
+            return kls._create(backing_file, **kwargs)
 
-        p = losetup(*cli)
+    @classmethod
+    def _create(kls, backing_file, **kwargs):
+        p = losetup(*kls.create_args(backing_file, **kwargs))
         device = p.stdout.decode('ascii').strip()
 
         LOG.debug('created loop device %s', device)
         return kls(device)
 
+    @classmethod
+    def attach(kls, backing_file, offset=None, sizelimit=None,
+               readonly=False, direct_io=False, block_size=None,
+               share=True):
+        '''Return a loop device for backing_file.
+
+        With share, reuse a loop device that another bull snapshot has
+        already set up for the same file with the same options (see
+        find_shared), so that the file's pages are only cached once.
+        Otherwise bind a free loop device with LOOP_CONFIGURE, or with
+        losetup if the kernel does not support it.
+        '''
+
+        options = dict(offset=offset, sizelimit=sizelimit,
+                       readonly=readonly, direct_io=direct_io,
+                       block_size=block_size)
+
+        with _create_lock, lock_file(LOOP_LOCK):
+            if share:
+                shared = kls.find_shared(backing_file, **options)
+                if shared is not None:
+                    LOG.debug('sharing loop device %s', shared.device)
+                    return shared
+
+            try:
+                with timing.timed('loop configure'):
+                    device = get_host().configure_loop(
+                        backing_file, offset=offset or 0,
+                        sizelimit=sizelimit or 0, readonly=readonly,
+                        direct_io=direct_io, block_size=block_size or 0)
+            except OSError as e:
+                LOG.debug('cannot configure loop device (%s), '
+                          'using losetup', e)
+                return kls._create(backing_file, **options)
+
+        LOG.debug('created loop device %s', device)
+        return kls(device)
+
+    @classmethod
+    def find_shared(kls, backing_file, offset=None, sizelimit=None,
+                    readonly=False, direct_io=False, block_size=None):
+        '''Return a loop device bound to backing_file with these options
+        that the base device of a bull snapshot is using, or None.
+
+        Loop devices that bull did not set up are never shared, as
+        whoever did may detach them or write through them.
+        '''
+
+        host = get_host()
+        backing_file = str(host.realpath(backing_file))
+        wanted = {
+            'backing_file': backing_file,
+            'offset': str(offset or 0),
+            'sizelimit': str(sizelimit or 0),
+            'ro': str(int(readonly)),
+            'dio': str(int(direct_io)),
+            'logical_block_size': str(block_size or 512),
+        }
+
+        for name in sorted(host.listdir(SYS_BLOCK)):
+            if not name.startswith('loop'):
+                continue
+
+            sysfs = SYS_BLOCK / name
+            try:
+                found = {
+                    'backing_file': host.read(
+                        sysfs / 'loop' / 'backing_file').strip(),
+                    'offset': host.read(sysfs / 'loop' / 'offset').strip(),
+                    'sizelimit': host.read(
+                        sysfs / 'loop' / 'sizelimit').strip(),
+                    'ro': host.read(sysfs / 'ro').strip(),
+                    'dio': host.read(sysfs / 'loop' / 'dio').strip(),
+                    'logical_block_size': host.read(
+                        sysfs / 'queue' / 'logical_block_size').strip(),
+                }
+            except FileNotFoundError:
+                # Not bound to anything, or gone since we listed it.
+                continue
+
+            if found == wanted and kls.held_by_base(name):
+                return kls('/dev/{}'.format(name))
+
+    @staticmethod
+    def held_by_base(name):
+        '''Whether a bull base device is stacked on the loop device
+        called name.'''
+
+        host = get_host()
+        try:
+            holders = host.listdir(SYS_BLOCK / name / 'holders')
+        except FileNotFoundError:
+            return False
+
+        for holder in holders:
+            try:
+                dm_name = host.read(SYS_BLOCK / holder / 'dm' / 'name')
+            except FileNotFoundError:
+                continue
+            if dm_name.strip().endswith('-base'):
+                return True
+
+        return False
+
     def remove(self):
         LOG.debug('removing loop device %s', self.device.name)
         losetup('-d', str(self.device))
 
+    def release(self):
+        '''Detach a loop device that may be shared (see attach), unless
+        it is gone or a device is still stacked on it. Returns whether
+        it was detached.
+
+        This holds LOOP_LOCK, so that attach cannot hand the device out
+        between the check and the detach.
+        '''
+
+        with _create_lock, lock_file(LOOP_LOCK):
+            if not self.exists() or self.holders():
+                return False
+            self.remove()
+            return True
+
     def exists(self):
-        return super().exists() and (self.sysfs / 'loop').exists()
+        return super().exists() and \
+            get_host().exists(self.sysfs / 'loop')
@@ -1,16 +1,26 @@
 import click
+import json
 import logging
 from pathlib import Path
+import signal
 import subprocess
 import sys
 
-from bull import blockdev
-from bull import loop
+from bull import api
+from bull import budget as snapbudget
+from bull import dmioctl
+from bull import listing
 from bull import mapper
+from bull import metrics as snapmetrics
+from bull import pool as snappool
+from bull import registry as snapregistry
+from bull import timing
+from bull import watch as snapwatch
 from bull import zram
+from bull.exceptions import BullError, NoSuchDevice
+from bull.inventory import Inventory
 
 LOG = logging.getLogger(__name__)
-MAX_BACKING_SIZE = 2**30
 
 
 class Size(click.ParamType):
@@ -36,102 +46,335 @@ class Size(click.ParamType):
             raise ValueError(value)
 
 
+class Partitions(click.ParamType):
+    '''A partition number, a comma-separated list of them or "all".'''
+
+    name = 'partitions'
+
+    def convert(self, value, param, ctx):
+        if value == 'all' or not isinstance(value, str):
+            return value
+
+        try:
+            numbers = [int(number) for number in str(value).split(',')]
+        except ValueError:
+            self.fail('{} is not a partition number, a list of them or '
+                      '"all"'.format(value), param, ctx)
+
+        return numbers[0] if len(numbers) == 1 else numbers
+
+
+def zram_options(func):
+    '''Add options controlling the zram backing store to a command.'''
+
+    for option in reversed([
+            click.option('--comp-algorithm', '-C',
+                         help='zram compression algorithm (e.g. lz4, zstd)'),
+            click.option('--streams', type=click.IntRange(min=1),
+                         help='maximum number of compression streams'),
+            click.option('--mem-limit', type=Size(),
+                         help='limit on memory used by each zram device'),
+    ]):
+        func = option(func)
+
+    return func
+
+
+def get_zram_options(comp_algorithm=None, streams=None, mem_limit=None):
+    return {'comp_algorithm': comp_algorithm,
+            'max_comp_streams': streams,
+            'mem_limit': mem_limit}
+
+
+def fail(e):
+    '''Log a failed command or device operation and exit.'''
+
+    if isinstance(e, subprocess.CalledProcessError):
+        LOG.error('%s: %s', e, e.stderr.decode('utf-8'))
+    else:
+        LOG.error('%s', e)
+    sys.exit(1)
+
+
 @click.group()
 @click.option('--quiet', '-q', 'loglevel', flag_value='WARNING',
               default=True)
 @click.option('--verbose', '-v', 'loglevel', flag_value='INFO')
 @click.option('--debug', '-d', 'loglevel', flag_value='DEBUG')
-def cli(loglevel=None):
+@click.option('--dm-backend', type=click.Choice(['auto', 'ioctl', 'dmsetup']),
+              default='auto')
+@click.option('--timings', is_flag=True,
+              help='print how long each step took on stderr')
+@click.option('--trace', type=click.Path(dir_okay=False),
+              help='write a Chrome trace of each step to this file')
+@click.option('--max-ram', type=Size(), envvar='BULL_MAX_RAM',
+              help='most RAM the ramdisks of all bull snapshots may take '
+              '(default: $BULL_MAX_RAM, or no limit)')
+@click.pass_context
+def cli(ctx, loglevel=None, dm_backend=None, timings=False, trace=None,
+        max_ram=None):
     logging.basicConfig(level=loglevel)
+    snapbudget.set_max_ram(max_ram)
+
+    if dm_backend == 'ioctl':
+        mapper.set_backend(dmioctl.IoctlBackend())
+    elif dm_backend == 'dmsetup':
+        mapper.set_backend(mapper.DmsetupBackend())
+
+    ctx.call_on_close(lambda: report_timings(timings, trace))
+
+
+def report_timings(timings=False, trace=None):
+    '''Report the steps timed while running a command, and add them to
+    the latency histograms exported by bull metrics.'''
+
+    events = timing.get_recorder().take()
+    if not events:
+        return
+
+    if timings:
+        print(timing.format_summary(events), file=sys.stderr)
+
+    if trace:
+        with open(trace, 'w') as fd:
+            json.dump(timing.trace(events), fd)
+
+    try:
+        snapmetrics.LatencyHistograms().add(events)
+    except OSError as e:
+        LOG.debug('unable to record latencies: %s', e)
 
 
 @cli.command()
-@click.option('--part', '-p', type=Size())
+@click.option('--part', '-p', type=Partitions(),
+              help='snapshot this partition, these partitions (e.g. 1,2) '
+              'or "all" of them')
+@click.option('--whole-disk', is_flag=True,
+              help='with several partitions, snapshot the whole disk and '
+              'map the partitions onto it')
 @click.option('--offset', '-o', type=Size(), default=0)
 @click.option('--backing-size', '-b', type=Size())
 @click.option('--snap-size', '-s', type=Size())
 @click.option('--name', '-n')
-@click.argument('src')
-def create(src, part=None, offset=None, snap_size=None,
-           backing_size=None, name=None):
+@click.option('--prefix', '-P', default='bull',
+              help='name snapshots <prefix><n> when --name is not given')
+@click.option('--count', '-c', type=click.IntRange(min=1), default=1)
+@click.option('--engine', '-e', type=click.Choice(api.ENGINES),
+              default='snapshot')
+@click.option('--direct-io', is_flag=True,
+              help='read an image source with direct I/O, bypassing the '
+              'page cache')
+@click.option('--block-size', type=Size(),
+              help='logical block size of the loop device for an image '
+              'source (512 to 4096)')
+@click.option('--preload', is_flag=True,
+              help='copy the source into a compressed ramdisk first')
+@click.option('--persistent', is_flag=True,
+              help='use a persistent exception store, so that the snapshot '
+              'can be merged back with "bull commit"')
+@click.option('--backing-file', type=click.Path(dir_okay=False),
+              help='keep the snapshot in a persistent store in this file')
+@click.option('--backing-dev', type=click.Path(dir_okay=False),
+              help='keep the snapshot in a persistent store on this '
+              'device, overwriting it')
+@click.option('--spill-to', type=click.Path(dir_okay=False),
+              help='let idle pages be written from RAM to this file or '
+              'device (see "bull watch --spill-every")')
+@click.option('--wait', type=float, default=0,
+              help='with --max-ram, wait this many seconds for RAM to be '
+              'free rather than failing at once')
+@click.option('--stripe-size', type=Size(),
+              help='with several sources, stripe across them in chunks of '
+              'this size rather than putting them one after the other')
+@zram_options
+@click.argument('src', nargs=-1, required=True)
+def create(src, part=None, whole_disk=False, offset=None, snap_size=None,
+           backing_size=None, name=None, prefix=None, count=None,
+           engine=None, direct_io=False, block_size=None, preload=False,
+           persistent=False, backing_file=None, backing_dev=None,
+           spill_to=None, wait=0, stripe_size=None, comp_algorithm=None,
+           streams=None, mem_limit=None):
 
     '''Create a snapshot of the given source.
 
     Create a copy-on-write snapshot of the given source, using a ramdisk as the
     snapshot backing store.  If the source is not a block device, first map it
-    onto a loop device.
+    onto a loop device. With --count, create several snapshots that share a
+    single loop device and base device. Snapshots of the same image made by
+    separate commands share a loop device too, as long as they ask for the
+    same --direct-io and --block-size.
+
+    With --preload, the source is first copied into a compressed ramdisk,
+    which is shared by every snapshot of the same part of the source, so
+    that reads never go to slow storage.
+
+    With --engine thin, the snapshots are thin volumes in a ramdisk-backed
+    thin pool that use the source as an external origin.
+
+    With --backing-file or --backing-dev, the snapshot is stored on disk
+    rather than in a ramdisk, so it can be bigger than RAM, and survives a
+    reboot: bring it back with "bull attach". --backing-size sets the size
+    of a new backing file (by default, the size of the snapshot).
+
+    With --spill-to, each snapshot's ramdisk gets a slice of a file or device
+    that "bull watch" can write pages nobody has touched in a while back to,
+    freeing the RAM they used. A new file is --backing-size bytes per
+    snapshot.
+
+    With --part all or a list of partitions like --part 1,2, the partition
+    table is read once and one loop device serves every partition, each of
+    which gets a snapshot (named <name>p<N>, with --name) with a ramdisk
+    sized for it. With --whole-disk as well, there is a single snapshot of
+    the whole disk instead, with each partition mapped onto it as
+    <snapshot>p<N>.
+
+    With "bull --max-ram SIZE create ...", the snapshots are only created if
+    their ramdisks fit in what the ramdisks of other bull snapshots have left
+    of SIZE; each ramdisk is given a --mem-limit of its size unless one is
+    set. --wait queues the create until there is room.
+
+    Given several sources, the snapshot is of all of them put one after the
+    other, or with --stripe-size, striped across them in chunks of that size
+    (each is then cut down to the size of the smallest). --part and --offset
+    apply to each source.
     '''
 
-    if not zram.check_zram_available():
+    on_disk = backing_file or backing_dev
+    if (preload or not on_disk) and not zram.check_zram_available():
         raise click.ClickException('ZRAM module is not available')
 
-    src = Path(src)
+    zram_opts = get_zram_options(comp_algorithm, streams, mem_limit)
+    several = part is not None and not isinstance(part, int)
+    if len(src) > 1 and (several or preload or on_disk):
+        raise click.UsageError('several sources cannot be combined with '
+                               'several partitions, --preload, '
+                               '--backing-file or --backing-dev')
+    elif stripe_size and len(src) == 1:
+        raise click.UsageError('--stripe-size needs several sources')
+    elif stripe_size is not None and (stripe_size <= 0 or stripe_size % 4096):
+        raise click.UsageError('--stripe-size must be a multiple of 4K')
+    src = src[0] if len(src) == 1 else list(src)
+
+    if whole_disk and not several:
+        raise click.UsageError('--whole-disk needs --part all or a list of '
+                               'partitions')
+    elif several and (count > 1 or offset):
+        raise click.UsageError('several partitions cannot be combined with '
+                               '--count or --offset')
+    elif several and not whole_disk and any([
+            snap_size, preload, on_disk, spill_to, engine != 'snapshot']):
+        raise click.UsageError(
+            'a snapshot of each of several partitions cannot be combined '
+            'with --snap-size, --preload, --backing-file, --backing-dev, '
+            '--spill-to or --engine thin')
 
-    if not src.is_block_device():
-        loopdev = loop.LoopDevice.create(src)
-        LOG.info('mapped %s to %s', src, loopdev.device)
-        src = loopdev
-    else:
-        src = blockdev.BlockDevice(src)
+    try:
+        if several and not whole_disk:
+            snaps = api.create_partition_snapshots(
+                src, parts=part, backing_size=backing_size, name=name,
+                prefix=prefix, direct_io=direct_io, block_size=block_size,
+                persistent=persistent, wait=wait, zram_options=zram_opts,
+                inventory=Inventory())
+        else:
+            kwargs = dict(
+                snap_size=snap_size, backing_size=backing_size, name=name,
+                prefix=prefix, engine=engine, direct_io=direct_io,
+                block_size=block_size, preload=preload,
+                persistent=persistent, backing_file=backing_file,
+                backing_dev=backing_dev, spill_to=spill_to, wait=wait,
+                on_preload=lambda stats: print('preloaded', src, stats,
+                                               file=sys.stderr),
+                zram_options=zram_opts, inventory=Inventory())
+            if whole_disk:
+                snap, views = api.create_disk_snapshot(src, parts=part,
+                                                       **kwargs)
+                snaps = [snap] + views
+            else:
+                snaps = api.create_snapshots(src, count=count, part=part,
+                                             offset=offset,
+                                             stripe_size=stripe_size,
+                                             **kwargs)
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
+
+    for snap in snaps:
+        print('created', snap.device)
 
-    if part is not None:
-        offset = src.get_part_offset_sectors(part)
-        data_sectors = src.get_part_size_sectors(part)
-    else:
-        data_sectors = src.get_size_sectors() - offset
 
-    data_size = data_sectors * 512
+@cli.command()
+@click.option('--name', '-n',
+              help='name the snapshot (default: its original name)')
+@click.argument('store')
+def attach(store, name=None):
+    '''Bring back a snapshot kept on disk.
+
+    Rebuild the devices of a snapshot created with --backing-file or
+    --backing-dev from STORE, for example after a reboot. The snapshot keeps
+    everything written to it; its source must not have changed.
+    '''
 
-    if snap_size is None:
-        snap_size = data_size
-    else:
-        if snap_size < data_size:
-            raise ValueError('requested size cannot be smaller than source')
+    try:
+        snap = api.attach_snapshot(store, name=name, inventory=Inventory())
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
 
-    snap_sectors = snap_size // 512
+    print('attached', snap.device)
 
-    if backing_size is None:
-        backing_size = int(min(snap_size * 0.25, MAX_BACKING_SIZE))
 
-    LOG.debug('part %s offset %s data_sectors %s data_size %s',
-              part, offset, data_sectors, data_size)
-    LOG.debug('snap_size %s snap_sectors %s backing_size %s',
-              snap_size, snap_sectors, backing_size)
+@cli.command()
+@click.option('--interval', '-i', type=float, default=api.MERGE_INTERVAL,
+              help='seconds between progress reports')
+@click.argument('name')
+def commit(name, interval=None):
+    '''Write a snapshot's changes back to its source.
+
+    Merge the chunks written to the snapshot back into the image or device it
+    was made of with the kernel's snapshot-merge target, reporting progress
+    on stderr, and then remove the snapshot. The snapshot must have been
+    created with --persistent, --backing-file or --backing-dev, be no bigger
+    than its source and not share its base device with other snapshots, and
+    the source must be writable.
+    '''
 
-    try:
-        # We reserve a device name by creating a dm device with no table.
-        snap = mapper.MapperDevice.create_first_available()
+    def report(done, total):
+        print('{}: merged {} of {} sectors ({:.0f}%)'.format(
+            name, done, total, done * 100 / total if total else 100),
+            file=sys.stderr)
 
-        # Now that we have reserved a device name, we can create the
-        # base device. This is a simple linear mapping onto the source,
-        # possibly with an offset applied if either --offset or --part
-        # were used.
-        base = mapper.MapperDevice.create('{}-base'.format(snap.device.name))
-        base.table.append(
-            mapper.Segment(0, data_sectors,
-                           mapper.Linear(src.device, offset)))
+    try:
+        api.commit_snapshot(name, on_progress=report, interval=interval,
+                            inventory=Inventory())
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
 
-        if snap_sectors > data_sectors:
-            base.table.append(
-                mapper.Segment(data_sectors, (snap_sectors - data_sectors),
-                               mapper.Zero()))
+    print('committed', name)
 
-        base.load()
 
-        # Create a ramdisk for use as the snapshow backing store.
-        backing = zram.ZramDevice.create()
-        backing.size = backing_size
+@cli.command()
+@click.option('--snap-size', '-s', type=Size(), required=True,
+              help='new size of the snapshot')
+@click.argument('name')
+def resize(name, snap_size=None):
+    '''Grow a live snapshot.
+
+    Extend the snapshot NAME (and, for a classic snapshot, the zero padding
+    at the end of its base device) to --snap-size, without unmounting it. The
+    new tables are loaded before I/O is suspended, so it is only held up while
+    the kernel swaps them in; how long that took is reported on stderr.
+    Snapshots cannot be shrunk.
+    '''
 
-        # And finally create the snapshot itself.
-        snap.table.append(
-            mapper.Segment(0, snap_sectors,
-                           mapper.Snapshot(base.device, backing.device)))
-        snap.load()
-    except subprocess.CalledProcessError as e:
-        LOG.error('%s: %s', e, e.stderr.decode('utf-8'))
-        sys.exit(1)
+    try:
+        result = api.resize_snapshot(name, snap_size)
+    except NoSuchDevice:
+        raise click.ClickException('device {} does not exist'.format(name))
+    except (subprocess.CalledProcessError, BullError, ValueError) as e:
+        fail(e)
 
-    print('created', snap.device)
+    for device, stall in result.stalls.items():
+        print('{}: I/O stalled for {:.3f} ms'.format(device, stall * 1000),
+              file=sys.stderr)
+    print('resized', name, 'to', result.new_size)
 
 
 @cli.command()
@@ -141,58 +384,382 @@ def remove(name):
 
     Tear down the ramdisk, device mapper devices, and loopback
     mounts associated with the bull snapshot. If the bull device is
-    mounted, attempt to unmount it first.
+    mounted, attempt to unmount it first. Base and loop devices shared
+    with other snapshots are left in place until the last one is removed.
     '''
 
-    snap = mapper.MapperDevice.create(name)
-    if not snap.exists():
+    try:
+        api.remove_snapshot(name, inventory=Inventory())
+    except NoSuchDevice:
         raise click.ClickException('device {} does not exist'.format(name))
-    snap.table.resolve()
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
 
-    if snap.is_mounted():
-        LOG.info('unmounting %s', name)
-        subprocess.check_call(['umount', str(snap.device)])
+    print('removed', name)
 
-    base = mapper.MapperDevice.create('{}-base'.format(name))
-    base.table.resolve()
 
-    backingdev = snap.table[0].target.backing
-    srcdev = base.table[0].target.device
+@cli.command()
+@click.option('--name', '-n')
+@click.argument('src')
+def clone(src, name=None):
+    '''Snapshot an existing thin snapshot.
 
-    LOG.debug('got source device %s', srcdev)
-    LOG.debug('got backing device %s', backingdev)
+    The new snapshot starts out sharing every block with SRC, which must
+    have been created with --engine thin.
+    '''
 
-    backing = zram.ZramDevice(backingdev)
+    try:
+        snap = api.clone_snapshot(src, new_name=name)
+    except NoSuchDevice:
+        raise click.ClickException('device {} does not exist'.format(src))
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
 
-    if srcdev.startswith('/dev/loop'):
-        loopdev = loop.LoopDevice(srcdev)
-    else:
-        loopdev = None
+    print('created', snap.device)
+
+
+@cli.command()
+@click.option('--long', '-l', 'long_format', is_flag=True,
+              help='show backing store usage')
+@click.option('--json', '-j', 'json_format', is_flag=True,
+              help='show everything about each snapshot as JSON')
+@click.option('--prefix', '-P', help='only show snapshots with this prefix')
+def list(long_format=False, json_format=False, prefix=None):
+    '''List existing bull snapshots.
+
+    With --long, show for each snapshot its backing store, the original and
+    compressed size of the data written to it, the compression ratio, the
+    maximum memory the backing store has used and how much of it has been
+    written to a spill device, followed by the RAM committed to the ramdisks of
+    all bull snapshots and what is left of --max-ram. With --json, also show
+    its source, base device, size, copy-on-write usage, spill device I/O and
+    mount point.
+    '''
 
     try:
-        snap.remove()
-        backing.remove()
-        base.remove()
+        if not (long_format or json_format):
+            print('\n'.join(api.snapshot_names(prefix=prefix)))
+            return
+
+        snapshots = listing.list_snapshots(prefix=prefix,
+                                           inventory=Inventory())
+        memory = snapbudget.memory_usage()
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
+
+    if json_format:
+        print(json.dumps([info.to_dict() for info in snapshots], indent=2))
+        return
+
+    print('\t'.join(['NAME', 'BACKING', 'ORIG', 'COMPR', 'RATIO',
+                     'MEM_USED_MAX', 'SPILLED']))
+    for info in snapshots:
+        ratio = (info.orig_data_size / info.compr_data_size
+                 if info.compr_data_size else None)
+        print('\t'.join(str(x) for x in [
+            info.name, Path(info.backing).name, info.orig_data_size,
+            info.compr_data_size,
+            '{:.2f}'.format(ratio) if ratio else '-',
+            info.mem_used_max,
+            info.spilled if info.spilled is not None else '-']))
+
+    print()
+    print('RAM committed: {}'.format(memory.committed))
+    if memory.budget is not None:
+        print('RAM budget: {} ({} left)'.format(
+            memory.budget, memory.headroom))
+
+
+def load_batch(fd):
+    '''Read a batch file, returning the create specs and names to remove.
+
+    The file holds a JSON list of objects. Objects with "op": "remove"
+    name a snapshot to remove; anything else is passed to create_snapshots,
+    with sizes given as for the command line options and the zram options
+    given by their option names.
+    '''
 
-        if loopdev:
-            loopdev.remove()
-    except subprocess.CalledProcessError as e:
-        LOG.error('%s: %s', e, e.stderr.decode('utf-8'))
-        sys.exit(1)
+    size = Size()
+    specs, names = [], []
 
-    print('removed', name)
+    for item in json.load(fd):
+        item = dict(item)
+        op = item.pop('op', 'create')
+
+        if op == 'remove':
+            names.append(item['name'])
+            continue
+        elif op != 'create':
+            raise ValueError('unknown operation: {}'.format(op))
+
+        for key in ['offset', 'snap_size', 'backing_size', 'block_size',
+                    'mem_limit']:
+            if item.get(key) is not None:
+                item[key] = size.convert(item[key], None, None)
+
+        item['zram_options'] = get_zram_options(
+            item.pop('comp_algorithm', None), item.pop('streams', None),
+            item.pop('mem_limit', None))
+        specs.append(item)
+
+    return specs, names
 
 
 @cli.command()
-def list():
-    '''List existing bull snapshots.'''
+@click.option('--workers', '-w', type=click.IntRange(min=1),
+              help='number of snapshots to work on at once')
+@click.option('--json', '-j', 'json_format', is_flag=True,
+              help='report results as JSON')
+@click.argument('batchfile', type=click.File('r'))
+def batch(batchfile, workers=None, json_format=False):
+    '''Create and remove many snapshots in one go.
+
+    BATCHFILE (or - for stdin) holds a JSON list like:
+
+    \b
+        [{"src": "disk.img", "part": 2, "count": 4},
+         {"src": "other.img", "snap_size": "4G", "engine": "thin"},
+         {"op": "remove", "name": "bull7"}]
+
+    Removals run first, then creations, each in parallel. Report the result
+    of every item and the overall throughput; exit non-zero if anything
+    failed.
+    '''
 
     try:
-        print('\n'.join(mapper.list_devices()))
-    except subprocess.CalledProcessError as e:
-        LOG.error('%s: %s', e, e.stderr.decode('utf-8'))
+        specs, names = load_batch(batchfile)
+    except (ValueError, KeyError, TypeError) as e:
+        raise click.ClickException('invalid batch file: {}'.format(e))
+
+    # One scan of the host serves every item; it is taken again after
+    # the removals, which may have unmounted things.
+    inventory = Inventory()
+    reports = [api.remove_many(names, workers=workers, inventory=inventory)]
+    inventory.refresh()
+    reports.append(api.create_many(specs, workers=workers,
+                                   inventory=inventory))
+
+    if json_format:
+        print(json.dumps({'removed': reports[0].to_dict(),
+                          'created': reports[1].to_dict()}, indent=2))
+    else:
+        for verb, report in zip(['removed', 'created'], reports):
+            for result in report.results:
+                if result.ok:
+                    for device in result.devices:
+                        print(verb, device,
+                              '({:.2f}s)'.format(result.elapsed))
+                else:
+                    print('failed', result.item, result.error)
+
+            if report.results:
+                print('{} {} in {:.2f}s ({:.1f}/s)'.format(
+                    verb, len(report.devices), report.elapsed,
+                    report.throughput))
+
+    if any(report.failed for report in reports):
         sys.exit(1)
 
 
+@cli.command()
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='write to this file (e.g. in the node_exporter textfile '
+              'directory) instead of stdout')
+@click.option('--prefix', '-P', help='only include snapshots with this prefix')
+def metrics(output=None, prefix=None):
+    '''Write metrics in the Prometheus text format.
+
+    Report the number of snapshots, their copy-on-write usage, the original
+    and compressed bytes in their ramdisks, and histograms of how long each
+    phase and step of earlier bull commands took. With --output the file is
+    replaced atomically, as the node_exporter textfile collector expects.
+    '''
+
+    try:
+        text = snapmetrics.collect(prefix=prefix)
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
+
+    if output:
+        snapmetrics.write_atomic(output, text)
+    else:
+        sys.stdout.write(text)
+
+
+@cli.command()
+def reconcile():
+    '''Rebuild the snapshot registry from the kernel.
+
+    bull records how each snapshot was built in /run/bull/registry.json, and
+    reads that when listing and removing snapshots. If devices have been
+    created or removed behind bull's back, bring the registry back in line
+    with the devices that actually exist.
+    '''
+
+    try:
+        added, dropped = snapregistry.reconcile()
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
+
+    for name in added:
+        print('recorded', name)
+    for name in dropped:
+        print('dropped', name)
+
+
+@cli.command()
+@click.option('--watermark', '-w', type=click.IntRange(1, 99), default=80,
+              help='grow snapshots that are this many percent full')
+@click.option('--interval', '-i', type=float, default=1.0)
+@click.option('--grow-by', '-g', type=Size(),
+              help='bytes to add (default: double the backing store)')
+@click.option('--max-size', '-m', type=Size(),
+              help='never grow a backing store past this size')
+@click.option('--spill-every', type=float,
+              help='write pages idle for this many seconds to the spill '
+              'device of snapshots created with --spill-to')
+@click.option('--spill-above', type=Size(),
+              help='write idle pages to spill devices at once when the '
+              'ramdisks of those snapshots use more memory than this')
+@click.option('--spill-limit', type=Size(),
+              help='write at most this much from each snapshot at a time')
+@click.option('--once', is_flag=True, help='check once and exit')
+def watch(watermark=None, interval=None, grow_by=None, max_size=None,
+          spill_every=None, spill_above=None, spill_limit=None, once=False):
+    '''Grow snapshot backing stores before they fill up.
+
+    Poll the usage of every snapshot, and when one crosses the watermark add
+    another ramdisk to its backing store before the kernel invalidates the
+    snapshot.
+
+    With --spill-every or --spill-above, also write pages that have not been
+    touched since the last pass out of the ramdisks of snapshots created with
+    --spill-to, into their spill device.
+    '''
+
+    spiller = None
+    if spill_every is not None or spill_above is not None:
+        spiller = snapwatch.Spiller(every=spill_every, budget=spill_above,
+                                    limit=spill_limit)
+
+    watcher = snapwatch.Watcher(watermark=watermark / 100,
+                                interval=interval, grow_by=grow_by,
+                                max_size=max_size, spiller=spiller)
+
+    try:
+        if once:
+            for usage in watcher.poll():
+                print('{}\t{}\t{:.0f}%'.format(usage.name, usage.state,
+                                               usage.used * 100))
+        else:
+            watcher.run()
+    except KeyboardInterrupt:
+        pass
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
+
+
+@cli.group()
+def pool():
+    '''Manage a pool of ready snapshots.'''
+    pass
+
+
+@pool.command('serve')
+@click.option('--size', '-N', type=click.IntRange(min=1), default=4)
+@click.option('--part', '-p', type=Size())
+@click.option('--offset', '-o', type=Size(), default=0)
+@click.option('--backing-size', '-b', type=Size())
+@click.option('--snap-size', '-s', type=Size())
+@click.option('--prefix', '-P', default='bull',
+              help='name snapshots <prefix><n>')
+@click.option('--socket', '-S', 'socket_path',
+              default=str(snappool.DEFAULT_SOCKET))
+@zram_options
+@click.argument('src')
+def pool_serve(src, size=None, part=None, offset=None, backing_size=None,
+               snap_size=None, prefix=None, socket_path=None,
+               comp_algorithm=None, streams=None, mem_limit=None):
+    '''Keep a pool of ready snapshots of SRC.
+
+    Create SIZE snapshots of the given source up front and hand them out
+    to "bull pool checkout" over a unix socket, creating replacements in
+    the background. Snapshots returned with "bull pool checkin" are
+    recycled. The ready snapshots are removed when the server exits.
+    '''
+
+    if not zram.check_zram_available():
+        raise click.ClickException('ZRAM module is not available')
+
+    snapshots = snappool.SnapshotPool(src, size, part=part, offset=offset,
+                                      snap_size=snap_size,
+                                      backing_size=backing_size,
+                                      prefix=prefix,
+                                      zram_options=get_zram_options(
+                                          comp_algorithm, streams,
+                                          mem_limit))
+    try:
+        snapshots.start()
+    except (subprocess.CalledProcessError, BullError) as e:
+        fail(e)
+
+    server = snappool.PoolServer(snapshots, socket_path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    LOG.info('serving %d snapshots of %s on %s', size, src, socket_path)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        snapshots.stop()
+
+
+@pool.command('checkout')
+@click.option('--timeout', '-t', type=float)
+@click.option('--socket', '-S', 'socket_path',
+              default=str(snappool.DEFAULT_SOCKET))
+def pool_checkout(timeout=None, socket_path=None):
+    '''Take a ready snapshot from the pool.'''
+
+    try:
+        print(snappool.PoolClient(socket_path).checkout(timeout=timeout))
+    except (OSError, BullError) as e:
+        fail(e)
+
+
+@pool.command('checkin')
+@click.option('--socket', '-S', 'socket_path',
+              default=str(snappool.DEFAULT_SOCKET))
+@click.argument('name')
+def pool_checkin(name, socket_path=None):
+    '''Return a snapshot to the pool.
+
+    The snapshot must not be mounted. Everything written to it is
+    discarded.
+    '''
+
+    try:
+        snappool.PoolClient(socket_path).checkin(name)
+    except (OSError, BullError) as e:
+        fail(e)
+
+
+@pool.command('status')
+@click.option('--socket', '-S', 'socket_path',
+              default=str(snappool.DEFAULT_SOCKET))
+def pool_status(socket_path=None):
+    '''Show ready and checked out snapshots.'''
+
+    try:
+        status = snappool.PoolClient(socket_path).status()
+    except (OSError, BullError) as e:
+        fail(e)
+
+    print('ready:', ' '.join(status['ready']))
+    print('checked out:', ' '.join(status['checked_out']))
+
+
 if __name__ == '__main__':
     cli()
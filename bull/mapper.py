@@ -1,44 +1,346 @@
 import attr
 import functools
+import heapq
 import logging
+import os
+import re
 import subprocess
+import threading
+import time
 
 from bull.blockdev import BlockDevice
-from bull.common import run_command
-from bull.exceptions import NoDevicesAvailable, DeviceExists
+from bull.common import lock_file, run_command
+from bull.host import RUN_DIR, get_host
+from bull import dmioctl
+from bull import timing
+from bull.exceptions import DeviceExists, DeviceMapperError
 
 LOG = logging.getLogger(__name__)
-MAX_DEVICES = 10
+NAMES_LOCK = RUN_DIR / 'names.lock'
 
 
 dmsetup = functools.partial(run_command, 'dmsetup')
 
 
+class DmsetupBackend():
+    '''Device mapper backend that runs the dmsetup command.'''
+
+    def call(self, *args, input=None):
+        try:
+            p = dmsetup(*args, input=input)
+        except subprocess.CalledProcessError as e:
+            raise DeviceMapperError('dmsetup {} failed: {}'.format(
+                ' '.join(str(arg) for arg in args),
+                e.stderr.decode('utf-8').strip()))
+
+        return p.stdout.decode('utf-8')
+
+    def exists(self, name):
+        try:
+            self.call('status', name)
+        except DeviceMapperError:
+            return False
+
+        return True
+
+    def create(self, name):
+        self.call('create', name, '--notable')
+
+    def remove(self, name):
+        self.call('remove', name)
+
+    def suspend(self, name):
+        self.call('suspend', name)
+
+    def resume(self, name):
+        self.call('resume', name)
+
+    def load(self, name, table):
+        self.call('load', name, input=table.encode('utf-8'))
+
+    def clear(self, name):
+        self.call('clear', name)
+
+    def message(self, name, sector, message):
+        return self.call('message', name, sector, message)
+
+    def table(self, name):
+        return self.call('table', name)
+
+    def status(self, name):
+        return self.call('status', name)
+
+    def names(self):
+        '''Return the names of all dm devices, read from sysfs rather
+        than by running dmsetup.'''
+
+        return sysfs_device_names()
+
+    def list_devices(self, target_type=None):
+        args = ['ls']
+        if target_type is not None:
+            args.extend(['--target', target_type])
+
+        return [line.split()[0] for line in self.call(*args).splitlines()
+                if line.strip() and line != 'No devices found']
+
+    def devices(self):
+        '''Return a dictionary mapping device names to 'major:minor'.'''
+
+        devices = {}
+        for line in self.call('ls').splitlines():
+            match = re.match(r'(\S+)\s+\((\d+)[:,]\s*(\d+)\)', line)
+            if match:
+                devices[match.group(1)] = '{}:{}'.format(match.group(2),
+                                                         match.group(3))
+
+        return devices
+
+    def _per_device(self, command, target_type=None):
+        args = [command]
+        if target_type is not None:
+            args.extend(['--target', target_type])
+
+        output = {}
+        name = None
+        for line in self.call(*args).splitlines():
+            if not line.strip() or line == 'No devices found':
+                continue
+
+            # dmsetup puts the device name in front of every segment.
+            prefix, sep, rest = line.partition(': ')
+            if sep and ' ' not in prefix:
+                name = prefix
+                output.setdefault(name, []).append(rest)
+            elif name is not None:
+                output[name].append(line)
+
+        return {name: '\n'.join(lines) for name, lines in output.items()}
+
+    def status_all(self, target_type=None):
+        '''Return a dictionary mapping device names to their status, using
+        a single dmsetup call.'''
+
+        return self._per_device('status', target_type)
+
+    def table_all(self, target_type=None):
+        '''Return a dictionary mapping device names to their table, using
+        a single dmsetup call.'''
+
+        return self._per_device('table', target_type)
+
+
+_backend = None
+
+
+def default_backend():
+    '''Use the ioctl backend if we can open the control device, falling
+    back to dmsetup otherwise.'''
+
+    if os.access(str(dmioctl.Control.path), os.R_OK | os.W_OK):
+        try:
+            backend = dmioctl.IoctlBackend()
+            backend.version()
+            return backend
+        except (OSError, DeviceMapperError) as e:
+            LOG.debug('unable to use dm ioctl interface: %s', e)
+
+    return DmsetupBackend()
+
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        _backend = default_backend()
+        LOG.debug('using device mapper backend %s',
+                  _backend.__class__.__name__)
+
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
 def resolve_device(dev):
     '''Derive a device name from a major:minor pair'''
 
     if dev.startswith('/dev'):
         return dev
 
+    host = get_host()
     try:
-        with open('/sys/dev/block/{}/dm/name'.format(dev)) as fd:
-            name = fd.read().strip()
-            return '/dev/mapper/{}'.format(name)
+        name = host.read('/sys/dev/block/{}/dm/name'.format(dev)).strip()
+        return '/dev/mapper/{}'.format(name)
     except FileNotFoundError:
-        with open('/sys/dev/block/{}/uevent'.format(dev)) as fd:
-            uevent = {k: v.strip() for k, v in [line.split('=', 1)
-                                                for line in fd]}
+        uevent = host.read('/sys/dev/block/{}/uevent'.format(dev))
+        uevent = dict(line.split('=', 1) for line in uevent.splitlines()
+                      if '=' in line)
 
         return '/dev/{DEVNAME}'.format(**uevent)
 
 
-def list_devices(prefix='bull'):
+def sysfs_device_names():
+    host = get_host()
+    names = []
+    for entry in host.listdir('/sys/block'):
+        if not entry.startswith('dm-'):
+            continue
+
+        try:
+            names.append(host.read(
+                '/sys/block/{}/dm/name'.format(entry)).strip())
+        except FileNotFoundError:
+            pass
+
+    return names
+
+
+class NameAllocator():
+    '''Hand out device names of the form <prefix><number>.
+
+    The names in use are read once (with a single DM_LIST_DEVICES
+    call, or from sysfs) and the unused numbers below the highest one
+    kept on a free list, so that allocation costs the same however
+    many devices exist. A number counts as in use if any device is
+    named after it (bull3-base counts, as well as bull3). Names are
+    claimed by creating an empty dm device, which the kernel does
+    atomically, while holding lockfile so that concurrent bull
+    processes do not fight over the same number.
+    '''
+
+    def __init__(self, prefix='bull', backend=None, lockfile=NAMES_LOCK):
+        self.prefix = prefix
+        self.backend = backend or get_backend()
+        self.lockfile = lockfile
+        self.pattern = re.compile(r'{}(\d+)(-.*)?$'.format(re.escape(prefix)))
+        self.lock = threading.Lock()
+        self.free = None
+        self.next = 0
+
+    def number(self, name):
+        match = self.pattern.match(name)
+        if match:
+            return int(match.group(1))
+
+    def refresh(self):
+        '''Read the names in use and rebuild the free list.'''
+
+        used = {self.number(name) for name in self.backend.names()}
+        used.discard(None)
+
+        self.next = max(used) + 1 if used else 0
+        self.free = [num for num in range(self.next) if num not in used]
+        LOG.debug('%d %s* names in use, %d free below %d', len(used),
+                  self.prefix, len(self.free), self.next)
+
+    def _take(self):
+        if self.free:
+            return heapq.heappop(self.free)
+
+        self.next += 1
+        return self.next - 1
+
+    def allocate(self):
+        '''Create an empty dm device with the lowest free name and return
+        that name.'''
+
+        with self.lock, lock_file(self.lockfile):
+            refreshed = self.free is None
+            if refreshed:
+                self.refresh()
+
+            while True:
+                name = '{}{}'.format(self.prefix, self._take())
+                try:
+                    self.backend.create(name)
+                except DeviceMapperError:
+                    if not self.backend.exists(name):
+                        raise
+
+                    # Someone else created this device since we last
+                    # looked, so the free list is stale.
+                    LOG.debug('%s is already in use', name)
+                    if not refreshed:
+                        self.refresh()
+                        refreshed = True
+                    continue
+
+                LOG.debug('allocated device name %s', name)
+                return name
+
+    def release(self, name):
+        '''Put the number of a removed device back on the free list.
+
+        The number is only reused once no device is named after it.
+        '''
+
+        num = self.number(name)
+        with self.lock:
+            if num is None or self.free is None or num >= self.next \
+                    or num in self.free:
+                return
+
+            base = '{}{}'.format(self.prefix, num)
+            if any(self.backend.exists(base + suffix)
+                   for suffix in ('', '-base', '-cow', '-pool')):
+                return
+
+            heapq.heappush(self.free, num)
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def get_allocator(prefix='bull', backend=None):
+    '''Return the NameAllocator for prefix, creating it if necessary.'''
+
+    backend = backend or get_backend()
+    with _allocators_lock:
+        key = (prefix, backend)
+        if key not in _allocators:
+            _allocators[key] = NameAllocator(prefix, backend=backend)
+
+        return _allocators[key]
+
+
+def release_name(name, backend=None):
+    '''Tell the allocators that the device name has been removed.'''
+
+    backend = backend or get_backend()
+    with _allocators_lock:
+        allocators = [allocator for (prefix, _backend), allocator
+                      in _allocators.items() if _backend is backend]
+
+    for allocator in allocators:
+        allocator.release(name)
+
+
+def list_devices(prefix='bull', backend=None):
     '''Return a list of device mapper snapshot device names that start with the
     given prefix.
+
+    This includes both classic snapshots and thin volumes. If prefix is
+    None, return all of them.
     '''
 
-    p = dmsetup('ls', '--target', 'snapshot')
-    return [line.split()[0].decode('ascii') for line in p.stdout.splitlines()]
+    backend = backend or get_backend()
+    names = backend.list_devices('snapshot') + backend.list_devices('thin')
+    return sorted(name for name in names
+                  if prefix is None or name.startswith(prefix))
+
+
+def load_all(devices):
+    '''Load the tables of several MapperDevices into their inactive
+    slots, and then swap them all in. Return the total time I/O was
+    stalled, in seconds.'''
+
+    for device in devices:
+        device.load_inactive()
+    return sum(device.activate() for device in devices)
 
 
 class Table(list):
@@ -80,6 +382,7 @@ class Target():
     '''A target in a device mapper device table'''
 
     device_attrs = []
+    target_type = None
 
     @classmethod
     def from_string(kls, target):
@@ -89,22 +392,27 @@ class Target():
             return Linear(*args)
         elif _type == 'snapshot':
             return Snapshot(*args)
+        elif _type == 'snapshot-merge':
+            return SnapshotMerge(*args)
         elif _type == 'zero':
             return Zero(*args)
         elif _type == 'thin-pool':
-            return Thinpool(*args)
+            return Thinpool.from_args(*args)
         elif _type == 'thin':
             return Thin(*args)
+        elif _type == 'striped':
+            return Striped.from_args(*args)
         else:
             raise ValueError('unknown target description: {}'.format(target))
 
     def resolve(self):
         for attrname in self.device_attrs:
-            setattr(self, attrname,
-                    resolve_device(getattr(self, attrname)))
+            value = getattr(self, attrname)
+            if value is not None:
+                setattr(self, attrname, resolve_device(value))
 
     def __str__(self):
-        target_type = self.__class__.__name__.lower()
+        target_type = self.target_type or self.__class__.__name__.lower()
         attrs = [target_type] + [getattr(self, x.name)
                                  for x in attr.fields(self.__class__)]
         return ' '.join(str(x) for x in attrs if x is not None)
@@ -125,6 +433,38 @@ class Linear(Target):
     offset = attr.ib(converter=int, default=0)
 
 
+@attr.s
+class Striped(Target):
+    '''https://www.kernel.org/doc/Documentation/device-mapper/striped.txt
+
+    stripes is a list of (device, offset) pairs; chunk_size is in
+    sectors.'''
+
+    chunk_size = attr.ib(converter=int)
+    stripes = attr.ib(converter=list, default=attr.Factory(list))
+
+    @classmethod
+    def from_args(kls, count, chunk_size, *args):
+        stripes = list(zip(args[0::2], (int(x) for x in args[1::2])))
+        if len(stripes) != int(count):
+            raise ValueError('expected {} stripes, got {}'.format(
+                count, len(stripes)))
+        return kls(chunk_size, stripes)
+
+    @property
+    def devices(self):
+        return [device for device, offset in self.stripes]
+
+    def resolve(self):
+        self.stripes = [(resolve_device(device), offset)
+                        for device, offset in self.stripes]
+
+    def __str__(self):
+        return ' '.join(str(x) for x in [
+            'striped', len(self.stripes), self.chunk_size,
+        ] + [x for stripe in self.stripes for x in stripe])
+
+
 @attr.s
 class Snapshot(Target):
     '''https://www.kernel.org/doc/Documentation/device-mapper/snapshot.txt'''
@@ -144,24 +484,46 @@ class Snapshot(Target):
     chunksize = attr.ib(converter=int, default=16)
 
 
+@attr.s
+class SnapshotMerge(Snapshot):
+    '''Write the exceptions of a persistent snapshot back into its
+    origin, presenting the merged result while it does; see
+    snapshot.txt.'''
+
+    target_type = 'snapshot-merge'
+
+
 @attr.s
 class Thinpool(Target):
     '''https://www.kernel.org/doc/Documentation/device-mapper/thin-provisioning.txt'''  # NOQA
 
     device_attrs = ['metadata_dev', 'data_dev']
+    target_type = 'thin-pool'
 
     metadata_dev = attr.ib(converter=str)
     data_dev = attr.ib(converter=str)
-    blocksize = attr.ib(converter=int)
-    lwm = attr.ib(converter=int)
-    argc = attr.ib(converter=int)
+    blocksize = attr.ib(converter=int, default=128)
+    lwm = attr.ib(converter=int, default=0)
+    argc = attr.ib(converter=int, default=0)
+    features = attr.ib(converter=list, default=attr.Factory(list))
+
+    @classmethod
+    def from_args(kls, metadata_dev, data_dev, blocksize, lwm, argc=0,
+                  *features):
+        return kls(metadata_dev, data_dev, blocksize, lwm, argc, features)
+
+    def __str__(self):
+        return ' '.join(str(x) for x in [
+            self.target_type, self.metadata_dev, self.data_dev,
+            self.blocksize, self.lwm, len(self.features),
+        ] + self.features)
 
 
 @attr.s
 class Thin(Target):
     '''https://www.kernel.org/doc/Documentation/device-mapper/thin-provisioning.txt'''  # NOQA
 
-    device_attrs = ['pool_dev']
+    device_attrs = ['pool_dev', 'origin']
 
     pool_dev = attr.ib(converter=str)
     dev_id = attr.ib(converter=int)
@@ -175,55 +537,86 @@ class MapperDevice(BlockDevice):
     more information.
     '''
 
-    def __init__(self, device):
+    def __init__(self, device, backend=None):
         super().__init__(device)
+        self.backend = backend or get_backend()
         self.table = self.get_table_from_device()
 
+    @property
+    def name(self):
+        return self.device.name
+
     def get_table_from_device(self):
-        res = dmsetup('table', self.device.name)
-        return Table.from_string(res.stdout.decode('ascii'))
+        return Table.from_string(self.backend.table(self.name))
 
     @classmethod
-    def create(kls, name, exclusive=False):
+    def create(kls, name, exclusive=False, backend=None):
         LOG.debug('creating dm device %s', name)
-        try:
-            dmsetup('status', name)
+        backend = backend or get_backend()
+
+        if backend.exists(name):
             if exclusive:
                 raise DeviceExists(name)
-        except subprocess.CalledProcessError:
-            dmsetup('create', name, '--notable')
+        else:
+            backend.create(name)
 
-        return kls('/dev/mapper/{}'.format(name))
+        return kls('/dev/mapper/{}'.format(name), backend=backend)
 
     @classmethod
-    def create_first_available(kls, prefix='bull'):
-        LOG.debug('looking for available device')
-        for devnum in range(MAX_DEVICES):
-            devname = '{}{}'.format(prefix, devnum)
-            LOG.debug('checking device %s', devname)
-            try:
-                dmsetup('create', devname, '--notable')
-            except subprocess.CalledProcessError:
-                pass
-            else:
-                LOG.debug('found device %s', devname)
-                break
-        else:
-            raise NoDevicesAvailable()
+    def create_first_available(kls, prefix='bull', backend=None):
+        '''Create an empty device named <prefix><n> for the lowest
+        unused n.'''
 
-        return kls('/dev/mapper/{}'.format(devname))
+        backend = backend or get_backend()
+        devname = get_allocator(prefix, backend=backend).allocate()
+        return kls('/dev/mapper/{}'.format(devname), backend=backend)
 
     def remove(self):
-        LOG.debug('removing dm device %s', self.device.name)
-        dmsetup('remove', self.device.name)
+        LOG.debug('removing dm device %s', self.name)
+        self.backend.remove(self.name)
 
     def load(self):
-        LOG.debug('loading table for dm device %s', self.device.name)
-        dmsetup('suspend', self.device.name)
-        dmsetup('load', self.device.name,
-                input=str(self.table).encode('ascii'))
-        dmsetup('resume', self.device.name)
+        '''Make self.table the live table of the device. Return how long
+        I/O to the device was stalled, in seconds.
+
+        The table is loaded into the inactive slot first, so that I/O
+        is only suspended while the kernel swaps it in.
+        '''
+
+        self.load_inactive()
+        return self.activate()
+
+    def load_inactive(self):
+        '''Load self.table into the inactive slot of the device.'''
+
+        LOG.debug('loading table for dm device %s', self.name)
+        self.backend.load(self.name, str(self.table))
+
+    def activate(self):
+        '''Swap the inactive table in. Return how long I/O to the device
+        was stalled, in seconds.'''
+
+        started = time.monotonic()
+        with timing.timed('dm suspend window'):
+            self.backend.suspend(self.name)
+            self.backend.resume(self.name)
+        self.invalidate_geometry()
+        return time.monotonic() - started
+
+    def status(self):
+        return self.backend.status(self.name)
+
+    def message(self, message, sector=0):
+        LOG.debug('sending message "%s" to dm device %s', message, self.name)
+        return self.backend.message(self.name, sector, message)
+
+    def suspend(self):
+        self.backend.suspend(self.name)
+
+    def resume(self):
+        self.backend.resume(self.name)
 
     def refresh(self):
-        LOG.debug('reading table for dm device %s', self.device.name)
+        LOG.debug('reading table for dm device %s', self.name)
         self.table = self.get_table_from_device()
+        self.invalidate_geometry()
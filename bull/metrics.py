@@ -0,0 +1,214 @@
+'''Export bull metrics for the node_exporter textfile collector.
+
+Each bull command adds the timings it recorded (see bull.timing) to
+latency histograms kept in /run/bull/latency.json. bull metrics writes
+those histograms, along with gauges and counters describing the
+current snapshots, in the Prometheus text format.
+'''
+
+import json
+import logging
+import os
+from pathlib import Path
+
+from bull import budget
+from bull import listing
+from bull.common import lock_file
+from bull.host import RUN_DIR, get_host
+
+LOG = logging.getLogger(__name__)
+LATENCY_PATH = RUN_DIR / 'latency.json'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def write_atomic(path, text):
+    '''Replace the contents of path without readers seeing a partial
+    file.'''
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.{}.{}'.format(path.name, os.getpid()))
+    tmp.write_text(text)
+    os.replace(str(tmp), str(path))
+
+
+class LatencyHistograms():
+    '''Cumulative latency histograms, keyed by phase and operation.
+
+    Each histogram is a dictionary holding the per-bucket counts (not
+    cumulative; the last bucket is +Inf), the count and the sum.
+    '''
+
+    def __init__(self, path=LATENCY_PATH, buckets=LATENCY_BUCKETS):
+        self.path = get_host().run_path(path)
+        self.lockfile = self.path.with_name(self.path.name + '.lock')
+        self.buckets = buckets
+
+    def load(self):
+        try:
+            with self.path.open() as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            LOG.warning('ignoring unreadable latency file %s: %s',
+                        self.path, e)
+            return {}
+
+        return {(item['phase'], item['operation']): item
+                for item in data.get('histograms', [])}
+
+    def observe(self, histograms, phase, operation, elapsed):
+        key = (phase, operation)
+        if key not in histograms:
+            histograms[key] = {'phase': phase, 'operation': operation,
+                               'buckets': [0] * (len(self.buckets) + 1),
+                               'count': 0, 'sum': 0.0}
+
+        histogram = histograms[key]
+        index = next((i for i, bound in enumerate(self.buckets)
+                      if elapsed <= bound), len(self.buckets))
+        histogram['buckets'][index] += 1
+        histogram['count'] += 1
+        histogram['sum'] += elapsed
+
+    def add(self, events):
+        '''Add timing.Events to the histograms.'''
+
+        if not events:
+            return
+
+        with lock_file(self.lockfile):
+            histograms = self.load()
+            for event in events:
+                self.observe(histograms, event.phase, event.operation,
+                             event.elapsed)
+
+            write_atomic(self.path, json.dumps(
+                {'buckets': list(self.buckets),
+                 'histograms': list(histograms.values())}))
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def labels(**kwargs):
+    return '{' + ','.join('{}="{}"'.format(key, escape(value))
+                          for key, value in kwargs.items()) + '}'
+
+
+def format_gauges(snapshots):
+    lines = ['# HELP bull_snapshots Number of bull snapshots.',
+             '# TYPE bull_snapshots gauge',
+             'bull_snapshots {}'.format(len(snapshots))]
+
+    gauges = [
+        ('bull_cow_allocated_bytes', 'allocated',
+         'Bytes of the copy-on-write store in use.'),
+        ('bull_cow_size_bytes', 'total',
+         'Size of the copy-on-write store.'),
+        ('bull_zram_orig_data_bytes', 'orig_data_size',
+         'Uncompressed bytes written to the zram backing store.'),
+        ('bull_zram_compr_data_bytes', 'compr_data_size',
+         'Compressed bytes held by the zram backing store.'),
+        ('bull_zram_mem_used_max_bytes', 'mem_used_max',
+         'Most memory the zram backing store has used.'),
+        ('bull_zram_spilled_bytes', 'spilled',
+         'Bytes written back from zram to a spill device.'),
+    ]
+    counters = [
+        ('bull_zram_spill_read_bytes_total', 'spill_reads',
+         'Bytes read back from the spill device.'),
+        ('bull_zram_spill_written_bytes_total', 'spill_writes',
+         'Bytes written to the spill device.'),
+    ]
+
+    for metric_type, metrics in (('gauge', gauges), ('counter', counters)):
+        for metric, field, description in metrics:
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} {}'.format(metric, metric_type))
+            for info in snapshots:
+                value = getattr(info, field)
+                if value is not None:
+                    lines.append('{}{} {}'.format(
+                        metric,
+                        labels(snapshot=info.name, engine=info.engine),
+                        value))
+
+    return lines
+
+
+def format_memory(memory):
+    lines = ['# HELP bull_ram_committed_bytes RAM committed to the zram '
+             'devices of bull snapshots.',
+             '# TYPE bull_ram_committed_bytes gauge',
+             'bull_ram_committed_bytes {}'.format(memory.committed)]
+
+    if memory.budget is not None:
+        lines += ['# HELP bull_ram_budget_bytes Most RAM the zram devices '
+                  'of bull snapshots may take.',
+                  '# TYPE bull_ram_budget_bytes gauge',
+                  'bull_ram_budget_bytes {}'.format(memory.budget)]
+
+    return lines
+
+
+def format_histograms(histograms, buckets=LATENCY_BUCKETS):
+    lines = []
+    metrics = [
+        ('bull_phase_duration_seconds',
+         'Time taken by each phase of a bull command.',
+         lambda key: key[1] is None),
+        ('bull_operation_duration_seconds',
+         'Time taken by commands, ioctls and sysfs writes.',
+         lambda key: key[1] is not None),
+    ]
+
+    for metric, description, wanted in metrics:
+        lines.append('# HELP {} {}'.format(metric, description))
+        lines.append('# TYPE {} histogram'.format(metric))
+
+        for key in sorted((key for key in histograms if wanted(key)),
+                          key=lambda key: (key[0] or '', key[1] or '')):
+            histogram = histograms[key]
+            tags = {'phase': key[0] or ''}
+            if key[1] is not None:
+                tags['operation'] = key[1]
+
+            total = 0
+            for bound, count in zip(list(buckets) + ['+Inf'],
+                                    histogram['buckets']):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric, labels(**tags, le=bound), total))
+            lines.append('{}_sum{} {}'.format(metric, labels(**tags),
+                                              histogram['sum']))
+            lines.append('{}_count{} {}'.format(metric, labels(**tags),
+                                                histogram['count']))
+
+    return lines
+
+
+def format_metrics(snapshots, histograms, buckets=LATENCY_BUCKETS,
+                   memory=None):
+    '''Return metrics for snapshots (listing.SnapshotInfo objects),
+    latency histograms and, if given, a budget.MemoryUsage in the
+    Prometheus text format.'''
+
+    lines = format_gauges(snapshots)
+    if memory is not None:
+        lines += format_memory(memory)
+    return '\n'.join(lines + format_histograms(histograms, buckets)) + '\n'
+
+
+def collect(prefix=None, backend=None, latency=None):
+    '''Return the current metrics as text.'''
+
+    latency = latency or LatencyHistograms()
+    return format_metrics(listing.list_snapshots(prefix=prefix,
+                                                 backend=backend),
+                          latency.load(), latency.buckets,
+                          memory=budget.memory_usage())
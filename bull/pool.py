@@ -0,0 +1,286 @@
+'''Keep a pool of ready snapshots of one source.
+
+Creating a snapshot means reserving a name, loading tables and
+hot-adding a ramdisk. A SnapshotPool does that ahead of time, so that
+checking out a snapshot only has to hand over a name. The pool is
+refilled in the background, and snapshots that are checked back in
+are recycled (their ramdisk reset and table reloaded) rather than
+torn down.
+
+PoolServer exposes a pool on a unix socket, speaking one JSON
+object per line, and PoolClient talks to it.
+'''
+
+import collections
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import subprocess
+import threading
+
+from bull import api
+from bull import budget as snapbudget
+from bull import cow
+from bull import mapper
+from bull.exceptions import BullError, NoDevicesAvailable, OverBudget
+from bull.registry import get_registry
+
+LOG = logging.getLogger(__name__)
+DEFAULT_SOCKET = Path('/run/bull/pool.sock')
+POOL_ERRORS = (subprocess.CalledProcessError, BullError, OSError)
+
+
+class SnapshotPool():
+    '''A set of pre-created snapshots of one source.'''
+
+    def __init__(self, src, size, part=None, offset=0, snap_size=None,
+                 backing_size=None, prefix='bull', backend=None,
+                 zram_options=None, registry=None):
+        self.src = src
+        self.size = size
+        self.part = part
+        self.offset = offset
+        self.snap_size = snap_size
+        self.backing_size = backing_size
+        self.prefix = prefix
+        self.zram_options = zram_options
+        self.backend = backend or mapper.get_backend()
+        self.registry = registry or get_registry()
+
+        self.base = None
+        self.snap_sectors = None
+        self.template = None
+        self.ready = collections.deque()
+        self.checked_out = set()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        '''Create the initial set of snapshots and start refilling.'''
+
+        snaps = api.create_snapshots(
+            self.src, count=self.size, part=self.part, offset=self.offset,
+            snap_size=self.snap_size, backing_size=self.backing_size,
+            prefix=self.prefix, backend=self.backend,
+            zram_options=self.zram_options, registry=self.registry)
+
+        target = snaps[0].table[0].target
+        self.base = mapper.MapperDevice(target.origin, backend=self.backend)
+        self.snap_sectors = snaps[0].table[0].sectors
+        self.backing_size = cow.zram_devices(target.backing)[0].size
+        self.template = self.registry.get(snaps[0].name)
+
+        with self.cond:
+            self.ready.extend(snap.name for snap in snaps)
+            self.running = True
+
+        self.thread = threading.Thread(target=self._refill, daemon=True)
+        self.thread.start()
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.ready) >= self.size:
+                    self.cond.wait()
+
+                if not self.running:
+                    return
+
+            # Refills are admitted against the memory budget, as creates
+            # are; see api.create_snapshots.
+            options = api.budgeted_options(self.zram_options,
+                                           self.backing_size)
+            cost = options.get('mem_limit') or self.backing_size
+            snaps = []
+            try:
+                with snapbudget.admit(cost, registry=self.registry):
+                    snaps = api.reserve_names(1, prefix=self.prefix,
+                                              backend=self.backend)
+                    backings = api.stack_snapshots(
+                        snaps, self.base, self.snap_sectors,
+                        self.backing_size, zram_options=options)
+                    if self.template is not None:
+                        api.record_snapshots(
+                            snaps, self.template,
+                            [[backing.device] for backing in backings],
+                            registry=self.registry)
+            except OverBudget as e:
+                LOG.warning('not refilling pool: %s', e)
+                with self.cond:
+                    self.cond.wait(1)
+                continue
+            except POOL_ERRORS as e:
+                LOG.error('failed to refill pool: %s', e)
+                api.discard_snapshots(snaps, backend=self.backend)
+                with self.cond:
+                    self.cond.wait(1)
+                continue
+
+            LOG.debug('added %s to pool', snaps[0].name)
+            with self.cond:
+                self.ready.append(snaps[0].name)
+                self.cond.notify_all()
+
+    def checkout(self, timeout=None):
+        '''Return the name of a ready snapshot.
+
+        Wait up to timeout seconds (forever, if None) for one to
+        become available.
+        '''
+
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.ready or not self.running,
+                                      timeout):
+                raise NoDevicesAvailable('no snapshot ready')
+            if not self.ready:
+                raise NoDevicesAvailable('pool is stopped')
+
+            name = self.ready.popleft()
+            self.checked_out.add(name)
+            self.cond.notify_all()
+
+        LOG.info('checked out %s', name)
+        return name
+
+    def checkin(self, name):
+        '''Recycle a checked out snapshot and return it to the pool.
+
+        If the pool is already full the snapshot is removed instead.
+        '''
+
+        name = Path(name).name
+        with self.cond:
+            if name not in self.checked_out:
+                raise BullError('{} is not checked out'.format(name))
+            self.checked_out.discard(name)
+            full = len(self.ready) >= self.size
+
+        try:
+            if full:
+                api.remove_snapshot(name, backend=self.backend,
+                                    registry=self.registry)
+                return
+
+            api.recycle_snapshot(name, backend=self.backend,
+                                 registry=self.registry)
+        except POOL_ERRORS:
+            with self.cond:
+                self.checked_out.add(name)
+            raise
+
+        LOG.info('checked in %s', name)
+        with self.cond:
+            self.ready.append(name)
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return {
+                'size': self.size,
+                'ready': list(self.ready),
+                'checked_out': sorted(self.checked_out),
+            }
+
+    def stop(self, remove=True):
+        '''Stop refilling and (optionally) remove the ready snapshots.
+
+        Snapshots that are still checked out are left alone.
+        '''
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        if remove:
+            while self.ready:
+                api.remove_snapshot(self.ready.popleft(),
+                                    backend=self.backend,
+                                    registry=self.registry)
+
+
+class PoolRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.dispatch(request)
+            except (ValueError, KeyError) + POOL_ERRORS as e:
+                response = {'ok': False, 'error': str(e)}
+
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def dispatch(self, request):
+        pool = self.server.pool
+        op = request['op']
+
+        if op == 'checkout':
+            name = pool.checkout(timeout=request.get('timeout'))
+            return {'ok': True, 'name': name,
+                    'device': '/dev/mapper/{}'.format(name)}
+        elif op == 'checkin':
+            pool.checkin(request['name'])
+            return {'ok': True}
+        elif op == 'status':
+            return dict(pool.status(), ok=True)
+        else:
+            raise ValueError('unknown operation: {}'.format(op))
+
+
+class PoolServer(socketserver.ThreadingUnixStreamServer):
+    '''Serve a SnapshotPool on a unix socket.'''
+
+    daemon_threads = True
+
+    def __init__(self, pool, path=DEFAULT_SOCKET):
+        self.pool = pool
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.is_socket():
+            path.unlink()
+
+        super().__init__(str(path), PoolRequestHandler)
+        os.chmod(str(path), 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+class PoolClient():
+    '''Talk to a PoolServer.'''
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = Path(path)
+
+    def request(self, op, **kwargs):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(self.path))
+            request = json.dumps(dict(kwargs, op=op)).encode('utf-8')
+            sock.sendall(request + b'\n')
+            with sock.makefile('rb') as fd:
+                response = json.loads(fd.readline().decode('utf-8'))
+
+        if not response.get('ok'):
+            raise BullError(response.get('error'))
+
+        return response
+
+    def checkout(self, timeout=None):
+        return self.request('checkout', timeout=timeout)['device']
+
+    def checkin(self, name):
+        self.request('checkin', name=name)
+
+    def status(self):
+        return self.request('status')
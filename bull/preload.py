@@ -0,0 +1,126 @@
+'''Copy a source into RAM before snapshotting it.
+
+With preload, the sectors of the source that snapshots cover are
+copied once into a compressed zram device, and the base device maps
+onto that copy rather than onto a source on slow storage (an SD card,
+NFS or a spinning disk). The copy streams the source in large chunks
+and skips blocks that are all zeros, which a newly sized zram device
+already reads back as zeros. Snapshots of the same source share one
+copy, which is removed with the last of them.
+'''
+
+import attr
+import logging
+import time
+
+from bull import timing
+from bull import zram
+from bull.host import RUN_DIR, get_host
+
+LOG = logging.getLogger(__name__)
+PRELOAD_LOCK = RUN_DIR / 'preload.lock'
+CHUNK_SIZE = 2**20
+ZERO_BLOCK_SIZE = 2**16
+PAGE_SIZE = 4096
+
+
+@attr.s
+class CopyStats():
+    '''How a preload went. Sizes are in bytes, elapsed in seconds.'''
+
+    bytes_read = attr.ib(default=0)
+    bytes_written = attr.ib(default=0)
+    elapsed = attr.ib(default=0.0)
+
+    @property
+    def throughput(self):
+        '''Bytes read per second.'''
+
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / self.elapsed
+
+    def __str__(self):
+        return '{:.1f} MiB in {:.2f}s ({:.1f} MiB/s), {:.1f} MiB ' \
+            'written'.format(self.bytes_read / 2**20, self.elapsed,
+                             self.throughput / 2**20,
+                             self.bytes_written / 2**20)
+
+
+def copy_nonzero(src, dest, offset, length, chunk_size=CHUNK_SIZE,
+                 block_size=ZERO_BLOCK_SIZE):
+    '''Copy length bytes from offset in src to the start of dest,
+    leaving out blocks of block_size bytes that are all zeros.
+
+    dest must already read as zeros. Returns a CopyStats.
+    '''
+
+    host = get_host()
+    zeros = bytes(block_size)
+    stats = CopyStats()
+    started = time.perf_counter()
+
+    with host.open_device(src) as infd, \
+            host.open_device(dest, 'r+b') as outfd:
+        infd.seek(offset)
+
+        while stats.bytes_read < length:
+            chunk = infd.read(min(chunk_size, length - stats.bytes_read))
+            if not chunk:
+                break
+
+            # Write each run of nonzero blocks in one go.
+            view = memoryview(chunk)
+            run = None
+            for start in range(0, len(chunk), block_size):
+                block = view[start:start + block_size]
+                if block == zeros[:len(block)]:
+                    if run is not None:
+                        stats.bytes_written += _write_at(
+                            outfd, stats.bytes_read + run, view[run:start])
+                        run = None
+                elif run is None:
+                    run = start
+
+            if run is not None:
+                stats.bytes_written += _write_at(
+                    outfd, stats.bytes_read + run, view[run:])
+
+            stats.bytes_read += len(chunk)
+
+        # The base device maps the copy as soon as we return, so none
+        # of it may be left in the page cache.
+        host.sync_device(outfd)
+
+    stats.elapsed = time.perf_counter() - started
+    return stats
+
+
+def _write_at(fd, pos, data):
+    fd.seek(pos)
+    fd.write(data)
+    return len(data)
+
+
+def preload(source, zram_options=None):
+    '''Copy the data sectors of source (an api.Source) into a new zram
+    device. Returns the ZramDevice and a CopyStats.
+
+    zram_options are passed to ZramDevice.configure.
+    '''
+
+    size = -(-source.data_size // PAGE_SIZE) * PAGE_SIZE
+    origin = zram.ZramDevice.create()
+
+    try:
+        origin.configure(size, **(zram_options or {}))
+        with timing.timed('preload copy'):
+            stats = copy_nonzero(source.device.device, origin.device,
+                                 source.offset * 512, source.data_size)
+    except Exception:
+        origin.remove()
+        raise
+
+    LOG.info('preloaded %s onto %s: %s', source.device.device,
+             origin.device, stats)
+    return origin, stats
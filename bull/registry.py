@@ -0,0 +1,243 @@
+'''Remember how each snapshot was put together.
+
+When bull creates a snapshot it records the devices it is built from
+(loop device, base device, copy-on-write device or thin pool, zram
+devices) and the parameters it was created with in a JSON file in
+/run/bull. Removing and listing snapshots read that file instead of
+working the stack out again from the kernel, and shared base and loop
+devices are removed once no recorded snapshot uses them.
+
+The file lives on tmpfs, as the devices it describes do not survive a
+reboot either. If it and the kernel disagree (for example, because a
+device was removed by hand), reconcile() rebuilds it from the kernel.
+'''
+
+import attr
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from bull import listing
+from bull import mapper
+from bull.common import lock_file
+from bull.host import RUN_DIR, get_host
+
+LOG = logging.getLogger(__name__)
+REGISTRY_PATH = RUN_DIR / 'registry.json'
+REGISTRY_VERSION = 1
+
+
+@attr.s
+class SnapshotRecord():
+    '''What went into one snapshot.
+
+    size and backing_size are in bytes, offset is in sectors. backing
+    is the copy-on-write device of a classic snapshot or the pool of a
+    thin volume, and zram lists the zram devices behind it. origin is
+    the zram device holding a preloaded copy of the source, if any.
+    loops lists the loop devices of any further sources of a snapshot
+    built on several.
+    store is the file or device holding a persistent exception store
+    (see bull.store), and store_loop the loop device a file store is
+    attached to. spill is the file or device idle zram pages are
+    written back to (see bull.spill), spill_loop the loop device a
+    spill file is attached to and spill_dev the snapshot's slice of it,
+    which covers the (offset, sectors) spill_extent of the spill device.
+    views lists the partition devices mapped onto a snapshot of a
+    whole disk.
+    '''
+
+    name = attr.ib()
+    engine = attr.ib(default='snapshot')
+    size = attr.ib(default=None)
+    source = attr.ib(default=None)
+    source_device = attr.ib(default=None)
+    loop = attr.ib(default=None)
+    loops = attr.ib(default=attr.Factory(list))
+    origin = attr.ib(default=None)
+    offset = attr.ib(default=0)
+    base = attr.ib(default=None)
+    backing = attr.ib(default=None)
+    dev_id = attr.ib(default=None)
+    zram = attr.ib(default=attr.Factory(list))
+    backing_size = attr.ib(default=None)
+    created = attr.ib(default=attr.Factory(time.time))
+    params = attr.ib(default=attr.Factory(dict))
+    store = attr.ib(default=None)
+    store_loop = attr.ib(default=None)
+    spill = attr.ib(default=None)
+    spill_loop = attr.ib(default=None)
+    spill_dev = attr.ib(default=None)
+    spill_extent = attr.ib(default=None)
+    views = attr.ib(default=attr.Factory(list))
+
+    @classmethod
+    def from_dict(kls, data):
+        fields = {field.name for field in attr.fields(kls)}
+        return kls(**{k: v for k, v in data.items() if k in fields})
+
+    def to_dict(self):
+        return attr.asdict(self)
+
+
+class Registry():
+    '''The set of SnapshotRecords stored in a JSON file.
+
+    Changes are made inside transaction(), which holds a lock file so
+    that concurrent bull processes see each other's changes, and
+    replace the file atomically.
+    '''
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = get_host().run_path(path)
+        self.lockfile = self.path.with_name(self.path.name + '.lock')
+        self.lock = threading.RLock()
+
+    def exists(self):
+        return self.path.exists()
+
+    def load(self):
+        '''Return a dictionary mapping names to SnapshotRecords.'''
+
+        try:
+            with self.path.open() as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            LOG.warning('ignoring unreadable registry %s: %s', self.path, e)
+            return {}
+
+        return {name: SnapshotRecord.from_dict(record)
+                for name, record in data.get('snapshots', {}).items()}
+
+    def save(self, records):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {'version': REGISTRY_VERSION,
+                'snapshots': {name: record.to_dict()
+                              for name, record in sorted(records.items())}}
+
+        tmp = self.path.with_name('.{}.{}'.format(self.path.name,
+                                                  os.getpid()))
+        with tmp.open('w') as fd:
+            json.dump(data, fd, indent=2)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(str(tmp), str(self.path))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Yield the records, and save them if the block succeeds.'''
+
+        with self.lock, lock_file(self.lockfile):
+            records = self.load()
+            yield records
+            self.save(records)
+
+    def get(self, name):
+        return self.load().get(name)
+
+    def records(self, prefix=None):
+        return [record for name, record in sorted(self.load().items())
+                if prefix is None or name.startswith(prefix)]
+
+    def add(self, *records):
+        with self.transaction() as current:
+            for record in records:
+                current[record.name] = record
+
+    def remove(self, name):
+        with self.transaction() as current:
+            return current.pop(name, None)
+
+    def update(self, name, **changes):
+        '''Change fields of a record, if there is one for name.'''
+
+        with self.transaction() as current:
+            if name in current:
+                current[name] = attr.evolve(current[name], **changes)
+                return current[name]
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+
+    if _registry is None:
+        _registry = Registry()
+
+    return _registry
+
+
+def set_registry(registry):
+    global _registry
+    _registry = registry
+
+
+def record_from_info(info, dev_id=None):
+    '''Build a SnapshotRecord from a listing.SnapshotInfo.'''
+
+    loopdev = info.source if (info.source or '').startswith('/dev/loop') \
+        else None
+    origin = info.source if (info.source or '').startswith('/dev/zram') \
+        else None
+    return SnapshotRecord(
+        info.name, engine=info.engine, size=info.size,
+        source=info.source_file or info.source,
+        source_device=info.source, loop=loopdev, origin=origin,
+        offset=info.offset // 512, base=info.base, backing=info.backing,
+        dev_id=dev_id, zram=list(info.backing_devices),
+        backing_size=info.total, created=None)
+
+
+def reconcile(registry=None, backend=None, inventory=None):
+    '''Make the registry match the snapshots that exist in the kernel.
+
+    Records for snapshots that no longer exist are dropped. Snapshots
+    that are missing from the registry, or whose record does not match
+    their devices, are recorded afresh. Only snapshots stacked on a
+    bull base device (one named *-base) are considered. Returns the
+    lists of names added and dropped.
+    '''
+
+    registry = registry or get_registry()
+    sweep = listing.DeviceSweep(backend=backend, inventory=inventory)
+
+    found = {}
+    for name in sorted(sweep.tables):
+        info = sweep.describe(name)
+        if info is None or not (info.base or '').endswith('-base'):
+            continue
+
+        target = sweep.tables[name][0].target
+        dev_id = target.dev_id if isinstance(target, mapper.Thin) else None
+        found[name] = record_from_info(info, dev_id=dev_id)
+
+    added, dropped = [], []
+    with registry.transaction() as records:
+        for name in sorted(set(records) - set(found)):
+            LOG.info('dropping %s from the registry', name)
+            del records[name]
+            dropped.append(name)
+
+        for name, record in found.items():
+            current = records.get(name)
+            if current is not None and (current.base, current.backing,
+                                        current.zram) == \
+                    (record.base, record.backing, record.zram):
+                continue
+
+            if current is not None:
+                record = attr.evolve(record, created=current.created,
+                                     params=current.params)
+
+            LOG.info('recording %s in the registry', name)
+            records[name] = record
+            added.append(name)
+
+    return added, dropped
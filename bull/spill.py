@@ -0,0 +1,163 @@
+'''Spill devices for writing idle zram pages back to disk.
+
+A long-lived snapshot keeps everything written to it in RAM, in its
+zram backing store. zram can instead write pages back to a backing
+device of its own (its backing_dev), after which they only cost RAM
+again when they are read. bull gives each snapshot a slice of a spill
+device (a file, on a loop device with direct I/O, or a block device)
+as a linear device-mapper device called {name}-spill, as the kernel
+will only let one zram device use a block device at a time. Snapshots
+created at different times can share a spill device: the registry
+records the extent of each slice, and new slices go where no recorded
+one is (see bull.api.used_spill_extents). SPILL_LOCK is held from
+working that out until the new slices are recorded.
+
+Which pages are written back, and when, is up to watch.Spiller.
+'''
+
+import attr
+import logging
+import os
+from pathlib import Path
+
+from bull import loop
+from bull import mapper
+from bull.blockdev import BlockDevice
+from bull.exceptions import NoSuchDevice
+from bull.host import RUN_DIR, get_host
+from bull.zram import PAGE_SIZE
+
+LOG = logging.getLogger(__name__)
+SPILL_SUFFIX = '-spill'
+SPILL_LOCK = RUN_DIR / 'spill.lock'
+
+
+@attr.s
+class Spill():
+    '''A spill device opened for use: path is the file or device named
+    by the user, device the block device holding it (a loop device, for
+    a file).'''
+
+    path = attr.ib(converter=str)
+    device = attr.ib()
+    loopdev = attr.ib(default=None)
+
+    def free_extents(self, used=()):
+        '''Return the (offset, sectors) extents of the spill device
+        that none of the used extents cover.'''
+
+        free = []
+        start = 0
+        for offset, sectors in sorted(used):
+            if offset > start:
+                free.append((start, offset - start))
+            start = max(start, offset + sectors)
+
+        end = self.device.get_size_sectors()
+        if end > start:
+            free.append((start, end - start))
+        return free
+
+    def slice_size(self, count, size, used=()):
+        '''Return the bytes each of count slices can have, up to
+        size, outside the used extents.'''
+
+        available = sum(sectors for offset, sectors
+                        in self.free_extents(used)) * 512 // count
+        return min(size, available) // PAGE_SIZE * PAGE_SIZE
+
+    def place_slices(self, count, size, used=()):
+        '''Return the offsets (in sectors) of count slices of size
+        bytes outside the used extents.'''
+
+        offsets = []
+        for start, sectors in self.free_extents(used):
+            while sectors >= size // 512 and len(offsets) < count:
+                offsets.append(start)
+                start += size // 512
+                sectors -= size // 512
+
+        if len(offsets) < count:
+            raise ValueError('{} has no room for {} slices of {} '
+                             'bytes'.format(self.path, count, size))
+        return offsets
+
+    def create_slices(self, names, size, used=(), backend=None):
+        '''Create a {name}-spill device for each of names, each
+        holding up to size bytes of the spill device outside the used
+        (offset, sectors) extents. Returns the MapperDevices.'''
+
+        size = self.slice_size(len(names), size, used=used)
+        if size < PAGE_SIZE:
+            raise ValueError('{} is too small to spill to'.format(self.path))
+        offsets = self.place_slices(len(names), size, used=used)
+
+        slices = []
+        try:
+            for name, offset in zip(names, offsets):
+                spill = mapper.MapperDevice.create(
+                    '{}{}'.format(name, SPILL_SUFFIX), exclusive=True,
+                    backend=backend)
+                slices.append(spill)
+                spill.table.append(
+                    mapper.Segment(0, size // 512,
+                                   mapper.Linear(self.device.device,
+                                                 offset)))
+                spill.load()
+        except Exception:
+            for spill in slices:
+                spill.remove()
+            raise
+
+        return slices
+
+    def close(self):
+        '''Detach the loop device of a spill file. The file is kept.'''
+
+        if self.loopdev is not None:
+            self.loopdev.remove()
+
+
+def open_spill(path, size=None):
+    '''Open the spill device at path. A file is put on a loop device
+    with direct I/O, so that pages written back leave the page cache
+    too.
+
+    If size is given and path does not exist, a sparse file of size
+    bytes is created first.
+    '''
+
+    host = get_host()
+    if host.is_block_device(path):
+        return Spill(path, BlockDevice(path))
+
+    if not host.exists(path):
+        if size is None:
+            raise NoSuchDevice(path)
+        LOG.info('creating spill file %s', path)
+        with open(str(path), 'xb') as fd:
+            fd.truncate(size)
+
+    loopdev = loop.LoopDevice.attach(os.path.abspath(str(path)),
+                                     direct_io=True, share=False)
+    return Spill(path, loopdev, loopdev=loopdev)
+
+
+def is_spill_device(device):
+    return Path(str(device)).parent == Path('/dev/mapper') and \
+        str(device).endswith(SPILL_SUFFIX)
+
+
+def release(device, backend=None):
+    '''Remove a spill slice that its zram device has let go of, and the
+    loop device under it once no other slice uses it.'''
+
+    spill = mapper.MapperDevice(device, backend=backend)
+    spill.table.resolve()
+    below = spill.table[0].target.device
+    spill.remove()
+
+    if Path(str(below)).name.startswith('loop'):
+        loopdev = loop.LoopDevice(below)
+        if loopdev.exists() and not loopdev.holders():
+            loopdev.remove()
@@ -0,0 +1,151 @@
+'''Persistent copy-on-write stores on a file or block device.
+
+A snapshot normally keeps its exceptions in zram, so it can be no
+bigger than RAM and is lost on reboot. A persistent store keeps them
+on a local file or device instead, using dm-snapshot's persistent
+exception format, and records how the snapshot was built so that
+api.attach_snapshot can put the same stack back together later. The
+kernel reads the exceptions back from the store itself; nothing is
+replayed.
+
+The first HEADER_SECTORS of the store hold a JSON header (see
+StoreHeader); the snapshot's -cow device maps the rest.
+'''
+
+import attr
+import json
+import logging
+import os
+import time
+
+from bull import loop
+from bull.blockdev import BlockDevice
+from bull.exceptions import DeviceExists, NoSuchDevice
+from bull.host import get_host
+
+LOG = logging.getLogger(__name__)
+HEADER_SECTORS = 8
+HEADER_SIZE = HEADER_SECTORS * 512
+MAGIC = b'bull-cow-store 1\n'
+
+
+@attr.s
+class StoreHeader():
+    '''How the snapshot in a store was built.
+
+    offset and data_sectors describe the region of the source that the
+    base device maps, in sectors; size is the size of the snapshot in
+    bytes.
+    '''
+
+    name = attr.ib()
+    source = attr.ib()
+    part = attr.ib(default=None)
+    offset = attr.ib(default=0)
+    data_sectors = attr.ib(default=None)
+    size = attr.ib(default=None)
+    chunksize = attr.ib(default=16)
+    created = attr.ib(default=attr.Factory(time.time))
+
+    def to_bytes(self):
+        data = MAGIC + json.dumps(attr.asdict(self)).encode('utf-8')
+        if len(data) >= HEADER_SIZE:
+            raise ValueError('store header too long')
+        return data + bytes(HEADER_SIZE - len(data))
+
+    @classmethod
+    def from_bytes(kls, data):
+        '''Return the header in data, or None if there is none.'''
+
+        if not data.startswith(MAGIC):
+            return None
+
+        fields = {field.name for field in attr.fields(kls)}
+        header = json.loads(data[len(MAGIC):].rstrip(b'\0').decode('utf-8'))
+        return kls(**{k: v for k, v in header.items() if k in fields})
+
+
+@attr.s
+class Store():
+    '''A store opened for use: path is the file or device named by the
+    user, device the block device holding it (a loop device, for a
+    file).'''
+
+    path = attr.ib(converter=str)
+    device = attr.ib()
+    loopdev = attr.ib(default=None)
+
+    @property
+    def cow_sectors(self):
+        '''Sectors available to dm-snapshot, after the header.'''
+
+        return self.device.get_size_sectors() - HEADER_SECTORS
+
+    def read_header(self):
+        with get_host().open_device(self.device.device) as fd:
+            return StoreHeader.from_bytes(fd.read(HEADER_SIZE))
+
+    def write_header(self, header, clear=True):
+        '''Write header, and (if clear is true) clear dm-snapshot's own
+        header so that the kernel starts with an empty exception
+        store.'''
+
+        # dm-snapshot reads the store with its own I/O, so make sure none
+        # of this is left in the page cache.
+        with get_host().open_device(self.device.device, 'r+b') as fd:
+            fd.write(header.to_bytes())
+            if clear:
+                fd.write(bytes(header.chunksize * 512))
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def close(self):
+        '''Detach the loop device of a file store. The file is kept.'''
+
+        if self.loopdev is not None:
+            self.loopdev.remove()
+
+
+def open_store(path, size=None):
+    '''Open the store at path. A file is put on a loop device with
+    direct I/O, so that the page cache does not hold a second copy of
+    what the snapshot has written.
+
+    If size is given and path does not exist, a sparse file of size
+    bytes (plus the header) is created first.
+    '''
+
+    host = get_host()
+    if host.is_block_device(path):
+        return Store(path, BlockDevice(path))
+
+    if not host.exists(path):
+        if size is None:
+            raise NoSuchDevice(path)
+        LOG.info('creating store file %s', path)
+        with open(str(path), 'xb') as fd:
+            fd.truncate(size + HEADER_SIZE)
+
+    loopdev = loop.LoopDevice.attach(os.path.abspath(str(path)),
+                                     direct_io=True, share=False)
+    return Store(path, loopdev, loopdev=loopdev)
+
+
+def create_store(path, size=None):
+    '''Open (see open_store) a store for a new snapshot, whose header
+    is written once the snapshot is named.
+
+    A store that already holds a snapshot is not overwritten; it can be
+    attached instead.
+    '''
+
+    store = open_store(path, size=size)
+    try:
+        if store.read_header() is not None:
+            raise DeviceExists('{} already holds a snapshot; use bull '
+                               'attach'.format(path))
+    except Exception:
+        store.close()
+        raise
+
+    return store
@@ -0,0 +1,195 @@
+'''Thin provisioned snapshots on a RAM-backed thin pool.
+
+Instead of stacking a dm-snapshot per copy, the source is used as the
+external origin of thin volumes in a pool whose metadata and data
+devices are zram devices. Creating, cloning and deleting volumes are
+messages to the pool rather than new stacks of devices.
+
+See https://www.kernel.org/doc/Documentation/device-mapper/thin-provisioning.txt
+'''  # NOQA
+
+import attr
+import logging
+
+from bull import mapper
+from bull import zram
+from bull.exceptions import DeviceMapperError, NoDevicesAvailable
+
+LOG = logging.getLogger(__name__)
+
+THIN_BLOCK_SIZE = 128
+MIN_METADATA_SIZE = 2 * 2**20
+METADATA_BYTES_PER_BLOCK = 64
+MAX_DEV_ID = 2**24 - 1
+MAX_ALLOCATE_ATTEMPTS = 64
+
+
+def metadata_size(data_size, block_size=THIN_BLOCK_SIZE):
+    '''Estimate the size of the metadata device for a pool.
+
+    This is a conservative approximation of thin_metadata_size:
+    roughly 64 bytes of metadata per data block, rounded up to a
+    4KiB metadata block, and never less than 2MiB.
+    '''
+
+    blocks = data_size // (block_size * 512) + 1
+    size = blocks * METADATA_BYTES_PER_BLOCK
+    size = (size + 4095) // 4096 * 4096
+    return max(size, MIN_METADATA_SIZE)
+
+
+@attr.s
+class PoolStatus():
+    '''The status line of a thin-pool target.'''
+
+    transaction_id = attr.ib(converter=int)
+    used_metadata_blocks = attr.ib(converter=int)
+    total_metadata_blocks = attr.ib(converter=int)
+    used_data_blocks = attr.ib(converter=int)
+    total_data_blocks = attr.ib(converter=int)
+    mode = attr.ib()
+
+    @classmethod
+    def from_string(kls, status):
+        start, length, target_type, *args = status.split()
+        if target_type != 'thin-pool':
+            raise ValueError('not a thin-pool status: {}'.format(status))
+
+        if args[0] in ('Fail', 'Error'):
+            return kls(0, 0, 0, 0, 0, args[0])
+
+        used_meta, total_meta = args[1].split('/')
+        used_data, total_data = args[2].split('/')
+        return kls(args[0], used_meta, total_meta, used_data, total_data,
+                   args[4])
+
+
+class ThinPool():
+    '''A thin pool and the zram devices behind it.'''
+
+    def __init__(self, device, backend=None):
+        self.device = mapper.MapperDevice(device, backend=backend)
+        self.next_id = None
+
+    @property
+    def name(self):
+        return self.device.name
+
+    @classmethod
+    def create(kls, name, data_size, block_size=THIN_BLOCK_SIZE,
+               backend=None, zram_options=None):
+        '''Create a thin pool with data_size bytes of zram data space.
+
+        zram_options are applied to the data device.
+        '''
+
+        data_sectors = data_size // 512 // block_size * block_size
+        if data_sectors == 0:
+            raise ValueError('thin pool must hold at least one block')
+
+        devices = []
+        try:
+            meta = zram.ZramDevice.create()
+            devices.append(meta)
+            meta.size = metadata_size(data_size, block_size)
+            data = zram.ZramDevice.create()
+            devices.append(data)
+            data.configure(data_sectors * 512, **(zram_options or {}))
+
+            LOG.debug('creating thin pool %s with metadata %s and data %s',
+                      name, meta.device, data.device)
+
+            pool = mapper.MapperDevice.create(name, exclusive=True,
+                                              backend=backend)
+            devices.insert(0, pool)
+            pool.table.append(
+                mapper.Segment(0, data_sectors,
+                               mapper.Thinpool(meta.device, data.device,
+                                               block_size, 0)))
+            pool.load()
+        except Exception:
+            for device in devices:
+                device.remove()
+            raise
+
+        return kls(pool.device, backend=backend)
+
+    def status(self):
+        return PoolStatus.from_string(self.device.status())
+
+    def active_dev_ids(self):
+        '''Return the ids of active thin volumes in this pool.'''
+
+        backend = self.device.backend
+        refs = {str(self.device.device)}
+        try:
+            refs.add('{}:{}'.format(self.device.major, self.device.minor))
+        except OSError:
+            pass
+
+        ids = []
+
+        for name in backend.list_devices('thin'):
+            for segment in mapper.Table.from_string(backend.table(name)):
+                if segment.target.pool_dev in refs:
+                    ids.append(segment.target.dev_id)
+
+        return ids
+
+    def _allocate(self, message):
+        '''Send a create message with the first free device id.
+
+        Active volumes tell us where to start looking, and a message
+        that fails because the id is in use moves on to the next one.
+        They are only listed once; later volumes take the ids after
+        the last one handed out.
+        '''
+
+        if self.next_id is None:
+            self.next_id = max(self.active_dev_ids(), default=-1) + 1
+        dev_id = self.next_id
+
+        for attempt in range(MAX_ALLOCATE_ATTEMPTS):
+            if dev_id > MAX_DEV_ID:
+                break
+
+            try:
+                self.device.message(message.format(dev_id=dev_id))
+            except DeviceMapperError as e:
+                LOG.debug('device id %d unavailable: %s', dev_id, e)
+                dev_id += 1
+            else:
+                self.next_id = dev_id + 1
+                return dev_id
+
+        raise NoDevicesAvailable(self.name)
+
+    def create_thin(self):
+        '''Create a new, empty thin volume and return its id.'''
+
+        return self._allocate('create_thin {dev_id}')
+
+    def create_snap(self, origin_id):
+        '''Create a snapshot of thin volume origin_id and return its id.
+
+        If the origin is active it must be suspended while this runs.
+        '''
+
+        return self._allocate('create_snap {{dev_id}} {}'.format(origin_id))
+
+    def delete(self, dev_id):
+        self.device.message('delete {}'.format(dev_id))
+
+    def holders(self):
+        return self.device.holders()
+
+    def remove(self):
+        '''Remove the pool and its metadata and data devices.'''
+
+        self.device.refresh()
+        self.device.table.resolve()
+        target = self.device.table[0].target
+
+        self.device.remove()
+        zram.ZramDevice(target.metadata_dev).remove()
+        zram.ZramDevice(target.data_dev).remove()
@@ -0,0 +1,164 @@
+'''Time the steps bull takes.
+
+Every command bull runs, device-mapper ioctl it makes and zram sysfs
+attribute it writes is timed and tagged with the phase of the
+operation it belongs to (set with phase()). The recorded events can be
+summarised (bull --timings), written out as a trace in the Chrome
+trace event format (bull --trace) and folded into the latency
+histograms exported by bull metrics.
+'''
+
+import attr
+import collections
+import contextlib
+import threading
+import time
+
+MAX_EVENTS = 100000
+
+
+@attr.s(frozen=True)
+class Event():
+    '''One timed step. Times are in seconds.
+
+    Events with no operation time a whole phase.
+    '''
+
+    phase = attr.ib()
+    operation = attr.ib()
+    start = attr.ib()
+    elapsed = attr.ib()
+    thread = attr.ib(default=None)
+
+
+class Recorder():
+    '''Collect Events from any thread.
+
+    Only the last maxlen events are kept, so that long-running
+    processes do not grow without bound.
+    '''
+
+    def __init__(self, maxlen=MAX_EVENTS):
+        self.events = collections.deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.epoch = time.monotonic()
+
+    def current_phase(self):
+        phases = getattr(self.local, 'phases', None)
+        return phases[-1] if phases else None
+
+    def _add(self, phase, operation, started):
+        event = Event(phase, operation, started - self.epoch,
+                      time.monotonic() - started, threading.get_ident())
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Tag everything timed inside the block with phase name.'''
+
+        if not hasattr(self.local, 'phases'):
+            self.local.phases = []
+
+        self.local.phases.append(name)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.local.phases.pop()
+            self._add(name, None, started)
+
+    @contextlib.contextmanager
+    def timed(self, operation, phase=None):
+        '''Time the block as operation, in phase or the current phase.'''
+
+        phase = phase or self.current_phase()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._add(phase, operation, started)
+
+    def take(self):
+        '''Return the recorded events and forget them.'''
+
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+
+        return events
+
+
+@attr.s
+class Summary():
+    '''Totals for one (phase, operation) pair.'''
+
+    phase = attr.ib()
+    operation = attr.ib()
+    count = attr.ib(default=0)
+    total = attr.ib(default=0.0)
+    max = attr.ib(default=0.0)
+
+
+def summarize(events):
+    '''Return a Summary for each phase and operation, phases in the order
+    they started and their operations by decreasing total time.'''
+
+    summaries = {}
+    order = {}
+    for event in sorted(events, key=lambda event: event.start):
+        order.setdefault(event.phase, len(order))
+        key = (event.phase, event.operation)
+        summary = summaries.setdefault(key, Summary(*key))
+        summary.count += 1
+        summary.total += event.elapsed
+        summary.max = max(summary.max, event.elapsed)
+
+    return sorted(summaries.values(), key=lambda s: (
+        order[s.phase], s.operation is not None, -s.total))
+
+
+def format_summary(events):
+    lines = ['{:<12} {:<24} {:>6} {:>10} {:>10}'.format(
+        'PHASE', 'OPERATION', 'COUNT', 'TOTAL_MS', 'MAX_MS')]
+
+    for s in summarize(events):
+        lines.append('{:<12} {:<24} {:>6} {:>10.2f} {:>10.2f}'.format(
+            s.phase or '-', s.operation or '(phase)', s.count,
+            s.total * 1000, s.max * 1000))
+
+    return '\n'.join(lines)
+
+
+def trace(events):
+    '''Return events in the Chrome trace event format, as read by
+    chrome://tracing and Perfetto.'''
+
+    return {
+        'traceEvents': [{
+            'name': event.operation or event.phase,
+            'cat': event.phase or 'none',
+            'ph': 'X',
+            'ts': event.start * 1e6,
+            'dur': event.elapsed * 1e6,
+            'pid': 1,
+            'tid': event.thread,
+        } for event in events],
+        'displayTimeUnit': 'ms',
+    }
+
+
+_recorder = Recorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+def phase(name):
+    return _recorder.phase(name)
+
+
+def timed(operation, phase=None):
+    return _recorder.timed(operation, phase=phase)
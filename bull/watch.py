@@ -0,0 +1,266 @@
+'''Watch snapshot usage and grow COW stores before they overflow.
+
+When the exception store of a non-persistent snapshot fills up the
+kernel invalidates the snapshot. The Watcher polls the status of
+every snapshot in one sweep (a single dmsetup call, or one ioctl per
+device) and, when a snapshot crosses a watermark, grows its COW
+device (see bull.cow) with another zram device.
+
+A Spiller, if the Watcher has one, writes idle pages of snapshots
+created with a spill device (see bull.spill) back to it.
+'''
+
+import attr
+import logging
+import time
+
+from bull import budget as snapbudget
+from bull import cow
+from bull import mapper
+from bull import zram
+from bull.exceptions import BullError, OverBudget
+from bull.registry import get_registry
+
+LOG = logging.getLogger(__name__)
+DEFAULT_WATERMARK = 0.8
+DEFAULT_INTERVAL = 1.0
+
+
+@attr.s
+class SnapshotUsage():
+    '''Usage of a snapshot's exception store, from its status line.
+
+    state is 'valid' while the snapshot is usable, or the kernel's
+    description ('Invalid', 'Overflow', ...) once it is not.
+    '''
+
+    name = attr.ib()
+    allocated = attr.ib(converter=int, default=0)
+    total = attr.ib(converter=int, default=0)
+    metadata = attr.ib(converter=int, default=0)
+    state = attr.ib(default='valid')
+
+    @classmethod
+    def from_status(kls, name, status):
+        start, length, target_type, *args = status.split()
+        if target_type != 'snapshot':
+            raise ValueError('not a snapshot status: {}'.format(status))
+
+        if not args or '/' not in args[0]:
+            return kls(name, state=' '.join(args) or 'Unknown')
+
+        allocated, total = args[0].split('/')
+        metadata = args[1] if len(args) > 1 else 0
+        return kls(name, allocated, total, metadata)
+
+    @property
+    def valid(self):
+        return self.state == 'valid'
+
+    @property
+    def used(self):
+        '''Fraction of the exception store in use.'''
+
+        # dm-snapshot counts the metadata sectors in allocated.
+        if self.total == 0:
+            return 0.0
+        return self.allocated / self.total
+
+
+def snapshot_usage(backend=None):
+    '''Return a SnapshotUsage for every snapshot, from one status sweep.'''
+
+    backend = backend or mapper.get_backend()
+    usage = []
+    for name, status in sorted(backend.status_all('snapshot').items()):
+        line = status.splitlines()[0]
+        try:
+            usage.append(SnapshotUsage.from_status(name, line))
+        except ValueError:
+            LOG.debug('ignoring %s: %s', name, line)
+
+    return usage
+
+
+@attr.s
+class Spiller():
+    '''Write idle zram pages of spilling snapshots back to disk.
+
+    Every every seconds, pages that have not been touched since the
+    last pass are written back and the rest are marked idle. If the
+    zram devices of spilling snapshots use more than budget bytes of
+    RAM, everything is written back at once. Either can be None. At
+    most limit bytes are written back from each device in a pass.
+    '''
+
+    every = attr.ib(default=None)
+    budget = attr.ib(default=None)
+    limit = attr.ib(default=None)
+    prefix = attr.ib(default=None)
+    registry = attr.ib(default=None)
+    last = attr.ib(default=None)
+
+    def devices(self):
+        '''Return the zram devices that have a spill device.'''
+
+        registry = self.registry or get_registry()
+        return [zram.ZramDevice(record.zram[0])
+                for record in registry.records(prefix=self.prefix)
+                if record.spill_dev is not None and record.zram]
+
+    def spill(self, devices):
+        '''Write back the idle pages of devices. Return the number of
+        bytes written.'''
+
+        written = 0
+        for dev in devices:
+            try:
+                before = dev.bd_stat().bd_writes
+                if self.limit is not None:
+                    dev.set_writeback_limit(self.limit)
+                dev.writeback('idle')
+                written += (dev.bd_stat().bd_writes - before) * \
+                    zram.PAGE_SIZE
+            except OSError as e:
+                LOG.error('failed to write back %s: %s', dev.device, e)
+
+        return written
+
+    def mark_idle(self, devices):
+        for dev in devices:
+            try:
+                dev.mark_idle()
+            except OSError as e:
+                LOG.error('failed to mark %s idle: %s', dev.device, e)
+
+    def poll(self, now=None):
+        '''Write back whatever is due. Return the number of bytes
+        written.'''
+
+        now = time.monotonic() if now is None else now
+        devices = self.devices()
+        if not devices:
+            return 0
+
+        if self.budget is not None:
+            used = sum(dev.mm_stat().mem_used_total for dev in devices)
+            if used > self.budget:
+                LOG.info('spilling snapshots use %d bytes of RAM; writing '
+                         'back everything', used)
+                self.mark_idle(devices)
+                self.last = now
+                return self.spill(devices)
+
+        if self.every is None:
+            return 0
+        if self.last is not None and now - self.last < self.every:
+            return 0
+
+        # Pages marked on the last pass and not touched since are
+        # still idle.
+        written = self.spill(devices)
+        self.mark_idle(devices)
+        self.last = now
+        if written:
+            LOG.info('wrote back %d idle bytes', written)
+        return written
+
+
+@attr.s
+class Watcher():
+    '''Grow COW stores of snapshots whose usage crosses watermark.
+
+    Each time a snapshot is grown it gets grow_by more bytes (by
+    default, as much again as it already has), but never more than
+    max_size in total. If prefix is set, only snapshots whose names
+    start with it are watched. New zram devices are added to the
+    snapshot's record in the registry. spiller is a Spiller to poll
+    along with the snapshots.
+    '''
+
+    watermark = attr.ib(default=DEFAULT_WATERMARK)
+    interval = attr.ib(default=DEFAULT_INTERVAL)
+    grow_by = attr.ib(default=None)
+    max_size = attr.ib(default=None)
+    prefix = attr.ib(default=None)
+    backend = attr.ib(default=None)
+    registry = attr.ib(default=None)
+    spiller = attr.ib(default=None)
+
+    def backing_of(self, name):
+        snap = mapper.MapperDevice('/dev/mapper/{}'.format(name),
+                                   backend=self.backend)
+        target = snap.table[0].target
+        return mapper.resolve_device(target.backing)
+
+    def grow(self, usage):
+        '''Grow the COW store of a snapshot. Return the number of bytes
+        added.'''
+
+        backing = self.backing_of(usage.name)
+        if not cow.is_growable(backing, backend=self.backend):
+            LOG.warning('%s is %.0f%% full but its backing store %s '
+                        'cannot be grown', usage.name, usage.used * 100,
+                        backing)
+            return 0
+
+        current = usage.total * 512
+        size = self.grow_by or current
+        if self.max_size is not None:
+            size = min(size, self.max_size - current)
+        size = size // 4096 * 4096
+
+        if size < 4096:
+            LOG.warning('%s is %.0f%% full and at its maximum size',
+                        usage.name, usage.used * 100)
+            return 0
+
+        registry = self.registry or get_registry()
+        try:
+            with snapbudget.admit(size, registry=registry):
+                LOG.info('%s is %.0f%% full; adding %d bytes', usage.name,
+                         usage.used * 100, size)
+                added = cow.grow(backing, size, backend=self.backend)
+
+                record = registry.get(usage.name)
+                if record is not None:
+                    registry.update(usage.name,
+                                    zram=record.zram + [str(added.device)])
+        except OverBudget as e:
+            LOG.warning('%s is %.0f%% full but cannot be grown: %s',
+                        usage.name, usage.used * 100, e)
+            return 0
+
+        return size
+
+    def poll(self):
+        '''Check every snapshot once. Return the usage that was seen.'''
+
+        usage = [u for u in snapshot_usage(backend=self.backend)
+                 if self.prefix is None or u.name.startswith(self.prefix)]
+
+        for u in usage:
+            if not u.valid:
+                LOG.warning('snapshot %s is %s', u.name, u.state)
+            elif u.used >= self.watermark:
+                try:
+                    self.grow(u)
+                except (OSError, BullError) as e:
+                    LOG.error('failed to grow %s: %s', u.name, e)
+
+        if self.spiller is not None:
+            self.spiller.poll()
+
+        return usage
+
+    def run(self, count=None):
+        '''Poll every interval seconds, count times (forever if None).'''
+
+        while count is None or count > 0:
+            started = time.monotonic()
+            self.poll()
+            if count is not None:
+                count -= 1
+                if count == 0:
+                    break
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
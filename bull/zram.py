@@ -1,13 +1,101 @@
+import attr
 import logging
 from pathlib import Path
 
+from bull import timing
 from bull.blockdev import BlockDevice
+from bull.host import get_host
 
 LOG = logging.getLogger(__name__)
+PAGE_SIZE = 4096
+
+
+def _int_or_zero(value):
+    return int(value) if value not in (None, '-') else 0
+
+
+@attr.s
+class MMStat():
+    '''Memory usage of a zram device, from its mm_stat file.
+
+    See https://www.kernel.org/doc/Documentation/blockdev/zram.txt
+    '''
+
+    orig_data_size = attr.ib(converter=int)
+    compr_data_size = attr.ib(converter=int)
+    mem_used_total = attr.ib(converter=int)
+    mem_limit = attr.ib(converter=int)
+    mem_used_max = attr.ib(converter=int)
+    same_pages = attr.ib(converter=int)
+    pages_compacted = attr.ib(converter=int)
+    huge_pages = attr.ib(converter=_int_or_zero, default=0)
+    huge_pages_since = attr.ib(converter=_int_or_zero, default=0)
+
+    @classmethod
+    def from_string(kls, text):
+        return kls(*text.split()[:len(attr.fields(kls))])
+
+    @property
+    def compression_ratio(self):
+        if self.compr_data_size == 0:
+            return None
+        return self.orig_data_size / self.compr_data_size
+
+
+def sum_mm_stats(stats):
+    '''Add up the MMStats of several zram devices.'''
+
+    fields = [field.name for field in attr.fields(MMStat)]
+    totals = dict.fromkeys(fields, 0)
+    for stat in stats:
+        for field in fields:
+            totals[field] += getattr(stat, field)
+
+    return MMStat(**totals)
+
+
+@attr.s
+class IOStat():
+    '''Failed and unusual I/O on a zram device, from its io_stat file.'''
+
+    failed_reads = attr.ib(converter=int)
+    failed_writes = attr.ib(converter=int)
+    invalid_io = attr.ib(converter=int)
+    notify_free = attr.ib(converter=int)
+
+    @classmethod
+    def from_string(kls, text):
+        return kls(*text.split()[:len(attr.fields(kls))])
+
+
+@attr.s
+class BDStat():
+    '''Pages a zram device has written back to its backing device, from
+    its bd_stat file. Counts are in 4 KiB pages.'''
+
+    bd_count = attr.ib(converter=int)
+    bd_reads = attr.ib(converter=int)
+    bd_writes = attr.ib(converter=int)
+
+    @classmethod
+    def from_string(kls, text):
+        return kls(*text.split()[:len(attr.fields(kls))])
+
+
+def sum_bd_stats(stats):
+    '''Add up the BDStats of several zram devices.'''
+
+    fields = [field.name for field in attr.fields(BDStat)]
+    totals = dict.fromkeys(fields, 0)
+    for stat in stats:
+        for field in fields:
+            totals[field] += getattr(stat, field)
+
+    return BDStat(**totals)
 
 
 def check_zram_available():
-    return Path('/sys/class/zram-control').exists()
+    return get_host().exists(ZramDevice.control_path)
 
 
 class ZramDevice(BlockDevice):
@@ -16,32 +104,142 @@ class ZramDevice(BlockDevice):
     @classmethod
     def create(kls, minor=None):
         if minor is None:
-            with (kls.control_path / 'hot_add').open() as fd:
-                minor = fd.read().strip()
+            with timing.timed('zram hot_add'):
+                minor = get_host().read(kls.control_path / 'hot_add').strip()
 
         LOG.debug('created new zram device zram%s', minor)
         return kls('/dev/zram{}'.format(minor))
 
     def remove(self):
         LOG.debug('removing zram device %s', self.device.name)
-        with (self.control_path / 'hot_remove').open('w') as fd:
-            fd.write('{}'.format(self.minor))
+        with timing.timed('zram hot_remove'):
+            get_host().write(self.control_path / 'hot_remove', self.minor)
 
     def get_size(self):
-        with (self.sysfs / 'disksize').open() as fd:
-            size = fd.readline().strip()
-
-        return int(size)
+        return int(self.read_attr('disksize'))
 
     def set_size(self, size):
-        LOG.debug('set size of zram device %s to %s',
-                  self.device.name, size)
-        with (self.sysfs / 'disksize').open('w') as fd:
-            fd.write('{}'.format(size))
+        self.write_attr('disksize', size)
+        self.invalidate_geometry()
 
     size = property(get_size, set_size)
 
+    def read_attr(self, name):
+        return get_host().read(self.sysfs / name).strip()
+
+    def write_attr(self, name, value):
+        LOG.debug('set %s of zram device %s to %s',
+                  name, self.device.name, value)
+        with timing.timed('zram {}'.format(name)):
+            get_host().write(self.sysfs / name, value)
+
+    def get_comp_algorithm(self):
+        '''Return the compression algorithm currently selected.'''
+
+        for algorithm in self.read_attr('comp_algorithm').split():
+            if algorithm.startswith('['):
+                return algorithm.strip('[]')
+
+    def set_comp_algorithm(self, algorithm):
+        '''Select a compression algorithm. This must happen before the
+        device size is set.'''
+
+        self.write_attr('comp_algorithm', algorithm)
+
+    comp_algorithm = property(get_comp_algorithm, set_comp_algorithm)
+
+    def available_comp_algorithms(self):
+        return [algorithm.strip('[]') for algorithm in
+                self.read_attr('comp_algorithm').split()]
+
+    def get_max_comp_streams(self):
+        return int(self.read_attr('max_comp_streams'))
+
+    def set_max_comp_streams(self, streams):
+        self.write_attr('max_comp_streams', streams)
+
+    max_comp_streams = property(get_max_comp_streams, set_max_comp_streams)
+
+    def get_mem_limit(self):
+        return self.mm_stat().mem_limit
+
+    def set_mem_limit(self, limit):
+        '''Limit the memory used to store compressed data (0 for no
+        limit).'''
+
+        self.write_attr('mem_limit', limit)
+
+    mem_limit = property(get_mem_limit, set_mem_limit)
+
+    def mm_stat(self):
+        return MMStat.from_string(self.read_attr('mm_stat'))
+
+    def io_stat(self):
+        return IOStat.from_string(self.read_attr('io_stat'))
+
+    def bd_stat(self):
+        return BDStat.from_string(self.read_attr('bd_stat'))
+
+    def get_backing_dev(self):
+        '''Return the device idle pages are written back to, or None.'''
+
+        try:
+            value = self.read_attr('backing_dev')
+        except FileNotFoundError:
+            # The kernel was built without CONFIG_ZRAM_WRITEBACK.
+            return None
+        return None if value == 'none' else value
+
+    def set_backing_dev(self, device):
+        '''Set the device that writeback() writes to. This must happen
+        before the device size is set.'''
+
+        self.write_attr('backing_dev', device)
+
+    backing_dev = property(get_backing_dev, set_backing_dev)
+
+    def set_writeback_limit(self, limit):
+        '''Allow at most limit more bytes to be written back (None for
+        no limit).'''
+
+        if limit is None:
+            self.write_attr('writeback_limit_enable', 0)
+        else:
+            self.write_attr('writeback_limit_enable', 1)
+            self.write_attr('writeback_limit', limit // PAGE_SIZE)
+
+    def mark_idle(self, age=None):
+        '''Mark pages idle: all of them, or (on Linux 6.2 and later) those
+        not accessed for age seconds.'''
+
+        self.write_attr('idle', 'all' if age is None else int(age))
+
+    def writeback(self, mode='idle'):
+        '''Write pages back to the backing device: 'idle' pages,
+        'huge' (incompressible) pages or 'huge_idle' pages.'''
+
+        self.write_attr('writeback', mode)
+
+    def configure(self, size, comp_algorithm=None, max_comp_streams=None,
+                  mem_limit=None, backing_dev=None):
+        '''Set up a new (or reset) device.
+
+        Settings are applied in the order the kernel requires:
+        the compression algorithm, streams and backing device before
+        the size.
+        '''
+
+        if comp_algorithm is not None:
+            self.comp_algorithm = comp_algorithm
+        if max_comp_streams is not None:
+            self.max_comp_streams = max_comp_streams
+        if backing_dev is not None:
+            self.backing_dev = backing_dev
+        self.size = size
+        if mem_limit is not None:
+            self.mem_limit = mem_limit
+
     def reset(self):
         LOG.debug('resetting zram device %s', self.device.name)
-        with (self.sysfs / 'reset').open('w') as fd:
-            fd.write('1')
+        self.write_attr('reset', 1)
+        self.invalidate_geometry()
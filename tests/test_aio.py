@@ -0,0 +1,86 @@
+import asyncio
+import subprocess
+import tempfile
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase, mock
+
+import bull
+from bull import aio
+from bull import api
+from bull import dmioctl
+from bull import registry
+
+
+class FakeDevice():
+    device = Path('/dev/sda')
+
+    def get_size_sectors(self):
+        return 2048
+
+
+class TestRunCommand(IsolatedAsyncioTestCase):
+    '''Test running commands as asyncio subprocesses.'''
+
+    async def test_output(self):
+        p = await aio.run_command_async('cat', input=b'hello')
+        assert p.stdout == b'hello'
+
+    async def test_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            await aio.run_command_async('false')
+
+
+@mock.patch('bull.aio.zram')
+@mock.patch('bull.aio.open_source')
+class TestSnapshot(IsolatedAsyncioTestCase):
+    '''Test the snapshot lifecycle on one event loop.'''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.registry = registry.Registry(Path(tmpdir.name) / 'reg.json')
+        self.backend = dmioctl.IoctlBackend(dmioctl.FakeControl())
+        self.backend.create('bull0')
+
+        # The zram devices are removed by bull.api.
+        patcher = mock.patch('bull.api.zram')
+        self.api_zram = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def setup_mocks(self, mock_open_source, mock_zram):
+        async def open_source(src, part=None, offset=0):
+            return api.describe_source(FakeDevice(), offset=offset)
+
+        mock_open_source.side_effect = open_source
+        backings = iter(range(100))
+        mock_zram.ZramDevice.create.side_effect = lambda: mock.Mock(
+            device='/dev/zram{}'.format(next(backings)))
+
+    @mock.patch('bull.mapper.lock_file')
+    async def test_snapshot(self, mock_lock_file, mock_open_source,
+                            mock_zram):
+        self.setup_mocks(mock_open_source, mock_zram)
+
+        async with bull.snapshot('/dev/sda', backend=self.backend,
+                                 registry=self.registry) as snap:
+            assert snap.name == 'bull1'
+            assert str(self.backend.table('bull1')).split()[2] == 'snapshot'
+            assert self.registry.get('bull1').zram == ['/dev/zram0']
+
+        assert self.backend.names() == ['bull0']
+        assert self.registry.records() == []
+        self.api_zram.ZramDevice.assert_called_with('/dev/zram0')
+
+    @mock.patch('bull.mapper.lock_file')
+    async def test_many(self, mock_lock_file, mock_open_source, mock_zram):
+        self.setup_mocks(mock_open_source, mock_zram)
+
+        async def lifecycle():
+            async with aio.snapshot('/dev/sda', backend=self.backend,
+                                    registry=self.registry) as snap:
+                await asyncio.sleep(0)
+                return snap.name
+
+        names = await asyncio.gather(*[lifecycle() for i in range(20)])
+        assert len(set(names)) == 20
+        assert self.backend.names() == ['bull0']
@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from bull import dmioctl
+from bull import mapper
+
+
+class TestNameAllocator(TestCase):
+    '''Test allocation of snapshot names.'''
+
+    def setUp(self):
+        self.control = dmioctl.FakeControl()
+        self.backend = dmioctl.IoctlBackend(self.control)
+
+    def allocator(self, prefix='bull'):
+        return mapper.NameAllocator(prefix, backend=self.backend,
+                                    lockfile=None)
+
+    def test_lowest_free(self):
+        for name in ['bull0', 'bull2', 'bull3-base', 'other1']:
+            self.backend.create(name)
+
+        allocator = self.allocator()
+        assert [allocator.allocate() for i in range(3)] == \
+            ['bull1', 'bull4', 'bull5']
+        assert self.backend.exists('bull1')
+
+    def test_many(self):
+        allocator = self.allocator()
+        names = [allocator.allocate() for i in range(1000)]
+
+        assert names[-1] == 'bull999'
+        assert len(set(self.backend.names())) == 1000
+
+    def test_prefix(self):
+        self.backend.create('bull0')
+        assert self.allocator('test').allocate() == 'test0'
+
+    def test_stale(self):
+        allocator = self.allocator()
+        assert allocator.allocate() == 'bull0'
+
+        # Another process takes the next name behind our back.
+        self.backend.create('bull1')
+        assert allocator.allocate() == 'bull2'
+
+    def test_release(self):
+        allocator = self.allocator()
+        names = [allocator.allocate() for i in range(3)]
+        self.backend.create('bull0-base')
+
+        for name in names:
+            self.backend.remove(name)
+            allocator.release(name)
+
+        # bull0 is still in use by its base device.
+        assert allocator.allocate() == 'bull1'
+        assert allocator.allocate() == 'bull2'
+        assert allocator.allocate() == 'bull3'
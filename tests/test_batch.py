@@ -0,0 +1,56 @@
+import threading
+from unittest import TestCase, mock
+
+from bull import api
+from bull.exceptions import NoSuchDevice
+
+
+class FakeSnap():
+    def __init__(self, name):
+        self.device = '/dev/mapper/{}'.format(name)
+
+
+class TestBatch(TestCase):
+    '''Test creating and removing snapshots in batches.'''
+
+    @mock.patch('bull.api.create_snapshots')
+    def test_create_many(self, mock_create):
+        counter = iter(range(100))
+        lock = threading.Lock()
+
+        def create(src, count=1, **kwargs):
+            with lock:
+                return [FakeSnap('bull{}'.format(next(counter)))
+                        for i in range(count)]
+
+        mock_create.side_effect = create
+        report = api.create_many([{'src': '/a.img', 'count': 2},
+                                  {'src': '/b.img'},
+                                  {'count': 1}], workers=2)
+
+        assert [result.ok for result in report.results] == \
+            [True, True, False]
+        assert sorted(report.devices) == ['/dev/mapper/bull0',
+                                          '/dev/mapper/bull1',
+                                          '/dev/mapper/bull2']
+        assert len(report.results[0].devices) == 2
+        assert 'no src' in report.failed[0].error
+        assert report.throughput > 0
+
+    @mock.patch('bull.api.remove_snapshot')
+    def test_remove_many(self, mock_remove):
+        def remove(name, **kwargs):
+            if name == 'bull1':
+                raise NoSuchDevice(name)
+
+        mock_remove.side_effect = remove
+        report = api.remove_many(['bull0', 'bull1', 'bull2'])
+
+        assert report.devices == ['bull0', 'bull2']
+        assert [result.item for result in report.failed] == ['bull1']
+        assert report.to_dict()['results'][1]['ok'] is False
+
+    def test_empty(self):
+        report = api.create_many([])
+        assert report.results == []
+        assert report.throughput == 0.0
@@ -0,0 +1,168 @@
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import blockdev
+from bull.exceptions import NoSuchPartition
+
+
+def mbr_entry(parttype, start, size):
+    return struct.pack('<B3sB3sII', 0, b'\0' * 3, parttype, b'\0' * 3,
+                       start, size)
+
+
+def make_mbr(entries):
+    sector = bytearray(512)
+    for i, entry in enumerate(entries):
+        sector[446 + i * 16:446 + (i + 1) * 16] = mbr_entry(*entry)
+    sector[510:512] = blockdev.MBR_SIGNATURE
+    return sector
+
+
+def make_gpt(partitions, sector_size=512):
+    entry_size = 128
+    num_entries = 128
+    entries = bytearray(entry_size * num_entries)
+    for i, (start, end) in enumerate(partitions):
+        entry = blockdev.GPT_ENTRY.pack(b'\x01' * 16, b'\x02' * 16,
+                                        start, end, 0, b'')
+        entries[i * entry_size:(i + 1) * entry_size] = entry
+
+    header = bytearray(blockdev.GPT_HEADER.pack(
+        blockdev.GPT_SIGNATURE, 0x10000, 92, 0, 0, 1, 1000, 34, 900,
+        b'\0' * 16, 2, num_entries, entry_size, zlib.crc32(entries)))
+    struct.pack_into('<I', header, 16, zlib.crc32(header))
+
+    image = bytearray(sector_size * 2 + len(entries))
+    image[:512] = make_mbr([(blockdev.MBR_GPT_PROTECTIVE, 1, 0xffffffff)])
+    image[sector_size:sector_size + len(header)] = header
+    image[sector_size * 2:] = entries
+    return image
+
+
+class TestPartitionTables(TestCase):
+    '''Test the native MBR and GPT partition table readers.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.image = Path(self.tmpdir.name) / 'disk.img'
+        blockdev.clear_part_table_cache()
+
+    def write_image(self, data, size=2**20):
+        with open(str(self.image), 'wb') as fd:
+            fd.write(data)
+            fd.truncate(max(size, len(data)))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_mbr(self):
+        self.write_image(make_mbr([(0x0c, 8192, 85045),
+                                   (0x83, 94208, 3440640)]),
+                         size=3534848 * 512)
+        table = blockdev.read_part_table(self.image)
+
+        assert table.label == 'dos'
+        assert table.get(1) == blockdev.Partition(1, 8192, 85045, 'c')
+        assert table.get(2) == blockdev.Partition(2, 94208, 3440640, '83')
+
+    def test_mbr_logical(self):
+        image = bytearray(512 * 32)
+        image[:512] = make_mbr([(0x83, 1, 1), (0x05, 2, 100)])
+        image[1024:1536] = make_mbr([(0x83, 1, 10), (0x05, 20, 30)])
+        image[512 * 22:512 * 23] = make_mbr([(0x83, 2, 5)])
+        self.write_image(image)
+
+        table = blockdev.read_part_table(self.image)
+
+        assert table.get(5) == blockdev.Partition(5, 3, 10, '83')
+        assert table.get(6) == blockdev.Partition(6, 24, 5, '83')
+
+    def test_gpt(self):
+        self.image.write_bytes(make_gpt([(2048, 4095), (4096, 8191)]))
+        table = blockdev.read_part_table(self.image)
+
+        assert table.label == 'gpt'
+        assert table.get(2).start == 4096
+        assert table.get(2).size == 4096
+
+    def test_gpt_4k(self):
+        self.image.write_bytes(make_gpt([(256, 511)], sector_size=4096))
+        table = blockdev.read_part_table(self.image)
+
+        assert table.get(1).start == 2048
+        assert table.get(1).size == 2048
+
+    def test_no_such_partition(self):
+        self.write_image(make_mbr([(0x83, 2048, 2048)]), size=2**21)
+        with self.assertRaises(NoSuchPartition):
+            blockdev.read_part_table(self.image).get(3)
+
+    def test_unknown_format(self):
+        self.image.write_bytes(bytes(512))
+        assert blockdev.read_part_table(self.image) is None
+
+    def test_boot_sector(self):
+        # A FAT boot sector has the MBR signature, but boot code where
+        # the partition entries would be.
+        sector = make_mbr([])
+        sector[446:510] = bytes(range(0x20, 0x60))
+        self.write_image(sector)
+        assert blockdev.read_part_table(self.image) is None
+
+    def test_implausible_entries(self):
+        self.write_image(make_mbr([(0x83, 2048, 4096), (0x83, 4096, 2048)]))
+        assert blockdev.read_part_table(self.image) is None
+
+        self.write_image(make_mbr([(0x83, 2048, 4096)]), size=2**21)
+        assert blockdev.read_part_table(self.image) is None
+
+    @mock.patch('bull.blockdev.read_part_table_sfdisk')
+    def test_sfdisk_fallback(self, mock_sfdisk):
+        sector = make_mbr([(0x83, 2048, 2048)])
+        sector[446] = 0x29
+        self.write_image(sector)
+        mock_sfdisk.return_value = blockdev.PartitionTable('dos')
+
+        assert blockdev.get_part_table(self.image) is mock_sfdisk.return_value
+
+    @mock.patch('bull.blockdev.read_part_table')
+    def test_cache(self, mock_read):
+        self.image.write_bytes(make_mbr([(0x83, 2048, 2048)]))
+        mock_read.return_value = blockdev.PartitionTable('dos')
+
+        dev = blockdev.BlockDevice(self.image)
+        dev.get_part_table()
+        dev.get_part_table()
+
+        assert mock_read.call_count == 1
+
+        blockdev.get_part_table(self.image, sector_size=4096)
+        assert mock_read.call_count == 2
+
+
+class TestGeometry(TestCase):
+    '''Test device geometry for image files.'''
+
+    def test_regular_file(self):
+        with tempfile.NamedTemporaryFile() as fd:
+            fd.truncate(1024 * 1024)
+            dev = blockdev.BlockDevice(fd.name)
+
+            assert dev.get_size_bytes() == 1024 * 1024
+            assert dev.get_size_sectors() == 2048
+            assert dev.geometry.logical_sector_size == 512
+            assert not dev.geometry.is_block_device
+
+    def test_cached(self):
+        with tempfile.NamedTemporaryFile() as fd:
+            dev = blockdev.BlockDevice(fd.name)
+            assert dev.get_size_bytes() == 0
+
+            fd.truncate(4096)
+            assert dev.get_size_bytes() == 0
+
+            dev.invalidate_geometry()
+            assert dev.get_size_bytes() == 4096
@@ -0,0 +1,82 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import budget
+from bull.exceptions import OverBudget
+
+
+@mock.patch('bull.budget.lock_file')
+@mock.patch('bull.budget.committed')
+class TestAdmit(TestCase):
+    '''Test admission against a memory budget.'''
+
+    def test_no_budget(self, mock_committed, mock_lock_file):
+        with budget.admit(2**30) as usage:
+            assert usage.headroom is None
+        mock_committed.assert_not_called()
+        mock_lock_file.assert_not_called()
+
+    def test_reject(self, mock_committed, mock_lock_file):
+        mock_committed.return_value = 2**20
+        with self.assertRaises(OverBudget):
+            with budget.admit(2**20, budget=2**20 + 4096):
+                pass
+
+    def test_wait(self, mock_committed, mock_lock_file):
+        mock_committed.side_effect = [2**20, 2**20, 0]
+        with budget.admit(2**20, budget=2**20, wait=10,
+                          interval=0) as usage:
+            assert usage.headroom == 2**20
+        assert mock_committed.call_count == 3
+
+
+@mock.patch('bull.budget.lock_file')
+@mock.patch('bull.budget.committed')
+class TestReserve(TestCase):
+    '''Test reserving part of a memory budget.'''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        patcher = mock.patch('bull.budget.RESERVED_PATH',
+                             Path(tmpdir.name) / 'budget.json')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_budget(self, mock_committed, mock_lock_file):
+        assert budget.reserve(2**30) is None
+        with budget.recording(None):
+            pass
+        mock_lock_file.assert_not_called()
+
+    def test_reserve(self, mock_committed, mock_lock_file):
+        mock_committed.return_value = 0
+        first = budget.reserve(2**20, budget=2**21)
+        budget.reserve(2**20, budget=2**21)
+        assert budget.memory_usage(2**21).headroom == 0
+        with self.assertRaises(OverBudget):
+            budget.reserve(2**20, budget=2**21)
+
+        # Once recorded, the devices count instead.
+        mock_committed.return_value = 2**20
+        with budget.recording(first):
+            pass
+        assert first.released
+        assert budget.memory_usage(2**21).headroom == 0
+        first.release()
+        assert len(budget.reserved()) == 1
+
+    def test_release(self, mock_committed, mock_lock_file):
+        mock_committed.return_value = 0
+        reservation = budget.reserve(2**20, budget=2**20)
+        reservation.release()
+        assert budget.reserved() == {}
+
+    @mock.patch('bull.budget.os.kill')
+    def test_dead_process(self, mock_kill, mock_committed, mock_lock_file):
+        mock_committed.return_value = 0
+        budget.reserve(2**20, budget=2**20)
+        mock_kill.side_effect = ProcessLookupError()
+        assert budget.reserved() == {}
+        budget.reserve(2**20, budget=2**20)
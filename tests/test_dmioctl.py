@@ -0,0 +1,131 @@
+from unittest import TestCase, mock
+
+from bull import dmioctl
+from bull import mapper
+from bull.exceptions import DeviceMapperError
+
+
+class TestIoctlBackend(TestCase):
+    '''Test the device mapper ioctl backend against a fake control device.'''
+
+    def setUp(self):
+        self.control = dmioctl.FakeControl()
+        self.backend = dmioctl.IoctlBackend(self.control)
+
+    def test_header_size(self):
+        assert dmioctl.DM_IOCTL_STRUCT.size == 312
+        assert dmioctl.DM_TARGET_SPEC.size == 40
+        assert dmioctl.dm_request(dmioctl.DM_DEV_CREATE_CMD) == 0xc138fd03
+
+    def test_create_remove(self):
+        self.backend.create('test0')
+        assert self.backend.exists('test0')
+        assert self.backend.list_devices() == ['test0']
+
+        self.backend.remove('test0')
+        assert not self.backend.exists('test0')
+        assert self.backend.list_devices() == []
+
+    def test_create_exists(self):
+        self.backend.create('test0')
+        with self.assertRaises(DeviceMapperError):
+            self.backend.create('test0')
+
+    def test_load_table(self):
+        table = ('0 2048 linear /dev/loop0 94208\n'
+                 '2048 4096 zero')
+        self.backend.create('test0')
+        self.backend.load('test0', table)
+        assert self.backend.table('test0') == ''
+
+        self.backend.suspend('test0')
+        self.backend.resume('test0')
+        assert self.backend.table('test0') == table
+
+    def test_buffer_full(self):
+        backend = dmioctl.IoctlBackend(self.control, bufsize=512)
+        for i in range(50):
+            backend.create('test{}'.format(i))
+
+        assert len(backend.list_devices()) == 50
+
+    def test_status(self):
+        self.backend.create('test0')
+        self.backend.load('test0',
+                          '0 1024 snapshot /dev/loop0 /dev/zram0 N 16')
+        self.backend.resume('test0')
+
+        assert self.backend.status('test0') == '0 1024 snapshot 0/1024 0'
+        assert self.backend.list_devices('snapshot') == ['test0']
+        assert self.backend.list_devices('linear') == []
+
+    def test_remove_busy(self):
+        self.backend.create('base')
+        self.backend.create('snap')
+        self.backend.load('snap',
+                          '0 1024 snapshot /dev/mapper/base /dev/zram0 N 16')
+        self.backend.resume('snap')
+
+        with self.assertRaises(DeviceMapperError):
+            self.backend.remove('base')
+
+    @mock.patch('bull.mapper.lock_file')
+    def test_mapper_device(self, mock_lock_file):
+        dev = mapper.MapperDevice.create_first_available(
+            backend=self.backend)
+        dev.table.append(mapper.Segment(0, 2048, mapper.Zero()))
+        dev.load()
+
+        assert dev.name == 'bull0'
+        assert str(mapper.MapperDevice(dev.device,
+                                       backend=self.backend).table) == \
+            '0 2048 zero'
+        assert mapper.MapperDevice.create_first_available(
+            backend=self.backend).name == 'bull1'
+
+    def test_load_before_suspend(self):
+        self.backend.create('test0')
+        backend = mock.Mock(wraps=self.backend)
+        dev = mapper.MapperDevice('/dev/mapper/test0', backend=backend)
+        dev.table.append(mapper.Segment(0, 2048, mapper.Zero()))
+        stall = dev.load()
+
+        assert [call[0] for call in backend.method_calls] == [
+            'table', 'load', 'suspend', 'resume']
+        assert stall >= 0
+
+    def test_message(self):
+        self.backend.create('pool')
+        self.backend.message('pool', 0, 'create_thin 0')
+        assert self.control.devices['pool'].messages == ['create_thin 0']
+
+
+@mock.patch('subprocess.run')
+class TestDmsetupBackend(TestCase):
+    '''Test parsing of dmsetup output.'''
+
+    def test_status_all(self, mock_run):
+        mock_run.return_value = mock.Mock(stdout=(
+            b'bull0: 0 2048 snapshot 16/1024 16\n'
+            b'bull0-base: 0 1024 linear \n'
+            b'1024 1024 zero \n'))
+        status = mapper.DmsetupBackend().status_all()
+
+        assert status['bull0'] == '0 2048 snapshot 16/1024 16'
+        assert status['bull0-base'] == '0 1024 linear \n1024 1024 zero '
+
+    def test_table_all(self, mock_run):
+        mock_run.return_value = mock.Mock(stdout=(
+            b'bull0-base: 0 1024 linear 7:0 2048\n'
+            b'bull0-base: 1024 1024 zero \n'
+            b'bull0-cow: 0 512 linear 252:0 0\n'))
+        tables = mapper.DmsetupBackend().table_all()
+
+        assert tables['bull0-base'] == \
+            '0 1024 linear 7:0 2048\n1024 1024 zero '
+        assert len(mapper.Table.from_string(tables['bull0-base'])) == 2
+        assert tables['bull0-cow'] == '0 512 linear 252:0 0'
+
+    def test_list_empty(self, mock_run):
+        mock_run.return_value = mock.Mock(stdout=b'No devices found\n')
+        assert mapper.DmsetupBackend().list_devices('snapshot') == []
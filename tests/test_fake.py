@@ -0,0 +1,606 @@
+import asyncio
+import errno
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import aio
+from bull import api
+from bull import budget
+from bull import cow
+from bull import fake
+from bull import listing
+from bull import loop
+from bull import mapper
+from bull import pool
+from bull import watch
+from bull import zram
+from bull.exceptions import (DeviceBusy, DeviceExists, NoSuchDevice,
+                             OverBudget, UnsupportedDevice)
+from bull.registry import get_registry
+
+
+class TestFakeKernel(TestCase):
+    '''Run whole snapshot lifecycles against the simulated kernel.'''
+
+    dmsetup = False
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.image = Path(tmpdir.name) / 'disk.img'
+        fake.make_image(self.image, size=2**24)
+
+        self.kernel = fake.FakeKernel(Path(tmpdir.name) / 'run',
+                                      dmsetup=self.dmsetup)
+        self.kernel.__enter__()
+        self.addCleanup(self.kernel.__exit__, None, None, None)
+
+    def test_lifecycle(self):
+        snaps = api.create_snapshots(self.image, part=1, count=2)
+        assert [snap.name for snap in snaps] == ['bull0', 'bull1']
+        assert self.kernel.commands['losetup'] == 0
+        assert self.kernel.loop_ioctls == 1
+
+        snapshots = listing.list_snapshots()
+        assert [info.name for info in snapshots] == ['bull0', 'bull1']
+        assert snapshots[0].source == '/dev/loop0'
+        assert snapshots[0].source_file == str(self.image)
+        assert snapshots[0].size == 2**24 - 2**20
+        assert snapshots[1].backing_devices == ['/dev/zram1']
+
+        api.remove_snapshot('bull0')
+        assert loop.LoopDevice('/dev/loop0').exists()
+        api.remove_snapshot('bull1')
+
+        assert not self.kernel.loops
+        assert not self.kernel.zrams
+        assert not self.kernel.control.devices
+        assert (self.kernel.run_dir / 'registry.json').exists()
+
+    def test_sysfs(self):
+        dev = zram.ZramDevice.create()
+        dev.configure(2**20, comp_algorithm='zstd')
+        assert dev.comp_algorithm == 'zstd'
+        assert dev.size == 2**20
+        assert dev.geometry.dev == self.kernel.devnum(
+            self.kernel.zrams[0])
+        assert self.kernel.listdir('/sys/dev/block') == ['252:0']
+        assert self.kernel.readlink('/sys/dev/block/252:0').endswith(
+            '/zram0')
+
+        with self.assertRaises(OSError):
+            dev.comp_algorithm = 'lz4'
+
+    def test_share_loop(self):
+        api.create_snapshots(self.image, part=1)
+        api.create_snapshots(self.image, part=1)
+        assert len(self.kernel.loops) == 1
+
+        # Different options need a loop device of their own. (With
+        # 4096 byte sectors, the image's MBR does not fit the device.)
+        api.create_snapshots(self.image, direct_io=True, block_size=4096)
+        assert len(self.kernel.loops) == 2
+        dev = loop.LoopDevice('/dev/loop1')
+        assert dev.direct_io
+        assert dev.geometry.logical_sector_size == 4096
+
+        api.remove_snapshot('bull0')
+        assert len(self.kernel.loops) == 2
+        api.remove_snapshot('bull1')
+        assert len(self.kernel.loops) == 1
+
+    def test_release_loop(self):
+        api.create_snapshots(self.image, part=1)
+        loopdev = loop.LoopDevice('/dev/loop0')
+
+        # The base device still holds it.
+        assert not loopdev.release()
+        assert 0 in self.kernel.loops
+
+        self.kernel.backend().remove('bull0')
+        self.kernel.backend().remove('bull0-base')
+        with mock.patch('bull.loop.lock_file',
+                        wraps=loop.lock_file) as lock_file:
+            assert loopdev.release()
+        lock_file.assert_called_with(loop.LOOP_LOCK)
+        assert not self.kernel.loops
+
+    def test_share_only_bull_loops(self):
+        loop.LoopDevice.create(self.image)
+        api.create_snapshots(self.image, part=1)
+        assert len(self.kernel.loops) == 2
+
+    def test_preload(self):
+        with open(str(self.image), 'r+b') as fd:
+            fd.seek(2**20 + 2**18)
+            fd.write(b'x' * 4096)
+
+        reports = []
+        api.create_snapshots(self.image, part=1, preload=True,
+                             on_preload=reports.append)
+        api.create_snapshots(self.image, part=1, preload=True,
+                             on_preload=reports.append)
+        assert not self.kernel.loops
+        assert len(reports) == 1
+        assert reports[0].bytes_read == 2**24 - 2**20
+        assert reports[0].bytes_written == 2**16
+
+        # One copy, and a backing store for each snapshot.
+        assert len(self.kernel.zrams) == 3
+        origin = self.kernel.zrams[0]
+        assert origin.orig_data_size == 2**16
+        assert origin.syncs == 1
+        assert listing.list_snapshots()[1].source == '/dev/zram0'
+
+        api.remove_snapshot('bull0')
+        assert 0 in self.kernel.zrams
+        api.remove_snapshot('bull1')
+        assert not self.kernel.zrams
+
+    def test_persistent(self):
+        store = self.image.parent / 'bull0.cow'
+        snap, = api.create_snapshots(self.image, part=1, backing_file=store)
+        target = snap.table[0].target
+        assert target.persistent == 'P'
+        assert not self.kernel.zrams
+        assert store.stat().st_size == 2**24 - 2**20 + 4096
+
+        cowdev = mapper.MapperDevice(target.backing)
+        cowdev.table.resolve()
+        assert cowdev.table[0].target.device == '/dev/loop1'
+        assert cowdev.table[0].target.offset == 8
+        assert loop.LoopDevice('/dev/loop1').direct_io
+
+        with self.assertRaises(DeviceExists):
+            api.create_snapshots(self.image, part=1, backing_file=store)
+
+        api.remove_snapshot('bull0')
+        assert not self.kernel.loops
+        assert store.exists()
+
+        # As after a reboot.
+        snap = api.attach_snapshot(store)
+        assert snap.name == 'bull0'
+        assert snap.table[0].target.persistent == 'P'
+        assert listing.list_snapshots()[0].source_file == str(self.image)
+
+        api.remove_snapshot('bull0')
+        assert not self.kernel.loops
+        assert not self.kernel.control.devices
+
+    def test_spill(self):
+        spill = self.image.parent / 'spill.img'
+        api.create_snapshots(self.image, part=1, count=2,
+                             backing_size=2**20, spill_to=spill)
+        assert spill.stat().st_size == 2**21
+        assert loop.LoopDevice('/dev/loop1').direct_io
+        assert zram.ZramDevice('/dev/zram0').backing_dev == \
+            '/dev/mapper/bull0-spill'
+        assert zram.ZramDevice('/dev/zram1').backing_dev == \
+            '/dev/mapper/bull1-spill'
+
+        # Pages are written back once they have been idle for a whole
+        # pass.
+        self.kernel.zrams[0].orig_data_size = 2**19
+        spiller = watch.Spiller(every=60)
+        assert spiller.poll(now=0) == 0
+        assert spiller.poll(now=30) == 0
+        assert spiller.poll(now=60) == 2**19
+
+        snapshots = listing.list_snapshots()
+        assert snapshots[0].spilled == 2**19
+        assert snapshots[0].spill_writes == 2**19
+        assert snapshots[1].spilled == 0
+
+        # Over budget, everything goes at once, up to the limit.
+        self.kernel.zrams[1].orig_data_size = 2**19
+        spiller = watch.Spiller(budget=2**16, limit=2**16)
+        assert spiller.poll() == 2**16
+
+        api.remove_snapshot('bull0')
+        assert len(self.kernel.loops) == 2
+        api.remove_snapshot('bull1')
+        assert not self.kernel.loops
+        assert not self.kernel.control.devices
+        assert spill.exists()
+
+    def spill_offsets(self):
+        return {name: mapper.MapperDevice(
+            '/dev/mapper/{}'.format(name)).table[0].target.offset
+            for name in sorted(self.kernel.control.devices)
+            if name.endswith('-spill')}
+
+    def test_shared_spill(self):
+        spill = self.image.parent / 'spill.img'
+        with open(str(spill), 'wb') as fd:
+            fd.truncate(2**22)
+
+        api.create_snapshots(self.image, part=1, count=2,
+                             backing_size=2**20, spill_to=spill)
+        api.create_snapshots(self.image, part=1, count=2,
+                             backing_size=2**20, spill_to=spill)
+        assert self.spill_offsets() == {
+            'bull0-spill': 0, 'bull1-spill': 2048,
+            'bull2-spill': 4096, 'bull3-spill': 6144}
+        assert get_registry().get('bull3').spill_extent == [6144, 2048]
+
+        # The file is full, until a snapshot goes.
+        with self.assertRaises(ValueError):
+            api.create_snapshots(self.image, part=1, backing_size=2**20,
+                                 spill_to=spill)
+        api.remove_snapshot('bull1')
+        api.create_snapshots(self.image, part=1, backing_size=2**20,
+                             spill_to=spill)
+        assert self.spill_offsets()['bull1-spill'] == 2048
+
+    def test_budget(self):
+        budget.set_max_ram(2**21)
+        self.addCleanup(budget.set_max_ram, None)
+
+        api.create_snapshots(self.image, part=1, backing_size=2**20)
+        assert self.kernel.zrams[0].mem_limit == 2**20
+        assert budget.memory_usage().headroom == 2**20
+
+        with self.assertRaises(OverBudget):
+            api.create_snapshots(self.image, part=1, count=2,
+                                 backing_size=2**20)
+        assert len(self.kernel.zrams) == 1
+        assert len(self.kernel.control.devices) == 3
+
+        # A given mem_limit is what counts.
+        api.create_snapshots(self.image, part=1, count=2,
+                             backing_size=2**20,
+                             zram_options={'mem_limit': 2**19})
+        assert budget.memory_usage().headroom == 0
+
+        api.remove_snapshot('bull0')
+        assert budget.memory_usage().headroom == 2**20
+
+    def test_resize(self):
+        api.create_snapshots(self.image, part=1, count=2)
+        size = 2**24 - 2**20
+        result = api.resize_snapshot('bull0', size + 2**20)
+        assert result.old_size == size
+        assert set(result.stalls) == {'bull0-base', 'bull0'}
+
+        base = mapper.MapperDevice('/dev/mapper/bull0-base')
+        assert isinstance(base.table[-1].target, mapper.Zero)
+        assert base.table[-1].sectors == 2048
+        snapshots = listing.list_snapshots()
+        assert [info.size for info in snapshots] == [size + 2**20, size]
+
+        # The zero padding grows, and only the snapshot is reloaded if
+        # the base is already big enough.
+        api.resize_snapshot('bull0', size + 2**21)
+        assert len(base.get_table_from_device()) == 2
+        assert set(api.resize_snapshot('bull1', size + 2**20).stalls) == \
+            {'bull1'}
+        assert self.kernel.control.devices['bull1'].inactive is None
+
+        with self.assertRaises(ValueError):
+            api.resize_snapshot('bull0', size)
+
+    def test_resize_persistent(self):
+        store = self.image.parent / 'bull0.cow'
+        api.create_snapshots(self.image, part=1, backing_file=store)
+        api.resize_snapshot('bull0', 2**24)
+        api.remove_snapshot('bull0')
+
+        snap = api.attach_snapshot(store)
+        assert snap.table[0].sectors == 2**15
+
+    def test_partitions(self):
+        disk = self.image.parent / 'rpi.img'
+        fake.make_image(disk, size=2**24, partitions=[
+            (0x0c, 2048, 8192), (0x83, 10240, 22528)])
+
+        snaps = api.create_partition_snapshots(disk, name='rpi')
+        assert [snap.name for snap in snaps] == ['rpip1', 'rpip2']
+        assert len(self.kernel.loops) == 1
+        assert [dev.disksize for dev in self.kernel.zrams.values()] == [
+            2**20, int(22528 * 512 * 0.25)]
+
+        snapshots = listing.list_snapshots()
+        assert [info.size for info in snapshots] == [8192 * 512,
+                                                     22528 * 512]
+        assert [info.offset for info in snapshots] == [2048 * 512,
+                                                       10240 * 512]
+
+        api.remove_snapshot('rpip1')
+        assert len(self.kernel.loops) == 1
+        api.remove_snapshot('rpip2')
+        assert not self.kernel.loops
+        assert not self.kernel.control.devices
+
+    def test_whole_disk(self):
+        disk = self.image.parent / 'rpi.img'
+        fake.make_image(disk, size=2**24, partitions=[
+            (0x0c, 2048, 8192), (0x83, 10240, 22528)])
+
+        snap, views = api.create_disk_snapshot(disk, parts=[2])
+        assert [view.name for view in views] == ['bull0p2']
+        assert views[0].table[0].target.offset == 10240
+        assert self.kernel.zrams[0].disksize == int(22528 * 512 * 0.25)
+        assert listing.list_snapshots()[0].size == 2**24
+
+        api.remove_snapshot('bull0')
+        assert not self.kernel.control.devices
+
+        # Without the registry, views are found from the kernel.
+        api.create_disk_snapshot(disk)
+        (self.kernel.run_dir / 'registry.json').unlink()
+        api.remove_snapshot('bull0')
+        assert not self.kernel.control.devices
+        assert not self.kernel.loops
+
+    def test_several_sources(self):
+        first, second = (self.image.parent / name
+                         for name in ('a.img', 'b.img'))
+        fake.make_image(first, size=2**20)
+        fake.make_image(second, size=2**21)
+
+        api.create_snapshots(second, name='single')
+        api.create_snapshots([first, second])
+        base = mapper.MapperDevice('/dev/mapper/bull0-base')
+        assert [(segment.start, segment.sectors)
+                for segment in base.table] == [(0, 2048), (2048, 4096)]
+        assert listing.list_snapshots(prefix='bull')[0].size == 3 * 2**20
+
+        # The loop device of b.img is shared with the other snapshot.
+        api.remove_snapshot('bull0')
+        assert list(self.kernel.loops) == [0]
+
+        api.create_snapshots([first, second], stripe_size=65536)
+        base = mapper.MapperDevice('/dev/mapper/bull0-base')
+        target = base.table[0].target
+        assert isinstance(target, mapper.Striped)
+        assert target.chunk_size == 128
+        assert base.table[0].sectors == 2 * 2048
+
+        # Without the registry, every source is found from the kernel.
+        (self.kernel.run_dir / 'registry.json').unlink()
+        api.remove_snapshot('bull0')
+        api.remove_snapshot('single')
+        assert not self.kernel.control.devices
+        assert not self.kernel.loops
+
+        with self.assertRaises(ValueError):
+            api.create_snapshots([first, second], stripe_size=1000)
+        with self.assertRaises(ValueError):
+            api.create_snapshots([first, second], preload=True)
+
+    def test_recycle(self):
+        api.create_snapshots(self.image, part=1)
+        cow.grow('/dev/mapper/bull0-cow', 2**20)
+        assert len(self.kernel.zrams) == 2
+
+        # The COW device holds the zram device open.
+        with self.assertRaises(OSError):
+            zram.ZramDevice('/dev/zram0').reset()
+
+        api.recycle_snapshot('bull0')
+        assert list(self.kernel.zrams) == [0]
+        assert self.kernel.zrams[0].disksize > 0
+        table = mapper.MapperDevice('/dev/mapper/bull0-cow').table
+        assert isinstance(table[0].target, mapper.Linear)
+        assert len(table) == 1
+
+    def test_aio_remove(self):
+        disk = self.image.parent / 'rpi.img'
+        fake.make_image(disk, size=2**24, partitions=[
+            (0x0c, 2048, 8192), (0x83, 10240, 22528)])
+        api.create_disk_snapshot(disk, name='disk')
+        api.create_snapshots(self.image, part=1, name='spilled',
+                             backing_size=2**20,
+                             spill_to=self.image.parent / 'spill.img')
+
+        # Snapshots made by bull.api are torn down completely.
+        asyncio.run(aio.remove_snapshot('disk'))
+        asyncio.run(aio.remove_snapshot('spilled'))
+        assert not self.kernel.control.devices
+        assert not self.kernel.loops
+        assert not self.kernel.zrams
+
+    def test_aio_rollback(self):
+        budget.set_max_ram(2**21)
+        self.addCleanup(budget.set_max_ram, None)
+
+        async def create():
+            return await aio.create_snapshot(self.image, part=1,
+                                             backing_size=2**20)
+
+        self.fail_after(0)
+        with self.assertRaises(OSError):
+            asyncio.run(create())
+        self.assert_clean()
+        assert budget.memory_usage().headroom == 2**21
+
+    def test_aio_budget(self):
+        budget.set_max_ram(2**21)
+        self.addCleanup(budget.set_max_ram, None)
+
+        async def create():
+            return await aio.create_snapshot(self.image, part=1,
+                                             backing_size=2**20)
+
+        async def create_many(count):
+            return await asyncio.gather(*[create() for i in range(count)],
+                                        return_exceptions=True)
+
+        # Admission happens on worker threads.
+        admit = budget.admit
+        threads = []
+
+        def admitting(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return admit(*args, **kwargs)
+
+        with mock.patch('bull.budget.admit', admitting):
+            snaps = asyncio.run(create_many(3))
+        assert len(threads) == 3
+        assert threading.main_thread() not in threads
+
+        errors = [snap for snap in snaps if isinstance(snap, OverBudget)]
+        assert len(errors) == 1
+        assert budget.memory_usage().headroom == 0
+        assert budget.reserved() == {}
+        assert len(self.kernel.zrams) == 2
+
+    def test_missing_snapshot(self):
+        api.create_snapshots(self.image, part=1)
+        self.kernel.backend().remove('bull0')
+
+        # The record goes, and so do the base and loop devices it
+        # shared with nothing else.
+        with self.assertRaises(NoSuchDevice):
+            api.remove_snapshot('bull0')
+        assert 'bull0-base' not in self.kernel.control.devices
+        assert not self.kernel.loops
+        assert get_registry().get('bull0') is None
+
+    def fail_after(self, count):
+        '''Make every zram hot_add after the first count fail.'''
+
+        hot_add = self.kernel.hot_add
+
+        def failing():
+            if len(self.kernel.zrams) >= count:
+                raise OSError(errno.ENOSPC, 'no more zram devices')
+            return hot_add()
+
+        patcher = mock.patch.object(self.kernel, 'hot_add', failing)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_clean(self):
+        assert not self.kernel.control.devices
+        assert not self.kernel.loops
+        assert not self.kernel.zrams
+
+    def test_create_rollback(self):
+        self.fail_after(1)
+        with self.assertRaises(OSError):
+            api.create_snapshots(self.image, part=1, count=2)
+        self.assert_clean()
+
+        with self.assertRaises(OSError):
+            api.create_snapshots(self.image, part=1, count=2,
+                                 spill_to=self.image.parent / 'spill.img')
+        self.assert_clean()
+
+        with self.assertRaises(OSError):
+            api.create_snapshots(self.image, part=1, engine='thin')
+        self.assert_clean()
+
+        report = api.create_many([{'src': self.image, 'part': 1},
+                                  {'src': self.image, 'part': 1}])
+        assert len(report.failed) == 1
+        assert len(self.kernel.zrams) == 1
+        assert len(self.kernel.control.devices) == 3
+        assert len(get_registry().records()) == 1
+
+    def test_create_rollback_snapshot(self):
+        create_cow = cow.create_cow
+
+        def failing(name, *args, **kwargs):
+            if name == 'bull1-cow':
+                raise OSError(errno.EIO, 'failed')
+            return create_cow(name, *args, **kwargs)
+
+        with mock.patch('bull.cow.create_cow', failing), \
+                self.assertRaises(OSError):
+            api.create_snapshots(self.image, part=1, count=2)
+        self.assert_clean()
+        assert not get_registry().records()
+
+        # The names are free again.
+        snaps = api.create_snapshots(self.image, part=1)
+        assert snaps[0].name == 'bull0'
+
+    def test_pool_refill_rollback(self):
+        snapshots = pool.SnapshotPool(self.image, 1, part=1)
+        snapshots.start()
+        self.addCleanup(snapshots.stop, remove=False)
+
+        discarded = threading.Event()
+        discard_snapshots = api.discard_snapshots
+
+        def discard(*args, **kwargs):
+            discard_snapshots(*args, **kwargs)
+            discarded.set()
+
+        self.fail_after(1)
+        with mock.patch('bull.api.discard_snapshots', discard):
+            snapshots.checkout()
+            assert discarded.wait(5)
+        snapshots.stop(remove=False)
+
+        # Only the snapshot that was checked out is left.
+        assert sorted(self.kernel.control.devices) == [
+            'bull0', 'bull0-base', 'bull0-cow']
+        assert len(self.kernel.zrams) == 1
+
+    def test_remove_reserved(self):
+        mapper.MapperDevice.create('bull0')
+        api.remove_snapshot('bull0')
+        assert not self.kernel.control.devices
+
+    def test_commit(self):
+        api.create_snapshots(self.image, part=1, persistent=True)
+        remaining = [64, 16, 0]
+        status_for = self.kernel.control.status_for
+
+        def merging(mapping, start, length, target_type, params):
+            if target_type == 'snapshot-merge':
+                if len(remaining) > 1:
+                    return '{}/{} 0'.format(remaining.pop(0), length)
+                return '{}/{} 0'.format(remaining[0], length)
+            return status_for(mapping, start, length, target_type, params)
+
+        self.kernel.control.status_for = merging
+        progress = []
+        api.commit_snapshot('bull0', interval=0,
+                            on_progress=lambda *args: progress.append(args))
+
+        assert progress == [(0, 64), (48, 64), (64, 64)]
+        assert not self.kernel.control.devices
+        assert not self.kernel.loops
+        assert not self.kernel.zrams
+
+    def test_commit_unsupported(self):
+        api.create_snapshots(self.image, part=1)
+        with self.assertRaises(UnsupportedDevice):
+            api.commit_snapshot('bull0')
+
+        api.create_snapshots(self.image, part=1, count=2, persistent=True,
+                             prefix='shared')
+        with self.assertRaises(DeviceBusy):
+            api.commit_snapshot('shared0')
+
+    def test_losetup_fallback(self):
+        self.kernel.loop_configure = False
+        api.create_snapshots(self.image, part=1, direct_io=True)
+        assert self.kernel.commands['losetup'] == 1
+        assert loop.LoopDevice('/dev/loop0').direct_io
+
+    def test_unmount(self):
+        api.create_snapshots(self.image, part=1)
+        self.kernel.mount('/dev/mapper/bull0', '/mnt')
+        assert listing.list_snapshots()[0].mountpoint == '/mnt'
+
+        api.remove_snapshot('bull0')
+        assert self.kernel.commands['umount'] == 1
+        assert not self.kernel.mounts
+
+
+class TestFakeKernelDmsetup(TestFakeKernel):
+    '''The same, with dmsetup run against the simulated kernel.'''
+
+    dmsetup = True
+
+    def test_commands(self):
+        api.create_snapshots(self.image, part=1)
+        assert self.kernel.commands['dmsetup'] > 0
+        assert self.kernel.subprocesses == self.kernel.commands['dmsetup']
@@ -0,0 +1,62 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from bull import api
+from bull import blockdev
+from bull import fake
+from bull.inventory import Inventory
+
+
+class TestInventory(TestCase):
+    '''Test finding devices and mounts from one scan of the host.'''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        image = Path(tmpdir.name) / 'disk.img'
+        fake.make_image(image, size=2**24)
+
+        self.kernel = fake.FakeKernel(Path(tmpdir.name) / 'run')
+        self.kernel.__enter__()
+        self.addCleanup(self.kernel.__exit__, None, None, None)
+        api.create_snapshots(image, part=1)
+
+        self.snap = self.kernel.control.devices['bull0']
+        self.dm_path = '/dev/dm-{}'.format(self.snap.dev)
+
+    def test_lookup(self):
+        inventory = Inventory()
+        entry = inventory.lookup('/dev/mapper/bull0')
+
+        assert entry.name == 'dm-{}'.format(self.snap.dev)
+        assert entry.path == '/dev/mapper/bull0'
+        assert inventory.lookup(self.dm_path) is entry
+        assert inventory.lookup(entry.devnum) is entry
+        assert inventory.path('7:0') == '/dev/loop0'
+        assert not inventory.exists('/dev/mapper/bull9')
+
+    def test_stacking(self):
+        inventory = Inventory()
+
+        assert [e.path for e in inventory.holders('/dev/loop0')] == \
+            ['/dev/mapper/bull0-base']
+        assert sorted(e.path for e in inventory.slaves('/dev/mapper/bull0')) \
+            == ['/dev/mapper/bull0-base', '/dev/mapper/bull0-cow']
+
+    def test_mounted_by_kernel_name(self):
+        self.kernel.mount(self.dm_path, '/mnt')
+        inventory = Inventory()
+
+        assert inventory.is_mounted('/dev/mapper/bull0')
+        assert blockdev.BlockDevice('/dev/mapper/bull0').is_mounted()
+        assert blockdev.BlockDevice('/dev/mapper/bull0').is_mounted(
+            inventory)
+
+    def test_refresh(self):
+        inventory = Inventory()
+        self.kernel.mount('/dev/mapper/bull0', '/mnt')
+        assert not inventory.is_mounted('/dev/mapper/bull0')
+
+        inventory.refresh()
+        assert inventory.mountpoints('/dev/mapper/bull0') == ['/mnt']
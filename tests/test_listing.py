@@ -0,0 +1,74 @@
+from unittest import TestCase, mock
+
+from bull import dmioctl
+from bull import listing
+from bull import mapper
+from bull import zram
+
+
+@mock.patch('bull.listing.Inventory')
+@mock.patch.object(zram.ZramDevice, 'mm_stat')
+class TestListSnapshots(TestCase):
+    '''Test building snapshot records from one sweep of the kernel.'''
+
+    def setUp(self):
+        self.control = dmioctl.FakeControl()
+        self.backend = dmioctl.IoctlBackend(self.control)
+
+        def load(name, *segments):
+            dev = mapper.MapperDevice.create(name, backend=self.backend)
+            dev.table.extend(segments)
+            dev.load()
+
+        load('bull0-base',
+             mapper.Segment(0, 1024, mapper.Linear('7:0', 2048)),
+             mapper.Segment(1024, 1024, mapper.Zero()))
+        for name in ('bull0', 'bull1'):
+            load('{}-cow'.format(name),
+                 mapper.Segment(0, 512, mapper.Linear('/dev/zram0')))
+            load(name, mapper.Segment(0, 2048, mapper.Snapshot(
+                '/dev/mapper/bull0-base', '/dev/mapper/{}-cow'.format(name))))
+
+    def test_list(self, mock_mm_stat, mock_inventory):
+        inventory = mock_inventory.return_value
+        inventory.mountpoint.side_effect = {'253:4': '/mnt'}.get
+        inventory.path.side_effect = {'7:0': '/dev/sda'}.get
+        mock_mm_stat.return_value = zram.MMStat(8192, 2048, 0, 0, 4096, 0, 0)
+
+        snapshots = listing.list_snapshots(backend=self.backend)
+
+        assert [info.name for info in snapshots] == ['bull0', 'bull1']
+        info = snapshots[1]
+        assert info.engine == 'snapshot'
+        assert info.size == 2048 * 512
+        assert info.source == '/dev/sda'
+        assert info.offset == 2048 * 512
+        assert info.base == '/dev/mapper/bull0-base'
+        assert info.backing_devices == ['/dev/zram0']
+        assert info.total == 2048 * 512
+        assert info.compr_data_size == 2048
+        assert info.mountpoint == '/mnt'
+        assert mock_mm_stat.call_count == 1
+
+    def test_allocated(self, mock_mm_stat, mock_inventory):
+        mock_inventory.return_value.mountpoint.return_value = None
+        mock_inventory.return_value.path.return_value = None
+        mock_mm_stat.return_value = zram.MMStat(0, 0, 0, 0, 0, 0, 0)
+        status_for = self.control.status_for
+
+        def allocated(mapping, start, length, target_type, params):
+            if target_type == 'snapshot':
+                return '48/{} 16'.format(length)
+            return status_for(mapping, start, length, target_type, params)
+
+        self.control.status_for = allocated
+        snapshots = listing.list_snapshots(backend=self.backend)
+        assert snapshots[0].allocated == 48 * 512
+
+    def test_prefix(self, mock_mm_stat, mock_inventory):
+        mock_inventory.return_value.mountpoint.return_value = None
+        mock_inventory.return_value.path.return_value = None
+
+        snapshots = listing.list_snapshots(prefix='bull1',
+                                           backend=self.backend)
+        assert [info.name for info in snapshots] == ['bull1']
@@ -28,3 +28,12 @@ class TestMapperTables(TestCase):
         mock_run.assert_called_with(
             ['losetup', '-d', '/dev/loop0'],
             check=True, input=None, stderr=-1, stdout=-1)
+
+    def test_create_direct_io(self, mock_run):
+        mock_run.return_value = FakeCompletedProcess(stdout=b'/dev/loop0')
+        loop.LoopDevice.create('/does/not/exist', direct_io=True,
+                               block_size=4096)
+        mock_run.assert_called_with(
+            ['losetup', '--find', '--show', '--direct-io=on',
+             '--sector-size', '4096', '/does/not/exist'],
+            check=True, input=None, stderr=-1, stdout=-1)
@@ -22,6 +22,11 @@ class TestMapperTables(TestCase):
         t = mapper.Snapshot('/dev/block', '/dev/cow')
         assert str(t) == 'snapshot /dev/block /dev/cow N 16'
 
+    def test_snapshot_merge(self):
+        t = mapper.SnapshotMerge('/dev/block', '/dev/cow', 'P')
+        assert str(t) == 'snapshot-merge /dev/block /dev/cow P 16'
+        assert mapper.Target.from_string(str(t)) == t
+
     def test_linear_segment(self):
         t = mapper.Segment(0, 2048, mapper.Linear('/dev/block'))
         assert str(t) == '0 2048 linear /dev/block 0'
@@ -43,3 +48,34 @@ class TestMapperTables(TestCase):
 
         assert isinstance(t[0].target, mapper.Linear)
         assert isinstance(t[1].target, mapper.Zero)
+
+    def test_thinpool(self):
+        t = mapper.Thinpool('/dev/meta', '/dev/data', 128, 0)
+        assert str(t) == 'thin-pool /dev/meta /dev/data 128 0 0'
+
+    def test_thinpool_features(self):
+        t = mapper.Target.from_string(
+            'thin-pool 253:1 253:2 128 0 1 skip_block_zeroing')
+        assert t.features == ['skip_block_zeroing']
+        assert str(t) == 'thin-pool 253:1 253:2 128 0 1 skip_block_zeroing'
+
+        t.features = []
+        assert str(t) == 'thin-pool 253:1 253:2 128 0 0'
+
+    def test_striped(self):
+        t = mapper.Striped(128, [('/dev/loop0', 0), ('/dev/loop1', 2048)])
+        assert str(t) == 'striped 2 128 /dev/loop0 0 /dev/loop1 2048'
+
+    def test_striped_from_string(self):
+        t = mapper.Target.from_string('striped 2 128 7:0 0 7:1 2048')
+        assert t.chunk_size == 128
+        assert t.devices == ['7:0', '7:1']
+        assert str(t) == 'striped 2 128 7:0 0 7:1 2048'
+
+        with self.assertRaises(ValueError):
+            mapper.Target.from_string('striped 3 128 7:0 0 7:1 2048')
+
+    def test_thin(self):
+        t = mapper.Thin('/dev/pool', 1, '/dev/origin')
+        assert str(t) == 'thin /dev/pool 1 /dev/origin'
+        assert str(mapper.Thin('/dev/pool', 1)) == 'thin /dev/pool 1'
@@ -0,0 +1,58 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from bull import listing
+from bull import metrics
+from bull import timing
+
+
+class TestMetrics(TestCase):
+    '''Test the Prometheus textfile exporter.'''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.latency = metrics.LatencyHistograms(
+            Path(tmpdir.name) / 'latency.json', buckets=(0.01, 0.1))
+
+    def test_histograms(self):
+        self.latency.add([timing.Event('base', 'dm load', 0, 0.005),
+                          timing.Event('base', 'dm load', 0, 0.05),
+                          timing.Event('base', None, 0, 0.2)])
+        self.latency.add([timing.Event('base', 'dm load', 0, 0.005)])
+
+        histograms = self.latency.load()
+        assert histograms[('base', 'dm load')]['buckets'] == [2, 1, 0]
+        assert histograms[('base', None)]['buckets'] == [0, 0, 1]
+
+        text = metrics.format_metrics([], histograms, self.latency.buckets)
+        assert 'bull_snapshots 0' in text
+        assert ('bull_operation_duration_seconds_bucket{phase="base",'
+                'operation="dm load",le="0.1"} 3') in text
+        assert ('bull_operation_duration_seconds_bucket{phase="base",'
+                'operation="dm load",le="+Inf"} 3') in text
+        assert ('bull_phase_duration_seconds_count{phase="base"} 1'
+                in text)
+
+    def test_gauges(self):
+        info = listing.SnapshotInfo('bull0', '/dev/mapper/bull0', 'snapshot',
+                                    2**20, allocated=4096, total=2**18)
+        text = metrics.format_metrics([info], {})
+
+        assert 'bull_snapshots 1' in text
+        assert ('bull_cow_allocated_bytes{snapshot="bull0",'
+                'engine="snapshot"} 4096') in text
+        assert 'bull_zram_orig_data_bytes{' not in text
+
+    def test_spill_counters(self):
+        info = listing.SnapshotInfo('bull0', '/dev/mapper/bull0', 'snapshot',
+                                    2**20, spilled=8192, spill_reads=4096,
+                                    spill_writes=12288)
+        text = metrics.format_metrics([info], {})
+
+        assert '# TYPE bull_zram_spilled_bytes gauge' in text
+        assert '# TYPE bull_zram_spill_read_bytes_total counter' in text
+        assert '# TYPE bull_zram_spill_written_bytes_total counter' in text
+        assert ('bull_zram_spill_written_bytes_total{snapshot="bull0",'
+                'engine="snapshot"} 12288') in text
@@ -0,0 +1,108 @@
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import pool
+from bull.exceptions import NoDevicesAvailable, OverBudget
+
+
+class FakeSnap():
+    def __init__(self, name):
+        self.name = name
+        self.table = [mock.Mock(sectors=2048)]
+
+
+@mock.patch('bull.pool.cow')
+@mock.patch('bull.pool.mapper')
+@mock.patch('bull.pool.api')
+class TestSnapshotPool(TestCase):
+    '''Test checkout, checkin and refill of a snapshot pool.'''
+
+    def make_pool(self, mock_api, size=2):
+        names = ('bull{}'.format(i) for i in range(100))
+        mock_api.create_snapshots.side_effect = lambda src, count, **kw: [
+            FakeSnap(next(names)) for i in range(count)]
+        mock_api.reserve_names.side_effect = lambda count, **kw: [
+            FakeSnap(next(names)) for i in range(count)]
+
+        snapshots = pool.SnapshotPool('/image', size, backend=mock.Mock(),
+                                      registry=mock.Mock())
+        snapshots.start()
+        self.addCleanup(snapshots.stop, remove=False)
+        return snapshots
+
+    def test_checkout_refills(self, mock_api, mock_mapper, mock_cow):
+        snapshots = self.make_pool(mock_api)
+
+        assert snapshots.checkout() == 'bull0'
+        assert snapshots.checkout() == 'bull1'
+        assert snapshots.checkout(timeout=5) == 'bull2'
+        assert mock_api.stack_snapshots.called
+
+    def test_checkin_recycles(self, mock_api, mock_mapper, mock_cow):
+        snapshots = self.make_pool(mock_api, size=1)
+        snapshots.stop(remove=False)
+
+        name = snapshots.checkout()
+        snapshots.checkin('/dev/mapper/{}'.format(name))
+
+        mock_api.recycle_snapshot.assert_called_with(
+            name, backend=snapshots.backend, registry=snapshots.registry)
+        assert snapshots.status()['ready'] == [name]
+
+    def test_checkin_failure(self, mock_api, mock_mapper, mock_cow):
+        snapshots = self.make_pool(mock_api, size=1)
+        snapshots.stop(remove=False)
+
+        name = snapshots.checkout()
+        mock_api.recycle_snapshot.side_effect = OSError('busy')
+        with self.assertRaises(OSError):
+            snapshots.checkin(name)
+
+        assert snapshots.status()['checked_out'] == [name]
+
+    @mock.patch('bull.pool.snapbudget')
+    def test_refill_errors(self, mock_budget, mock_api, mock_mapper,
+                           mock_cow):
+        admitted = [mock.MagicMock()] * 10
+        mock_budget.admit.side_effect = [OSError('no zram'),
+                                         OverBudget('full')] + admitted
+        snapshots = self.make_pool(mock_api, size=1)
+
+        snapshots.checkout()
+        assert snapshots.checkout(timeout=5) == 'bull1'
+        assert mock_budget.admit.call_count >= 3
+
+    def test_checkout_timeout(self, mock_api, mock_mapper, mock_cow):
+        snapshots = self.make_pool(mock_api, size=1)
+        snapshots.stop(remove=False)
+        snapshots.checkout()
+
+        with self.assertRaises(NoDevicesAvailable):
+            snapshots.checkout(timeout=0)
+
+
+class TestPoolServer(TestCase):
+    '''Test the pool protocol over a unix socket.'''
+
+    def test_checkout(self):
+        snapshots = mock.Mock()
+        snapshots.checkout.return_value = 'bull3'
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'pool.sock'
+            server = pool.PoolServer(snapshots, path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            try:
+                client = pool.PoolClient(path)
+                assert client.checkout() == '/dev/mapper/bull3'
+                client.checkin('bull3')
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+        snapshots.checkin.assert_called_with('bull3')
@@ -0,0 +1,46 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import preload
+
+
+class TestCopyNonzero(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.src = Path(tmpdir.name) / 'src'
+        self.dest = Path(tmpdir.name) / 'dest'
+
+        with open(str(self.src), 'wb') as fd:
+            fd.truncate(2**20)
+            fd.seek(4096)
+            fd.write(b'a' * 100)
+            fd.seek(3 * 2**16 - 10)
+            fd.write(b'b' * 20)
+
+        with open(str(self.dest), 'wb') as fd:
+            fd.truncate(2**20)
+
+    def test_copy(self):
+        stats = preload.copy_nonzero(self.src, self.dest, 0, 2**20,
+                                     chunk_size=2**18)
+        assert stats.bytes_read == 2**20
+        assert stats.bytes_written == 3 * 2**16
+        assert self.src.read_bytes() == self.dest.read_bytes()
+
+    @mock.patch('bull.host.os.fsync')
+    def test_copy_synced(self, mock_fsync):
+        preload.copy_nonzero(self.src, self.dest, 0, 2**20)
+        assert mock_fsync.call_count == 1
+
+    def test_copy_offset(self):
+        stats = preload.copy_nonzero(self.src, self.dest, 4096, 2**16)
+        assert stats.bytes_read == 2**16
+        assert stats.bytes_written == 2**16
+        assert self.dest.read_bytes()[:100] == b'a' * 100
+
+    def test_throughput(self):
+        stats = preload.CopyStats(bytes_read=2**20, elapsed=0.5)
+        assert stats.throughput == 2**21
+        assert preload.CopyStats().throughput == 0.0
@@ -0,0 +1,147 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import api
+from bull import dmioctl
+from bull import mapper
+from bull import registry
+from bull import zram
+from bull.exceptions import NoSuchDevice
+
+
+class RegistryTestCase(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = Path(tmpdir.name) / 'registry.json'
+        self.registry = registry.Registry(self.path)
+
+
+class TestRegistry(RegistryTestCase):
+    '''Test storing snapshot records.'''
+
+    def test_add_remove(self):
+        assert not self.registry.exists()
+        self.registry.add(registry.SnapshotRecord('bull0', base='/dev/b'),
+                          registry.SnapshotRecord('bull1', base='/dev/b'))
+
+        assert self.registry.get('bull0').base == '/dev/b'
+        assert [r.name for r in self.registry.records()] == ['bull0', 'bull1']
+        assert list(json.loads(self.path.read_text())['snapshots']) == \
+            ['bull0', 'bull1']
+
+        assert self.registry.remove('bull0').name == 'bull0'
+        assert self.registry.get('bull0') is None
+        assert self.registry.remove('bull0') is None
+
+    def test_update(self):
+        self.registry.add(registry.SnapshotRecord('bull0', zram=['/dev/z0']))
+        self.registry.update('bull0', zram=['/dev/z0', '/dev/z1'])
+        self.registry.update('bull1', zram=[])
+
+        assert self.registry.get('bull0').zram == ['/dev/z0', '/dev/z1']
+        assert self.registry.get('bull1') is None
+
+    def test_failed_transaction(self):
+        self.registry.add(registry.SnapshotRecord('bull0'))
+
+        with self.assertRaises(RuntimeError):
+            with self.registry.transaction() as records:
+                del records['bull0']
+                raise RuntimeError()
+
+        assert self.registry.get('bull0') is not None
+
+    def test_unreadable(self):
+        self.path.write_text('{')
+        assert self.registry.records() == []
+
+
+@mock.patch('bull.api.loop')
+@mock.patch('bull.api.zram')
+@mock.patch('bull.api.blockdev')
+class TestRemoveRecorded(RegistryTestCase):
+    '''Test removing snapshots using the registry.'''
+
+    def setUp(self):
+        super().setUp()
+        self.backend = dmioctl.IoctlBackend(dmioctl.FakeControl())
+
+        for name in ['bull0-base', 'bull0', 'bull0-cow', 'bull1',
+                     'bull1-cow']:
+            self.backend.create(name)
+
+        self.registry.add(*[
+            registry.SnapshotRecord(
+                name, base='/dev/mapper/bull0-base', loop='/dev/loop0',
+                backing='/dev/mapper/{}-cow'.format(name),
+                zram=['/dev/zram{}'.format(i)])
+            for i, name in enumerate(['bull0', 'bull1'])])
+
+    def test_shared_base(self, mock_blockdev, mock_zram, mock_loop):
+        mock_blockdev.BlockDevice.return_value.is_mounted.return_value = \
+            False
+
+        api.remove_snapshot('bull1', backend=self.backend,
+                            registry=self.registry)
+        assert self.backend.names() == ['bull0', 'bull0-base', 'bull0-cow']
+        mock_zram.ZramDevice.assert_called_once_with('/dev/zram1')
+        assert not mock_loop.LoopDevice.called
+
+        api.remove_snapshot('bull0', backend=self.backend,
+                            registry=self.registry)
+        assert self.backend.names() == []
+        mock_loop.LoopDevice.assert_called_once_with('/dev/loop0')
+        assert self.registry.records() == []
+
+    def test_missing(self, mock_blockdev, mock_zram, mock_loop):
+        self.backend.remove('bull1')
+
+        with self.assertRaises(NoSuchDevice):
+            api.remove_snapshot('bull1', backend=self.backend,
+                                registry=self.registry)
+        assert self.registry.get('bull1') is None
+
+
+@mock.patch('bull.listing.Inventory')
+@mock.patch.object(zram.ZramDevice, 'mm_stat')
+class TestReconcile(RegistryTestCase):
+    '''Test rebuilding the registry from the kernel.'''
+
+    def setUp(self):
+        super().setUp()
+        self.backend = dmioctl.IoctlBackend(dmioctl.FakeControl())
+
+        def load(name, *segments):
+            dev = mapper.MapperDevice.create(name, backend=self.backend)
+            dev.table.extend(segments)
+            dev.load()
+
+        load('bull0-base', mapper.Segment(0, 1024, mapper.Linear('7:0', 0)))
+        load('bull0-cow', mapper.Segment(0, 512, mapper.Linear('/dev/zram0')))
+        load('bull0', mapper.Segment(0, 1024, mapper.Snapshot(
+            '/dev/mapper/bull0-base', '/dev/mapper/bull0-cow')))
+        load('lvsnap', mapper.Segment(0, 1024, mapper.Snapshot(
+            '/dev/vg/lv', '/dev/vg/lvsnap-cow')))
+
+    def test_reconcile(self, mock_mm_stat, mock_inventory):
+        mock_inventory.return_value.mountpoint.return_value = None
+        mock_inventory.return_value.path.side_effect = {
+            '7:0': '/dev/loop0'}.get
+        self.registry.add(registry.SnapshotRecord('bull5'))
+
+        added, dropped = registry.reconcile(self.registry,
+                                            backend=self.backend)
+        assert added == ['bull0']
+        assert dropped == ['bull5']
+
+        record = self.registry.get('bull0')
+        assert record.base == '/dev/mapper/bull0-base'
+        assert record.backing == '/dev/mapper/bull0-cow'
+        assert record.loop == '/dev/loop0'
+        assert record.zram == ['/dev/zram0']
+
+        assert registry.reconcile(self.registry,
+                                  backend=self.backend) == ([], [])
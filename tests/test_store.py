@@ -0,0 +1,15 @@
+from unittest import TestCase
+
+from bull import store
+
+
+class TestStoreHeader(TestCase):
+    def test_round_trip(self):
+        header = store.StoreHeader('bull0', '/tmp/disk.img', part=2,
+                                   data_sectors=2048, size=2**21)
+        data = header.to_bytes()
+        assert len(data) == store.HEADER_SIZE
+        assert store.StoreHeader.from_bytes(data) == header
+
+    def test_no_header(self):
+        assert store.StoreHeader.from_bytes(bytes(store.HEADER_SIZE)) is None
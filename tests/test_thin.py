@@ -0,0 +1,49 @@
+from unittest import TestCase, mock
+
+from bull import dmioctl
+from bull import mapper
+from bull import thin
+
+
+class TestThinPool(TestCase):
+    '''Test thin pool management against a fake control device.'''
+
+    def setUp(self):
+        self.control = dmioctl.FakeControl()
+        self.backend = dmioctl.IoctlBackend(self.control)
+
+        pool = mapper.MapperDevice.create('pool', backend=self.backend)
+        pool.table.append(mapper.Segment(
+            0, 1024, mapper.Thinpool('/dev/zram0', '/dev/zram1', 128, 0)))
+        pool.load()
+        self.pool = thin.ThinPool(pool.device, backend=self.backend)
+
+    def test_status(self):
+        status = self.pool.status()
+        assert status.total_data_blocks == 8
+        assert status.mode == 'rw'
+
+    def test_create_thin(self):
+        assert self.pool.create_thin() == 0
+
+        vol = mapper.MapperDevice.create('vol', backend=self.backend)
+        vol.table.append(mapper.Segment(
+            0, 1024, mapper.Thin('/dev/mapper/pool', 0)))
+        vol.load()
+
+        assert self.pool.active_dev_ids() == [0]
+        assert self.pool.create_snap(0) == 1
+        assert self.control.devices['pool'].messages == [
+            'create_thin 0', 'create_snap 1 0']
+
+    def test_create_many(self):
+        with mock.patch.object(self.pool, 'active_dev_ids',
+                               return_value=[3]) as active_dev_ids:
+            ids = [self.pool.create_thin() for i in range(5)]
+
+        assert ids == [4, 5, 6, 7, 8]
+        assert active_dev_ids.call_count == 1
+
+    def test_metadata_size(self):
+        assert thin.metadata_size(0) == thin.MIN_METADATA_SIZE
+        assert thin.metadata_size(2**40) > thin.MIN_METADATA_SIZE
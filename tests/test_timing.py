@@ -0,0 +1,59 @@
+from unittest import TestCase
+
+from bull import dmioctl
+from bull import timing
+
+
+class TestRecorder(TestCase):
+    '''Test timing steps and phases.'''
+
+    def setUp(self):
+        self.recorder = timing.Recorder()
+
+    def test_phases(self):
+        with self.recorder.phase('base'):
+            with self.recorder.timed('dm load'):
+                pass
+            with self.recorder.timed('dm load'):
+                pass
+        with self.recorder.timed('losetup'):
+            pass
+
+        events = self.recorder.take()
+        assert [(e.phase, e.operation) for e in events] == [
+            ('base', 'dm load'), ('base', 'dm load'), ('base', None),
+            (None, 'losetup')]
+        assert self.recorder.take() == []
+
+        summary = timing.summarize(events)
+        assert [(s.phase, s.operation, s.count) for s in summary] == [
+            ('base', None, 1), ('base', 'dm load', 2), (None, 'losetup', 1)]
+
+        trace = timing.trace(events)['traceEvents']
+        assert trace[0]['name'] == 'dm load'
+        assert trace[0]['cat'] == 'base'
+        assert trace[0]['ph'] == 'X'
+
+        assert 'dm load' in timing.format_summary(events)
+
+    def test_maxlen(self):
+        recorder = timing.Recorder(maxlen=2)
+        for i in range(5):
+            with recorder.timed('op{}'.format(i)):
+                pass
+
+        assert [e.operation for e in recorder.take()] == ['op3', 'op4']
+
+    def test_ioctl(self):
+        backend = dmioctl.IoctlBackend(dmioctl.FakeControl())
+        timing.get_recorder().take()
+
+        with timing.phase('test'):
+            backend.create('test0')
+            backend.suspend('test0')
+            backend.resume('test0')
+
+        assert [(e.phase, e.operation) for e in
+                timing.get_recorder().take()] == [
+            ('test', 'dm create'), ('test', 'dm suspend'),
+            ('test', 'dm resume'), ('test', None)]
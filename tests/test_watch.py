@@ -0,0 +1,65 @@
+from unittest import TestCase, mock
+
+from bull import dmioctl
+from bull import mapper
+from bull import watch
+
+
+class FullControl(dmioctl.FakeControl):
+    def status_for(self, mapping, start, length, target_type, params):
+        if target_type == 'snapshot':
+            return '{}/{} 16'.format(length - 32, length)
+        return super().status_for(mapping, start, length, target_type,
+                                  params)
+
+
+class TestSnapshotUsage(TestCase):
+    '''Test parsing of snapshot status lines.'''
+
+    def test_usage(self):
+        usage = watch.SnapshotUsage.from_status(
+            'bull0', '0 2048 snapshot 512/1024 16')
+        assert usage.valid
+        assert usage.used == 0.5
+
+    def test_invalid(self):
+        usage = watch.SnapshotUsage.from_status('bull0',
+                                                '0 2048 snapshot Invalid')
+        assert not usage.valid
+        assert usage.state == 'Invalid'
+
+
+@mock.patch('bull.watch.cow')
+class TestWatcher(TestCase):
+    '''Test growing snapshots that cross the watermark.'''
+
+    def setUp(self):
+        self.backend = dmioctl.IoctlBackend(FullControl())
+        for name, sectors in [('bull0', 1024), ('other', 1024)]:
+            snap = mapper.MapperDevice.create(name, backend=self.backend)
+            snap.table.append(mapper.Segment(0, sectors, mapper.Snapshot(
+                '/dev/mapper/base', '/dev/mapper/{}-cow'.format(name))))
+            snap.load()
+
+    def test_grow(self, mock_cow):
+        mock_cow.is_growable.return_value = True
+        registry = mock.Mock()
+        registry.get.return_value.zram = ['/dev/zram0']
+        mock_cow.grow.return_value.device = '/dev/zram1'
+        watcher = watch.Watcher(prefix='bull', backend=self.backend,
+                                registry=registry)
+        usage = watcher.poll()
+
+        assert [u.name for u in usage] == ['bull0']
+        mock_cow.grow.assert_called_once_with(
+            '/dev/mapper/bull0-cow', 1024 * 512, backend=self.backend)
+        registry.update.assert_called_once_with(
+            'bull0', zram=['/dev/zram0', '/dev/zram1'])
+
+    def test_max_size(self, mock_cow):
+        mock_cow.is_growable.return_value = True
+        watcher = watch.Watcher(max_size=1024 * 512, backend=self.backend,
+                                registry=mock.Mock())
+        watcher.poll()
+
+        assert not mock_cow.grow.called
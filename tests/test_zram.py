@@ -0,0 +1,66 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from bull import zram
+
+
+class TestZramDevice(TestCase):
+    '''Test zram attributes against a fake sysfs directory.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sysfs = Path(self.tmpdir.name)
+        (self.sysfs / 'comp_algorithm').write_text('lzo lzo-rle [lz4] zstd\n')
+        (self.sysfs / 'mm_stat').write_text(
+            '  8192  2048  12288  0  16384  1  0  0\n')
+        (self.sysfs / 'io_stat').write_text('  0  1  2  3\n')
+
+        patcher = mock.patch.object(zram.ZramDevice, 'sysfs',
+                                    new_callable=mock.PropertyMock,
+                                    return_value=self.sysfs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dev = zram.ZramDevice('/dev/zram0')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_comp_algorithm(self):
+        assert self.dev.comp_algorithm == 'lz4'
+        assert 'zstd' in self.dev.available_comp_algorithms()
+
+    def test_mm_stat(self):
+        stat = self.dev.mm_stat()
+        assert stat.orig_data_size == 8192
+        assert stat.compr_data_size == 2048
+        assert stat.mem_used_max == 16384
+        assert stat.compression_ratio == 4.0
+
+    def test_io_stat(self):
+        assert self.dev.io_stat().invalid_io == 2
+
+    def test_configure(self):
+        self.dev.configure(2**20, comp_algorithm='zstd', max_comp_streams=2,
+                           mem_limit=2**19)
+
+        assert (self.sysfs / 'comp_algorithm').read_text() == 'zstd'
+        assert (self.sysfs / 'max_comp_streams').read_text() == '2'
+        assert (self.sysfs / 'disksize').read_text() == str(2**20)
+        assert (self.sysfs / 'mem_limit').read_text() == str(2**19)
+
+    def test_writeback(self):
+        (self.sysfs / 'backing_dev').write_text('none\n')
+        (self.sysfs / 'bd_stat').write_text('  10  2  12\n')
+        assert self.dev.backing_dev is None
+        assert self.dev.bd_stat() == zram.BDStat(10, 2, 12)
+
+        self.dev.configure(2**20, backing_dev='/dev/loop3')
+        self.dev.set_writeback_limit(2**20)
+        self.dev.mark_idle()
+        self.dev.writeback()
+
+        assert self.dev.backing_dev == '/dev/loop3'
+        assert (self.sysfs / 'writeback_limit').read_text() == '256'
+        assert (self.sysfs / 'idle').read_text() == 'all'
+        assert (self.sysfs / 'writeback').read_text() == 'idle'